@@ -0,0 +1,77 @@
+#!/bin/bash
+# Author: Vincent Hasse
+# License: MIT
+# Installs containerd and Kubernetes inside an emulated VM. Either run when the guest image is built by 'q8s bake-guest'
+# or, without a prebuilt image, by cloud-init on the first boot of the VM.
+# The guest images are cached by a hash of this script, change KUBERNETES_VERSION here only.
+
+KUBERNETES_VERSION="1.28.0-1.1"
+KUBERNETES_REPOSITORY="v$(echo $KUBERNETES_VERSION | cut -d. -f1,2)"
+export DEBIAN_FRONTEND=noninteractive
+
+sudo sh -c 'echo "GNUTLS_CPUID_OVERRIDE=0x1" >> /etc/environment'
+sudo apt update
+sudo apt-get -y upgrade
+sudo apt-get install -y dnsutils net-tools git
+#install containerd runtime
+sudo apt-get install -y curl ca-certificates gnupg
+sudo install -m 0755 -d /etc/apt/keyrings
+sudo curl -fsSL https://download.docker.com/linux/ubuntu/gpg -o /etc/apt/keyrings/docker.asc
+sudo chmod a+r /etc/apt/keyrings/docker.asc
+# Add the repository to Apt sources:
+echo \
+"deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.asc] https://download.docker.com/linux/ubuntu \
+$(. /etc/os-release && echo "$VERSION_CODENAME") stable" | \
+sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
+sudo apt-get update
+sudo apt-get -y install containerd.io
+
+# containerd configuration
+sudo containerd config default | sudo tee /etc/containerd/config.toml
+
+# to avoid continous restart of etcd pod and hence error for kube-apiserver and other kube-system pods
+# change SystemdCgroup to "true" in /etc/containerd/config.toml
+# see https://github.com/etcd-io/etcd/issues/13670
+sudo sed -i 's|SystemdCgroup = false|SystemdCgroup = true|g' /etc/containerd/config.toml
+sudo systemctl restart containerd
+
+#change system variables, fails harmlessly while the image is built, the files below apply them on every boot
+sudo modprobe overlay
+sudo modprobe br_netfilter
+
+sudo tee /proc/sys/net/bridge/bridge-nf-call-iptables <<EOF
+1
+EOF
+
+sudo tee /proc/sys/net/ipv4/ip_forward <<EOF
+1
+EOF
+
+sudo cat <<EOF | sudo tee /etc/modules-load.d/containerd.conf
+overlay
+br_netfilter
+EOF
+
+cat <<EOF | sudo tee /etc/sysctl.d/99-kubernetes-cri.conf
+net.bridge.bridge-nf-call-iptables=1
+net.ipv4.ip_forward=1
+net.bridge.bridge-nf-call-ip6tables=1
+EOF
+
+
+#disable swapoff
+sudo swapoff -a
+#permanently
+sudo sed -i '/ swap / s/^/#/' /etc/fstab
+
+#install kubernetes components
+sudo rm -f /etc/apt/sources.list.d/kubernetes.list
+echo "deb [signed-by=/etc/apt/keyrings/kubernetes-apt-keyring.gpg] https://pkgs.k8s.io/core:/stable:/$KUBERNETES_REPOSITORY/deb/ /" | sudo tee /etc/apt/sources.list.d/kubernetes.list
+curl -fsSL https://pkgs.k8s.io/core:/stable:/$KUBERNETES_REPOSITORY/deb/Release.key | sudo gpg --dearmor --yes -o /etc/apt/keyrings/kubernetes-apt-keyring.gpg
+sudo apt update
+sudo apt install -y kubelet=$KUBERNETES_VERSION kubeadm=$KUBERNETES_VERSION kubectl=$KUBERNETES_VERSION
+
+#disable auto-update
+sudo apt-mark hold kubectl kubeadm kubelet
+
+sudo sysctl --system
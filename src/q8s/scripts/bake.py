@@ -0,0 +1,105 @@
+"""
+License: MIT
+
+Creation of a golden host image with QEMU, libvirt, containerd and Kubernetes preinstalled. A temporary instance
+runs prepare_host.sh and install-k8s.sh and is saved as image 'q8s-host-<hash>', the hash covering both scripts and the
+base image. Masters and workers boot from this image as long as the scripts do not change, their setup scripts skip
+the steps marked as done in /etc/q8s.
+"""
+import base64
+import logging
+from openstack.connection import Connection
+from q8s.scripts.helper import exceptions, helper_functions, openstack_communication, openstack_resolver, q8s_tracer, ssh_pool
+from q8s.scripts.helper.cluster_def import ClusterData
+
+
+logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
+
+BAKE_SERVER_NAME = "q8s-bake"
+
+
+def get_bake_command(giturl: str) -> str:
+    """
+    Creates the command preparing the temporary instance and cleaning it up for the snapshot. The cloned repository,
+    the cloud-init state and the machine id are removed, so instances booted from the image behave like new instances.
+
+    Args:
+        giturl (str): A URL that can be used to clone Q8S.
+
+    Returns:
+        str: The shell command.
+    """
+    return (
+        "cloud-init status --wait > /dev/null 2>&1; export GNUTLS_CPUID_OVERRIDE=0x1; cd ~; "
+        f"sudo apt update && sudo apt install -y git && rm -rf ~/Q8S && git clone {giturl} && "
+        "bash ~/Q8S/src/q8s/scripts/prepare_host.sh > /home/cloud/bake.log 2>&1 && "
+        "sudo bash ~/Q8S/src/q8s/scripts/install-k8s.sh >> /home/cloud/bake.log 2>&1 && "
+        "sudo touch /etc/q8s/master-prepared && "
+        "rm -rf ~/Q8S ~/bake.log && sudo apt clean && "
+        "sudo cloud-init clean --logs && sudo truncate -s 0 /etc/machine-id"
+    )
+
+
+def bake_host_image(conn: Connection, cluster_data: ClusterData, force: bool = False) -> str:
+    """
+    Creates the baked host image for the current setup scripts if it does not exist yet.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        cluster_data (ClusterData): An object containing configuration data for the cluster.
+        force (bool): Create the image even if an image with the same name exists.
+
+    Returns:
+        str: The name of the image.
+
+    Raises:
+        Q8sFatalError: If the temporary instance cannot be prepared or saved.
+    """
+    resolver = openstack_resolver.get_resolver(conn)
+    image_name = openstack_communication.get_baked_image_name(cluster_data)
+    if resolver.image(image_name) is not None and not force:
+        logger.info(f"Host image {image_name} already exists, the setup scripts did not change.")
+        return image_name
+
+    keypair = openstack_communication.create_keypair(conn)
+    openstack_communication.create_security_group(conn, cluster_data)
+    openstack_communication.add_security_group_to_initial_instance(conn, cluster_data)
+    network = resolver.network(cluster_data.private_network_id)
+    image = resolver.image(cluster_data.default_image_name)
+    flavor = resolver.flavor(cluster_data.cluster_definition.master_node_flavor)
+    if network is None or image is None or flavor is None:
+        raise exceptions.Q8sFatalError("Network, default image or master node flavor of the cluster configuration not found.")
+    sec_groups = [{'name': f'{n}'} for n in cluster_data.security_groups]
+
+    logger.info(f"Creating temporary instance {BAKE_SERVER_NAME} to bake {image_name}...")
+    user_data = base64.b64encode(b"#cloud-config\n").decode("utf-8")
+    server = openstack_communication.create_servers(conn, [BAKE_SERVER_NAME], image, flavor, network, keypair, user_data, sec_groups)[0]
+    try:
+        server = openstack_communication.wait_for_servers(conn, [server])[0]
+        ip = openstack_communication.get_server_ip(conn, server, cluster_data)
+        if not helper_functions.check_if_ip_is_reachable(ip):
+            raise exceptions.Q8sFatalError(f"Temporary instance {ip} not reachable.")
+        logger.info("Installing QEMU, libvirt and Kubernetes... this might take some time (10+ min)")
+        with tracer.span("bake_prepare", BAKE_SERVER_NAME):
+            code = helper_functions.execute_ssh_command(ip, get_bake_command(cluster_data.git_url))
+        if code != 0:
+            raise exceptions.Q8sFatalError(f"Preparation of the temporary instance failed with exit code {code}.")
+
+        # a stopped instance gives a consistent snapshot
+        ssh_pool.get_ssh_pool().close(ip)
+        conn.compute.stop_server(server)
+        conn.compute.wait_for_server(server, status="SHUTOFF", wait=600)
+        # image names have to be unique, a forced bake replaces the existing image
+        old_image = resolver.image(image_name)
+        if old_image is not None:
+            conn.image.delete_image(old_image)
+            resolver.invalidate("image", image_name)
+        logger.info(f"Saving image {image_name}...")
+        with tracer.span("bake_snapshot", BAKE_SERVER_NAME):
+            conn.compute.create_server_image(server, image_name, metadata={"q8s_base_image": cluster_data.default_image_name}, wait=True, timeout=3600)
+    finally:
+        conn.compute.delete_server(server)
+        logger.debug(f"Temporary instance {BAKE_SERVER_NAME} deleted.")
+    logger.info(f"Host image {image_name} created.")
+    return image_name
@@ -0,0 +1,420 @@
+"""
+Author: Vincent Hasse
+License: MIT
+
+Stages of a Q8S deployment and the dependency graph connecting them.
+
+    spawn ──> wait:<node> ──> reachable:<node> ──> push:<node> ──> setup:<node>
+    init-master, image-cache ─────────────────────────┘
+    wait:<node>* ──> worker-ips ──> master-routing ──> join <── init-master
+"""
+import asyncio
+import functools
+import logging
+import os
+import subprocess
+import threading
+import time
+from pathlib import Path
+from openstack.connection import Connection
+from q8s.scripts import initialize_setups, routing_master
+from q8s.scripts.helper import exceptions, guest_image, helper_functions, image_cache, kubernetes_helper, openstack_communication, q8s_tracer, resource_bundle, setup_progress, ssh_probe
+from q8s.scripts.helper.cluster_def import ClusterData, get_node_names, parse_worker_name
+from q8s.scripts.helper.deploy_graph import DeployGraph
+from q8s.scripts.helper.deploy_state import DeployStateFile, NodeState
+
+
+logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
+
+
+class Deployment:
+    """State shared between the stages of a single deployment."""
+
+    def __init__(self, conn: Connection, cluster_data: ClusterData, cluster_data_file: Path, state_file: DeployStateFile,
+                 master_names: list[str] = None, worker_names: list[str] = None, worker_placement: dict[str, list[str]] = None):
+        self.conn = conn
+        self.cluster_data = cluster_data
+        self.cluster_data_file = cluster_data_file
+        self.state_file = state_file
+        self.master_names, self.worker_names = get_node_names(cluster_data)
+        if master_names is not None:
+            self.master_names = master_names
+        if worker_names is not None:
+            self.worker_names = worker_names
+        # worker VMs by the instance they run on, several VMs share an instance if placed by placement.plan_placement
+        self.placement = {name: [name] for name in self.worker_names}
+        if worker_placement is not None:
+            self.placement = worker_placement
+            self.worker_names = list(worker_placement)
+        self.vm_hosts = {vm: host for host, vms in self.placement.items() for vm in vms}
+        self.vm_addresses = {}
+        self.servers = {}
+        self.master_nodes = {}
+        self.worker_nodes = {}
+        self.setup_finished = {}
+        self.bundles = {}
+        self.image_cache_server = image_cache.ImageCacheServer(cluster_data.image_cache_port)
+        self.graph = None
+        self.waiter = openstack_communication.ServerWaiter(conn)
+        self.max_replacements = 2
+        self._lock = threading.Lock()
+
+    def node_stages(self, name: str) -> list[str]:
+        """Returns the names of the stages that belong to a single node."""
+        return [f"wait:{name}", f"reachable:{name}", f"push:{name}", f"setup:{name}"]
+
+    def prepare_resume(self) -> set[str]:
+        """
+        Restores servers and IPs from the state of a previous deployment. Nodes whose server no longer exists or is
+        in ERROR state are reset, so they are spawned and set up again together with all stages depending on them.
+
+        Returns:
+            set[str]: Names of the stages that do not need to run again.
+        """
+        completed = set(self.state_file.state.completed_stages)
+        for name in self.master_names + self.worker_names:
+            node = self.state_file.node(name)
+            server = None
+            if node.server_id:
+                server = self.conn.compute.find_server(node.server_id)
+            if server is None:
+                # the server might have been created right before the previous run failed
+                try:
+                    server = self.conn.compute.find_server(name)
+                except Exception as exception:
+                    logger.warning(f"Cannot look up server {name}: {exception}")
+            if server is not None and server.status == "ERROR":
+                logger.info(f"Server {name} is in ERROR state, replacing it.")
+                self.conn.compute.delete_server(server)
+                server = None
+            if server is None:
+                logger.info(f"Server {name} does not exist anymore, it will be spawned and set up again.")
+                with self.state_file.update():
+                    self.state_file.state.nodes[name] = NodeState()
+                completed -= {"spawn", "worker-ips", "master-routing", "join", *self.node_stages(name)}
+                continue
+            self.servers[name] = server
+            with self.state_file.update():
+                node.server_id = server.id
+            if node.ip and f"wait:{name}" in completed:
+                tracer.set_node_alias(node.ip, name)
+                if name in self.master_names:
+                    self.master_nodes[name] = node.ip
+                else:
+                    self.worker_nodes[name] = node.ip
+                    self.vm_addresses.update(node.vm_addresses or {name: node.ip})
+        # the image cache is only served while q8s runs, the cached images themselves are kept
+        completed.discard("image-cache")
+        with self.state_file.update() as state:
+            state.completed_stages = [s for s in state.completed_stages if s in completed]
+        return completed
+
+    def spawn(self):
+        """Creates all OpenStack instances that do not exist yet without waiting for them to become active."""
+        servers = openstack_communication.spawn_openstack_instances(self.conn, self.cluster_data, wait=False, skip_names=set(self.servers),
+                                                                    master_names=self.master_names, worker_names=self.worker_names)
+        with self.state_file.update():
+            for server in servers["master"] + servers["worker"]:
+                self.servers[server.name] = server
+                self.state_file.node(server.name).server_id = server.id
+
+    def install_initial_master(self):
+        """Installs Kubernetes on the initial instance and initializes the cluster, creating the join commands."""
+        #automatically select default option in case of conflicts with configuration files
+        with tracer.span("apt_upgrade", "initial-master"):
+            subprocess.run("sudo apt upgrade -y -o Dpkg::Options::='--force-confdef' -o Dpkg::Options::='--force-confold'", shell=True)
+        logger.info("Installing kubernetes...")
+        with tracer.span("install_k8s", "initial-master"):
+            result = subprocess.run("bash /home/cloud/Q8S/src/q8s/scripts/install-k8s.sh", capture_output=True, text=True, shell=True)
+        if result.returncode != 0:
+            logger.error(f"Could not install Kubernetes on the initializing instance. Stderr: {result.stderr}")
+            raise exceptions.Q8sFatalError(f"Could not install Kubernetes on the initializing instance. Stderr: {result.stderr}")
+        logger.info("Initializing kubernetes cluster...")
+        with tracer.span("kubeadm_init", "initial-master"):
+            result = subprocess.run("bash /home/cloud/Q8S/src/q8s/scripts/setup-kube-ctl.sh", capture_output=True, text=True, shell=True)
+        if result.returncode != 0:
+            logger.error(f"Could not initialize Kubernetes Cluster. Stderr: {result.stderr}")
+            raise exceptions.Q8sFatalError(f"Could not initialize Kubernetes Cluster. Stderr: {result.stderr}")
+
+    def start_image_cache(self):
+        """
+        Caches the cloud images of all worker architectures on the initial instance and serves them to the workers,
+        together with the Kubernetes-ready guest images built by 'q8s bake-guest' for the current install script.
+        The URL of the cache is saved for the worker bundle.
+        """
+        architectures = {self.cluster_data.vm_types.types[parse_worker_name(n)[1]].architecture for n in self.vm_hosts}
+        with tracer.span("image_cache", "initial-master"):
+            cached = image_cache.cache_images(architectures)
+            served = dict(cached)
+            for architecture in sorted(architectures):
+                name = image_cache.GUEST_IMAGES.get(architecture)
+                digest = guest_image.find_prebuilt_image(architecture, cached[name]) if name in cached else None
+                if digest is None:
+                    logger.info(f"No guest image with Kubernetes for {architecture}, its VMs install Kubernetes on first boot. Run 'q8s bake-guest' to build it.")
+                    continue
+                served[guest_image.get_prebuilt_image_name(architecture)] = digest
+            image_cache.write_checksums(served)
+        self.image_cache_server.start()
+        os.makedirs("/home/cloud/resources", exist_ok=True)
+        with open("/home/cloud/resources/image_cache.txt", "w", encoding='utf-8') as f:
+            f.write(f"http://{routing_master.get_ip()}:{self.cluster_data.image_cache_port}")
+
+    def stop_image_cache(self):
+        """Stops serving the image cache."""
+        self.image_cache_server.stop()
+
+    async def wait_for_node(self, name: str):
+        """
+        Waits until the instance of a node is active and saves its IP address. An instance going into ERROR state is
+        replaced by a new instance with the same name, at most max_replacements times. A host running several worker
+        VMs gets an additional IP for every VM but the first.
+        """
+        loop = asyncio.get_running_loop()
+        replacements = 0
+        while True:
+            try:
+                with tracer.span("wait_for_server", name):
+                    server = await self.waiter.wait(self.servers[name])
+                break
+            except exceptions.Q8sServerError as exception:
+                if replacements >= self.max_replacements:
+                    raise
+                replacements += 1
+                logger.warning(f"{exception.message}. Spawning replacement {replacements} of {self.max_replacements}.")
+                server = await loop.run_in_executor(None, openstack_communication.replace_server, self.conn, self.cluster_data, exception.server)
+                self.servers[name] = server
+                with self.state_file.update():
+                    self.state_file.node(name).server_id = server.id
+        ip = await loop.run_in_executor(None, openstack_communication.get_server_ip, self.conn, server, self.cluster_data)
+        vms = self.placement.get(name, [])
+        addresses = [ip]
+        if len(vms) > 1:
+            addresses = await loop.run_in_executor(None, openstack_communication.allocate_host_addresses, self.conn, server, self.cluster_data, len(vms))
+        with self._lock:
+            self.servers[name] = server
+            if name in self.master_names:
+                self.master_nodes[name] = ip
+            else:
+                self.worker_nodes[name] = ip
+                self.vm_addresses.update(zip(vms, addresses))
+        with self.state_file.update():
+            self.state_file.node(name).ip = ip
+            self.state_file.node(name).vm_addresses = dict(zip(vms, addresses))
+        tracer.set_node_alias(ip, name)
+        logger.debug(f"Instance {name} is active with ip {ip}.")
+
+    async def wait_until_reachable(self, name: str):
+        """Waits until the SSH daemon of a node accepts connections, its files are pushed right afterwards."""
+        ip = self.master_nodes.get(name) or self.worker_nodes.get(name)
+        with tracer.span("ssh_ready", name):
+            reachable = await ssh_probe.wait_for_ssh(ip)
+        if not reachable:
+            raise exceptions.Q8sFatalError(f"Instance {name} with ip {ip} not reachable via SSH.")
+
+    def write_node_ips(self):
+        """Saves the IPs of all worker and master instances for the master nodes."""
+        logger.debug(f"Worker: {self.worker_nodes}\nMaster: {self.master_nodes}")
+        os.makedirs("/home/cloud/resources", exist_ok=True)
+        with open("/home/cloud/resources/worker_ips.txt", "w", encoding='utf-8') as f:
+            f.write(str(self.routing_entries()))
+        with open("/home/cloud/resources/master_ips.txt", "w", encoding='utf-8') as f:
+            f.write(str(self.ordered_ips(self.master_names, self.master_nodes)))
+
+    def create_master_routing(self):
+        """Creates the routing rules on the initial instance and makes them persistent."""
+        logger.info("Creating routing rules.")
+        routing_master.create_master_routing(self.routing_entries())
+        subprocess.run("bash /home/cloud/Q8S/src/q8s/scripts/helper/make_master_routing_persistent.sh", shell=True)
+
+    def routing_entries(self) -> list[str]:
+        """
+        Returns the routing entries of all worker VMs for routing_master: the IP of the instance for a VM reached via
+        the IP of its instance, 'vm_ip=ip' for a VM reached via an additional IP of a shared host.
+        """
+        entries = []
+        for host in self.worker_names:
+            if host not in self.worker_nodes:
+                continue
+            host_ip = self.worker_nodes[host]
+            for vm in self.placement[host]:
+                address = self.vm_addresses.get(vm, host_ip)
+                entries.append(host_ip if address == host_ip else f"{routing_master.get_vm_ip(host_ip, address)}={address}")
+        return entries
+
+    def write_vm_list(self, name: str) -> str:
+        """
+        Saves the VMs of a worker instance with the IP each VM is reached with and its own IP, one VM per line.
+
+        Returns:
+            str: The path of the file.
+        """
+        host_ip = self.worker_nodes[name]
+        path = f"/home/cloud/resources/vms-{name}.txt"
+        with open(path, "w", encoding='utf-8') as f:
+            for vm in self.placement[name]:
+                address = self.vm_addresses.get(vm, host_ip)
+                f.write(f"{vm} {address} {routing_master.get_vm_ip(host_ip, address)}\n")
+        return path
+
+    def get_bundle(self, role: str, files: dict[str, str], key: str = None) -> resource_bundle.ResourceBundle:
+        """Returns the resource bundle of a node role, it is built once per key (default: the role) and sent to all nodes with the key."""
+        with self._lock:
+            key = key or role
+            if key not in self.bundles:
+                self.bundles[key] = resource_bundle.build_bundle(role, files)
+            return self.bundles[key]
+
+    def push_worker_files(self, name: str):
+        """Sends cluster info, public key, the worker join command, the image cache URL and the VMs to run to a worker instance as a single bundle."""
+        # the list of VMs differs per instance, so does the bundle
+        bundle = self.get_bundle("worker", {
+            "cluster.yaml": str(self.cluster_data_file),
+            "q8s-cluster.pub": "/home/cloud/.ssh/q8s-cluster.pub",
+            "join_command.txt": "/home/cloud/resources/join_command_worker.txt",
+            "image_cache.txt": "/home/cloud/resources/image_cache.txt",
+            "vms.txt": self.write_vm_list(name),
+        }, key=name)
+        resource_bundle.push_bundle(self.worker_nodes[name], bundle)
+        self.record_pushed_files(name, bundle)
+
+    def push_master_files(self, name: str):
+        """Sends the control-plane join command and the worker IPs to an additional master instance as a single bundle."""
+        bundle = self.get_bundle("master", {
+            "join_command.txt": "/home/cloud/resources/join_command_master.txt",
+            "worker_ips.txt": "/home/cloud/resources/worker_ips.txt",
+        })
+        resource_bundle.push_bundle(self.master_nodes[name], bundle)
+        self.record_pushed_files(name, bundle)
+
+    def record_pushed_files(self, name: str, bundle: resource_bundle.ResourceBundle):
+        """Saves the remote paths of the files sent to a node and the digest of their bundle in the deployment state."""
+        files = [f"{resource_bundle.RESOURCES_DIR}/{line.split(maxsplit=1)[1]}" for line in bundle.checksums.splitlines()]
+        with self.state_file.update():
+            self.state_file.node(name).files_pushed = files
+            self.state_file.node(name).bundle_digest = bundle.digest
+
+    def record_setup_exit_code(self, name: str, code: int):
+        """Saves the exit code of a node setup. A failed setup fails the stage so it is retried when resuming."""
+        with self.state_file.update():
+            self.state_file.node(name).setup_exit_code = code
+        if code != 0:
+            raise exceptions.Q8sFatalError(f"Setup of {name} returned exit code {code}.")
+
+    def setup_worker(self, name: str):
+        """Runs the host setup on a worker instance, the reachable stage already waited for SSH."""
+        code = initialize_setups.init_host_setup(self.cluster_data.git_url, self.worker_nodes[name], hostname=name, check_reachable=False)
+        self.record_setup_exit_code(name, code)
+        self.setup_finished[name] = time.time()
+        return code
+
+    def setup_master(self, name: str):
+        """Runs the master setup on an additional master instance and copies the kube-config to it, the reachable stage already waited for SSH."""
+        code = initialize_setups.init_master_setup(self.cluster_data.git_url, self.master_nodes[name], hostname=name, check_reachable=False)
+        self.record_setup_exit_code(name, code)
+        self.setup_finished[name] = time.time()
+        helper_functions.send_file_via_sftp([self.master_nodes[name]], "/home/cloud/.kube/config", "/home/cloud/.kube/config")
+        return code
+
+    def cluster_nodes(self) -> dict[str, str]:
+        """Returns the Kubernetes node names of all nodes and the IPs they are reached with."""
+        cluster_nodes = {}
+        for k, v in self.master_nodes.items():
+            cluster_nodes[k] = v
+        for k, v in self.worker_nodes.items():
+            for vm in self.placement.get(k, [k]):
+                cluster_nodes["vm-"+str(vm)] = self.vm_addresses.get(vm, v)
+        return cluster_nodes
+
+    def annotate_node(self, name: str):
+        """Annotates a node for Flannel communication using the IP it is reached with."""
+        ip = self.cluster_nodes()[name]
+        annotations = {
+            "flannel.alpha.coreos.com/public-ip": f"{ip}",
+            "flannel.alpha.coreos.com/public-ip-overwrite": f"{ip}"
+        }
+        result = kubernetes_helper.annotate_node(name, annotations)
+        if result:
+            logger.debug(f"Node {name} annotated with {annotations}")
+        else: logger.error(f"Node {name} could not be annotated. This will affect networking. Please annotate the node by hand with {annotations}.")
+
+    def check_pending_nodes(self, pending: set) -> set:
+        """
+        Gives up on nodes whose setup failed or was skipped, warns about nodes taking unusually long to join and shows
+        the progress of the setups that are still running.
+        """
+        given_up = set()
+        for node_name in pending:
+            vm_name = node_name.removeprefix("vm-")
+            instance_name = self.vm_hosts.get(vm_name, vm_name)
+            setup_stage = f"setup:{instance_name}"
+            if self.graph is not None and self.graph.is_unsuccessful(setup_stage):
+                given_up.add(node_name)
+            elif instance_name in self.setup_finished:
+                elapsed = (time.time() - self.setup_finished[instance_name]) / 60
+                if elapsed > 40:
+                    logger.info(f"{elapsed:.0f} minutes have passed since the setup for node {node_name} has finished and it is still missing. There may be something wrong. You can check the VM status by opening a new console, SSH to the host and run 'sudo virsh list'. It should list the VM as started. For further information you can open a console with 'sudo virsh console <vm-name>'.")
+        running = setup_progress.get_setup_progress().summary()
+        if running:
+            logger.info(f"Setups still running:\n{running}")
+        return given_up
+
+    def wait_for_join(self):
+        """Waits for all nodes to join the cluster and annotates each of them for Flannel as soon as it is ready."""
+        logger.info("Waiting for nodes to join the cluster as soon as their setup has finished... This might take some time (30min+)")
+        cluster_nodes = self.cluster_nodes()
+        started = time.time()
+        ready = kubernetes_helper.watch_nodes_ready(set(cluster_nodes.keys()), on_ready=self.annotate_node, check_pending=self.check_pending_nodes)
+
+        for node_name in sorted(ready):
+            vm_name = node_name.removeprefix("vm-")
+            since = self.setup_finished.get(self.vm_hosts.get(vm_name, vm_name), started)
+            if ready[node_name] > since:
+                tracer.add_span("vm_boot_join", since, ready[node_name], node_name.removeprefix("vm-"))
+            logger.info(f"Node {node_name} joined {max(0, ready[node_name] - since):.0f}s after its setup finished.")
+        missing_nodes = set(cluster_nodes) - set(ready)
+        if missing_nodes:
+            logger.error(f"Nodes {sorted(missing_nodes)} did not join the cluster.")
+        else:
+            logger.info("All nodes have joined the cluster.")
+        logger.debug("Restarting Flannel daemonset...")
+        result = subprocess.run("kubectl rollout restart daemonset kube-flannel-ds -n kube-flannel", capture_output=True, text=True, shell=True)
+        if result.returncode != 0:
+            logger.warning(f"Could not restart Flannel daemonset. Please check, if cluster communication works. Try restarting it by executing 'kubectl rollout restart daemonset kube-flannel-ds -n kube-flannel'.\nSdterr: {result.stderr}")
+
+    @staticmethod
+    def ordered_ips(names: list[str], nodes: dict[str, str]) -> list[str]:
+        """Returns the IPs of the given nodes in the order of their names."""
+        return [nodes[n] for n in names if n in nodes]
+
+
+def build_deploy_graph(deployment: Deployment) -> DeployGraph:
+    """
+    Creates the dependency graph of all stages of a deployment.
+
+    Args:
+        deployment (Deployment): The deployment the stages operate on.
+
+    Returns:
+        DeployGraph: The graph, ready to be run.
+    """
+    graph = DeployGraph()
+    deployment.graph = graph
+    graph.add_stage("spawn", deployment.spawn)
+    graph.add_stage("init-master", deployment.install_initial_master)
+    graph.add_stage("image-cache", deployment.start_image_cache)
+    for name in deployment.master_names + deployment.worker_names:
+        graph.add_stage(f"wait:{name}", functools.partial(deployment.wait_for_node, name), ["spawn"])
+        graph.add_stage(f"reachable:{name}", functools.partial(deployment.wait_until_reachable, name), [f"wait:{name}"])
+    graph.add_stage("worker-ips", deployment.write_node_ips,
+                    [f"wait:{n}" for n in deployment.master_names + deployment.worker_names])
+    graph.add_stage("master-routing", deployment.create_master_routing, ["worker-ips"])
+    for name in deployment.worker_names:
+        graph.add_stage(f"push:{name}", lambda n=name: deployment.push_worker_files(n), [f"reachable:{name}", "init-master", "image-cache"])
+        graph.add_stage(f"setup:{name}", lambda n=name: deployment.setup_worker(n), [f"push:{name}"])
+    for name in deployment.master_names:
+        graph.add_stage(f"push:{name}", lambda n=name: deployment.push_master_files(n), [f"reachable:{name}", "init-master", "worker-ips"])
+        graph.add_stage(f"setup:{name}", lambda n=name: deployment.setup_master(n), [f"push:{name}"])
+    # nodes are followed from the moment the cluster exists, each one is annotated as soon as it is ready
+    graph.add_stage("join", deployment.wait_for_join, ["init-master", "master-routing"])
+    return graph
@@ -16,6 +16,7 @@ class ClusterDefinition(yaml.YAMLObject):
     number_additional_master_nodes: int = 1
     master_node_flavor: str = "c1.small"
     worker: dict = field(default_factory=lambda:{"arm_mid" : 1, "x86_small" : 1})
+    worker_host_flavor: str = ""
     yaml_tag = "!ClusterDefinition"
     yaml_loader = yaml.SafeLoader
 
@@ -30,6 +31,7 @@ class VmType(yaml.YAMLObject):
     ram: int = 2048
     storage: int = 10
     openstack_flavor: str = "c1.medium"
+    emulation_overhead: float = 0.0
     yaml_tag = "!VmType"
     yaml_loader = yaml.SafeLoader
 
@@ -55,6 +57,7 @@ class ClusterData(yaml.YAMLObject):
     required_udp_ports: list[int] = field(default_factory=lambda:[])
     worker_port_range_min: int = 30000
     worker_port_range_max: int = 32767
+    image_cache_port: int = 8008
     cluster_definition: ClusterDefinition = field(default_factory=ClusterDefinition)
     vm_types: list = field(default_factory=lambda:[])
     yaml_tag = "!ClusterData"
@@ -107,7 +110,6 @@ def get_worker_name(number: int, cluster_data: ClusterData) -> str:
         IndexError: If the requested worker number exceeds the total number of workers defined in the cluster.
 
     """
-    name = f"worker-{number}-"
     worker = cluster_data.cluster_definition.worker
     n = 0
     add = ""
@@ -118,5 +120,77 @@ def get_worker_name(number: int, cluster_data: ClusterData) -> str:
             break
     if add == "":
         raise IndexError(f"Requested worker number is too high. Only {n} workers defined - asked for name for worker number {number}")
-    name = name + add
-    return name
\ No newline at end of file
+    return format_worker_name(number, add)
+
+
+def format_worker_name(number: int, vm_type: str) -> str:
+    """
+    Formats the name of a worker node.
+
+    Args:
+        number (int): The worker node number.
+        vm_type (str): The name of the VmType of the worker.
+
+    Returns:
+        str: The worker node name in the format 'worker-{number}-{VmType}'.
+    """
+    return f"worker-{number}-{vm_type}"
+
+
+def parse_worker_name(name: str) -> tuple[int, str]:
+    """
+    Splits the name of a worker node into its number and VmType.
+
+    Args:
+        name (str): A worker node name in the format 'worker-{number}-{VmType}'.
+
+    Returns:
+        tuple[int, str]: The worker number and the name of the VmType, or None if the name is no worker node name.
+    """
+    parts = name.split("-", maxsplit=2)
+    if len(parts) != 3 or parts[0] != "worker" or not parts[1].isdigit():
+        return None
+    return int(parts[1]), parts[2]
+
+def format_host_name(number: int) -> str:
+    """
+    Formats the name of a host running several worker VMs.
+
+    Args:
+        number (int): The host number.
+
+    Returns:
+        str: The host name in the format 'host-{number}'.
+    """
+    return f"host-{number}"
+
+
+def parse_host_name(name: str) -> int:
+    """
+    Returns the number of a host running several worker VMs.
+
+    Args:
+        name (str): A host name in the format 'host-{number}'.
+
+    Returns:
+        int: The host number, or None if the name is no host name.
+    """
+    parts = name.split("-", maxsplit=1)
+    if len(parts) != 2 or parts[0] != "host" or not parts[1].isdigit():
+        return None
+    return int(parts[1])
+
+def get_node_names(cluster_data: ClusterData) -> tuple[list[str], list[str]]:
+    """
+    Returns the names of all OpenStack instances that are spawned for the given cluster configuration.
+
+    Args:
+        cluster_data (ClusterData): The object containing the cluster's configuration data.
+
+    Returns:
+        tuple[list[str], list[str]]: The names of the additional master nodes and the names of the worker nodes.
+    """
+    master_names = [f"master-{i+1}" for i in range(int(cluster_data.cluster_definition.number_additional_master_nodes))]
+    total_workers = sum(int(n) for n in cluster_data.cluster_definition.worker.values())
+    worker_names = [get_worker_name(i+1, cluster_data) for i in range(total_workers)]
+    return master_names, worker_names
@@ -0,0 +1,232 @@
+"""
+License: MIT
+
+Dependency graph of named deployment stages. Every stage starts as soon as all stages it depends on have
+finished successfully, so independent stages (e.g. spawning OpenStack instances and installing Kubernetes on the
+initial instance) run concurrently.
+
+The stages are executed by an asyncio event loop. Coroutine functions run directly on the loop, blocking functions
+(SSH, OpenStack and Kubernetes API calls) run on a thread pool bounded by the concurrency limit, so hundreds of nodes
+need neither hundreds of processes nor hundreds of threads.
+"""
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import logging
+import time
+import traceback
+from typing import Any, Callable
+from q8s.scripts.helper import exceptions, q8s_tracer
+
+
+logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
+
+
+@dataclass
+class Stage:
+    """A named unit of work of a deployment and the names of the stages it depends on."""
+
+    name: str
+    action: Callable[[], Any]
+    depends_on: list[str] = field(default_factory=list)
+
+    @property
+    def node(self) -> str:
+        """The node a stage belongs to, e.g. "worker-1-x86-small" for "push:worker-1-x86-small", empty for cluster wide stages."""
+        return self.name.split(":", maxsplit=1)[1] if ":" in self.name else ""
+
+
+@dataclass
+class StageResult:
+    """Outcome of a single stage."""
+
+    name: str
+    node: str = ""
+    status: str = "pending"
+    value: Any = None
+    error: Exception = None
+    started: float = None
+    finished: float = None
+
+    @property
+    def duration(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class DeployGraph:
+    """Collects stages and executes them in dependency order, running independent stages in parallel."""
+
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+    COMPLETED_BEFORE = "completed before"
+
+    def __init__(self):
+        self.stages: dict[str, Stage] = {}
+        self.results: dict[str, StageResult] = {}
+
+    def add_stage(self, name: str, action: Callable[[], Any], depends_on: list[str] = None) -> Stage:
+        """
+        Adds a stage to the graph.
+
+        Args:
+            name (str): Unique name of the stage, e.g. "push:worker-1-x86-small".
+            action (Callable[[], Any]): Function executed for the stage. Its return value is stored in results.
+                Coroutine functions (also wrapped in functools.partial) run on the event loop, others on the thread pool.
+            depends_on (list[str]): Names of the stages that have to finish successfully before this stage starts.
+
+        Returns:
+            Stage: The added stage.
+
+        Raises:
+            ValueError: If a stage with the same name already exists.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage {name} is defined twice.")
+        stage = Stage(name, action, list(depends_on or []))
+        self.stages[name] = stage
+        return stage
+
+    def validate(self):
+        """
+        Checks that all dependencies exist and that the graph contains no cycles.
+
+        Raises:
+            ValueError: If a dependency is unknown or the stages depend on each other in a cycle.
+        """
+        for stage in self.stages.values():
+            for dep in stage.depends_on:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}.")
+        visited = set()
+        in_progress = set()
+
+        def visit(name: str):
+            if name in in_progress:
+                raise ValueError(f"Stage {name} is part of a dependency cycle.")
+            if name in visited:
+                return
+            in_progress.add(name)
+            for dep in self.stages[name].depends_on:
+                visit(dep)
+            in_progress.remove(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def is_unsuccessful(self, name: str) -> bool:
+        """
+        Checks if a stage failed or was skipped. Safe to call from stages running in other threads.
+
+        Args:
+            name (str): Name of the stage.
+
+        Returns:
+            bool: True if the stage failed or was skipped, False if it succeeded or has not finished yet.
+        """
+        result = self.results.get(name)
+        return result is not None and result.status in (self.FAILED, self.SKIPPED)
+
+    def failed(self) -> dict[str, StageResult]:
+        """Returns the results of all failed stages."""
+        return {name: r for name, r in list(self.results.items()) if r.status == self.FAILED}
+
+    def run(self, max_concurrency: int = 32, completed: set[str] = None, on_stage_completed: Callable[[str], None] = None) -> dict[str, StageResult]:
+        """
+        Executes all stages. A stage is started the moment its last dependency finishes. If a stage fails, all
+        stages depending on it (directly or transitively) are skipped while unrelated stages keep running.
+
+        Args:
+            max_concurrency (int): Maximum number of stages running at the same time.
+            completed (set[str]): Names of stages that already finished in a previous run. They are not executed again.
+            on_stage_completed (Callable[[str], None]): Called with the name of every stage that finished successfully.
+
+        Returns:
+            dict[str, StageResult]: The results of all stages by stage name.
+
+        Raises:
+            Q8sFatalError: If at least one stage failed, after all runnable stages have finished.
+        """
+        self.validate()
+        asyncio.run(self._run_all(max_concurrency, completed or set(), on_stage_completed))
+        logger.info(f"Results per node:\n{self.summary()}")
+
+        failed = self.failed()
+        if failed:
+            skipped = sorted(name for name, r in self.results.items() if r.status == self.SKIPPED)
+            errors = "; ".join(f"{name}: {r.error}" for name, r in failed.items())
+            raise exceptions.Q8sFatalError(
+                f"Deployment stages failed: {errors}. Skipped stages: {', '.join(skipped) or 'none'}."
+            )
+        return self.results
+
+    async def _run_all(self, max_concurrency: int, completed: set[str], on_stage_completed: Callable[[str], None]):
+        """Runs every stage as a task that waits for the events of its dependencies."""
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="q8s-stage")
+        loop.set_default_executor(executor)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        finished = {name: asyncio.Event() for name in self.stages}
+
+        async def execute(stage: Stage):
+            for dep in stage.depends_on:
+                await finished[dep].wait()
+            result = StageResult(stage.name, stage.node)
+            if any(self.is_unsuccessful(dep) for dep in stage.depends_on):
+                logger.debug(f"Skipping stage {stage.name}, a dependency failed.")
+                result.status = self.SKIPPED
+            else:
+                # coroutine stages mostly wait (e.g. for servers to become active) and do not take a slot
+                is_coroutine = asyncio.iscoroutinefunction(stage.action)
+                async with contextlib.nullcontext() if is_coroutine else semaphore:
+                    logger.debug(f"Starting stage {stage.name}.")
+                    result.started = time.time()
+                    try:
+                        with tracer.span(stage.name, stage.node, "stage", depends_on=stage.depends_on):
+                            if is_coroutine:
+                                result.value = await stage.action()
+                            else:
+                                result.value = await loop.run_in_executor(None, stage.action)
+                        result.status = self.SUCCEEDED
+                        logger.debug(f"Stage {stage.name} finished.")
+                    except Exception as exception:
+                        logger.error(f"Stage {stage.name} failed: {exception}")
+                        logger.debug("".join(traceback.format_exception(exception)))
+                        result.status = self.FAILED
+                        result.error = exception
+                    result.finished = time.time()
+            self.results[stage.name] = result
+            if result.status == self.SUCCEEDED and on_stage_completed is not None:
+                on_stage_completed(stage.name)
+            finished[stage.name].set()
+
+        tasks = []
+        for name, stage in self.stages.items():
+            if name in completed:
+                logger.debug(f"Stage {name} already completed, skipping it.")
+                self.results[name] = StageResult(name, stage.node, self.COMPLETED_BEFORE)
+                finished[name].set()
+            else:
+                tasks.append(execute(stage))
+        await asyncio.gather(*tasks)
+
+    def summary(self) -> str:
+        """
+        Creates a table of the results of all stages, grouped by node.
+
+        Returns:
+            str: The formatted table.
+        """
+        dash = "-" * 96
+        output = "{:<28s}{:<32s}{:<18s}{:>10s}  {:s}".format("Node", "Stage", "Status", "Time [s]", "Error") + "\n"
+        output = output + dash + "\n"
+        for result in sorted(self.results.values(), key=lambda r: (r.node, r.started or 0)):
+            output = output + "{:<28s}{:<32s}{:<18s}{:>10.1f}  {:s}".format(
+                result.node or "-", result.name, result.status, result.duration, str(result.error or "")
+            ) + "\n"
+        return output
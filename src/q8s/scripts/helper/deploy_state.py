@@ -0,0 +1,162 @@
+"""
+License: MIT
+
+Persistent state of a deployment, written after every finished stage so that a failed deployment can be resumed
+with 'q8s deploy --resume' instead of spawning a new set of servers.
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import hashlib
+import logging
+import os
+from pathlib import Path
+import threading
+import yaml
+from q8s.scripts.helper import exceptions
+
+
+logger = logging.getLogger("logger")
+
+DEFAULT_STATE_FILE = Path("q8s-state.yaml")
+
+
+@dataclass
+class NodeState(yaml.YAMLObject):
+    """Dataclass for the state of a single OpenStack instance of the cluster that can be parsed in YAML."""
+
+    server_id: str = ""
+    ip: str = ""
+    files_pushed: list[str] = field(default_factory=lambda:[])
+    bundle_digest: str = ""
+    vm_addresses: dict = field(default_factory=lambda:{})
+    setup_exit_code: int = None
+    yaml_tag = "!NodeState"
+    yaml_loader = yaml.SafeLoader
+    yaml_dumper = yaml.SafeDumper
+
+
+@dataclass
+class DeployState(yaml.YAMLObject):
+    """Dataclass for the state of a deployment that can be parsed in YAML."""
+
+    cluster_data_file: str = ""
+    cluster_data_digest: str = ""
+    completed_stages: list[str] = field(default_factory=lambda:[])
+    nodes: dict = field(default_factory=lambda:{})
+    yaml_tag = "!DeployState"
+    yaml_loader = yaml.SafeLoader
+    yaml_dumper = yaml.SafeDumper
+
+
+class DeployStateFile:
+    """Thread-safe access to a DeployState that is saved to disk on every change."""
+
+    def __init__(self, path: Path, state: DeployState):
+        self.path = path
+        self.state = state
+        self._lock = threading.RLock()
+
+    def node(self, name: str) -> NodeState:
+        """
+        Returns the state of a node, creating an empty one if the node is not known yet.
+
+        Args:
+            name (str): Name of the OpenStack instance.
+
+        Returns:
+            NodeState: The state of the node.
+        """
+        with self._lock:
+            if name not in self.state.nodes:
+                self.state.nodes[name] = NodeState()
+            return self.state.nodes[name]
+
+    @contextmanager
+    def update(self):
+        """Context manager that locks the state for modification and saves it afterwards."""
+        with self._lock:
+            yield self.state
+            self.save()
+
+    def mark_stage_completed(self, stage: str):
+        """Records a finished stage so it is skipped when resuming."""
+        with self.update() as state:
+            if stage not in state.completed_stages:
+                state.completed_stages.append(stage)
+
+    def save(self):
+        """Writes the state atomically, a crash during writing never leaves a truncated state file."""
+        with self._lock:
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                yaml.safe_dump(self.state, f)
+            os.replace(tmp_path, self.path)
+
+
+def get_server_ids(state: DeployState) -> list[str]:
+    """Returns the IDs of all servers recorded in a state."""
+    return [node.server_id for node in state.nodes.values() if node.server_id]
+
+
+def get_cluster_data_digest(cluster_data_file: Path) -> str:
+    """Returns the SHA-256 digest of a cluster definition file, identifying the cluster a state belongs to."""
+    return hashlib.sha256(Path(cluster_data_file).read_bytes()).hexdigest()
+
+
+def create_deploy_state(cluster_data_file: Path) -> DeployState:
+    """Creates the empty state of a new deployment of the given cluster definition file."""
+    return DeployState(cluster_data_file=str(cluster_data_file), cluster_data_digest=get_cluster_data_digest(cluster_data_file))
+
+
+def check_cluster_data_file(state: DeployState, cluster_data_file: Path):
+    """
+    Checks that a loaded state belongs to the given cluster definition file. The digest of the file is compared, the
+    path only for states written without a digest.
+
+    Args:
+        state (DeployState): The state of a previous deployment.
+        cluster_data_file (Path): The cluster definition file of the current command.
+
+    Raises:
+        Q8sFatalError: If the state was written for another or a changed cluster definition file.
+    """
+    if state.cluster_data_digest:
+        if state.cluster_data_digest != get_cluster_data_digest(cluster_data_file):
+            raise exceptions.Q8sFatalError(f"The deployment state belongs to {state.cluster_data_file} which differs from {cluster_data_file}, cannot resume with a changed cluster definition.")
+    elif Path(state.cluster_data_file).resolve() != Path(cluster_data_file).resolve():
+        raise exceptions.Q8sFatalError(f"The deployment state belongs to {state.cluster_data_file}, not to {cluster_data_file}, cannot resume.")
+
+
+def load_deploy_state(path: Path, required: bool = False) -> DeployState:
+    """
+    Loads the state of a previous deployment.
+
+    Args:
+        path (Path): The file path to the state file.
+        required (bool): Whether the state must exist, e.g. for 'q8s deploy --resume'.
+
+    Returns:
+        DeployState: The loaded state or, unless required, an empty state if the file does not exist or cannot be parsed.
+
+    Raises:
+        Q8sFatalError: If the state is required and the file does not exist or cannot be parsed.
+    """
+    if not path.is_file():
+        if required:
+            raise exceptions.Q8sFatalError(f"No deployment state found at {path}, cannot resume. Pass --state-file or deploy without --resume.")
+        logger.info(f"No deployment state found at {path}, starting from scratch.")
+        return DeployState()
+    with open(path, "r", encoding="utf-8") as file:
+        try:
+            state = yaml.safe_load(file)
+        except yaml.YAMLError as exception:
+            if required:
+                raise exceptions.Q8sFatalError(f"Parsing of deployment state file {path} failed with error: {exception}")
+            logger.error(f"Parsing of deployment state file {path} failed with error: {exception}")
+            return DeployState()
+    if not isinstance(state, DeployState):
+        if required:
+            raise exceptions.Q8sFatalError(f"Could not parse {path} as deployment state, cannot resume.")
+        logger.error(f"Could not parse {path} as deployment state, starting from scratch.")
+        return DeployState()
+    return state
@@ -7,4 +7,9 @@ class Q8sFatalError(Exception):
     def __init__(self, message):
         self.message = "Critical error:" + message
         super().__init__(self.message)
-        logger.warning(self.message)
\ No newline at end of file
+        logger.warning(self.message)
+class Q8sServerError(Q8sFatalError):
+    """An OpenStack instance went into ERROR state, it can be replaced by a new instance"""
+    def __init__(self, message, server=None):
+        self.server = server
+        super().__init__(message)
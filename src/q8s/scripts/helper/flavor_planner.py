@@ -0,0 +1,285 @@
+"""
+License: MIT
+
+Quota-aware selection of the OpenStack flavors of the emulation hosts. For every VmType with an empty
+openstack_flavor the cheapest flavor that can run the emulated VM is chosen, so that the whole cluster fits into the
+quota of the project. The cost of a flavor is the share of the quota it uses, summed over cores, RAM and disk.
+"""
+from dataclasses import dataclass, field
+import itertools
+import logging
+import math
+import openstack
+from q8s.scripts.helper import exceptions, openstack_communication, openstack_resolver
+from q8s.scripts.helper.cluster_def import ClusterData, VmType
+
+
+logger = logging.getLogger("logger")
+
+# resources used by the host itself next to the emulated VM
+HOST_RAM_MB = 1024
+HOST_DISK_GB = 10
+# used if a VmType does not set emulation_overhead, emulating a foreign architecture needs more host CPU
+DEFAULT_EMULATION_OVERHEAD = {"x86_64": 1.0, "arm_64": 1.5}
+# number of cheapest fitting flavors per VmType considered when searching an assignment that fits the quota
+MAX_CANDIDATES = 5
+# above this number of assignments the search is greedy with local improvement instead of exhaustive
+MAX_COMBINATIONS = 10000
+
+
+@dataclass
+class HostRequirements:
+    """Minimal resources of a host flavor to emulate a single VM of a VmType."""
+
+    vcpus: int
+    ram: int
+    disk: int
+
+
+@dataclass
+class FlavorPlan:
+    """Flavor per VmType and the projected usage of the project quota."""
+
+    flavors: dict[str, str] = field(default_factory=dict)
+    planned: set[str] = field(default_factory=set)
+    requirements: dict[str, HostRequirements] = field(default_factory=dict)
+    used_now: dict[str, int] = field(default_factory=dict)
+    used_after: dict[str, int] = field(default_factory=dict)
+    limits: dict[str, int] = field(default_factory=dict)
+    fits: bool = True
+
+
+def get_host_requirements(vm_type: VmType) -> HostRequirements:
+    """
+    Computes the resources a host needs to emulate a VM of the given VmType.
+
+    Args:
+        vm_type (VmType): The VmType to emulate.
+
+    Returns:
+        HostRequirements: vCPUs and RAM of the VM scaled by the emulation overhead plus the host's own RAM and disk.
+    """
+    overhead = vm_type.emulation_overhead or DEFAULT_EMULATION_OVERHEAD.get(vm_type.architecture, 1.0)
+    return HostRequirements(
+        vcpus=math.ceil(int(vm_type.num_cpus) * overhead),
+        ram=math.ceil(int(vm_type.ram) * overhead) + HOST_RAM_MB,
+        disk=int(vm_type.storage) + HOST_DISK_GB,
+    )
+
+
+def flavor_cost(flavor, limits: dict[str, int]) -> float:
+    """
+    Returns the share of the quota a single instance of a flavor uses, summed over cores, RAM and disk.
+    Unlimited resources (negative limits) do not add to the cost.
+    """
+    cost = 0.0
+    for usage, limit in ((flavor.vcpus, limits["cores"]), (flavor.ram, limits["ram"]), (flavor.disk, limits["disk"])):
+        if limit is not None and limit > 0:
+            cost += usage / limit
+    return cost
+
+
+def fits_quota(used: dict[str, int], limits: dict[str, int]) -> bool:
+    """Checks that no resource is used beyond its limit, negative limits are unlimited."""
+    return all(limits[key] < 0 or used[key] <= limits[key] for key in limits)
+
+
+def quota_overuse(used: dict[str, int], limits: dict[str, int]) -> float:
+    """Returns the share by which the usage exceeds the quota, summed over all limited resources."""
+    return sum(max(0, used[key] - limit) / limit for key, limit in limits.items() if limit is not None and limit > 0)
+
+
+def get_assignment_usage(fixed: dict[str, int], candidates: dict[str, tuple[int, list]], assignment: dict,
+                         limits: dict[str, int]) -> tuple[dict[str, int], float]:
+    """
+    Returns the quota usage and the total cost of an assignment of flavors.
+
+    Args:
+        fixed (dict[str, int]): Usage independent of the assignment.
+        candidates (dict[str, tuple[int, list]]): Number of instances and candidate flavors per VmType.
+        assignment (dict): The flavor per VmType.
+        limits (dict[str, int]): The quota limits.
+
+    Returns:
+        tuple[dict[str, int], float]: The usage and the cost.
+    """
+    used = dict(fixed)
+    cost = 0.0
+    for type_name, flavor in assignment.items():
+        count = candidates[type_name][0]
+        used["instances"] += count
+        used["cores"] += count * flavor.vcpus
+        used["ram"] += count * flavor.ram
+        used["disk"] += count * flavor.disk
+        cost += count * flavor_cost(flavor, limits)
+    return used, cost
+
+
+def search_assignment(candidates: dict[str, tuple[int, list]], fixed: dict[str, int], limits: dict[str, int]) -> tuple[bool, float, dict, dict[str, int]]:
+    """
+    Searches the cheapest assignment of a flavor to every VmType that fits the quota. An assignment that fits always
+    beats one that does not, the cheapest one is reported if none fits. Up to MAX_COMBINATIONS assignments all of them
+    are compared, above that the search starts with the cheapest flavor of every VmType and changes the flavor of one
+    VmType at a time as long as that reduces the excess over the quota or, once it fits, the cost.
+
+    Args:
+        candidates (dict[str, tuple[int, list]]): Number of instances and candidate flavors, cheapest first, per VmType.
+        fixed (dict[str, int]): Usage independent of the assignment, i.e. current usage, masters and fixed flavors.
+        limits (dict[str, int]): The quota limits, negative limits are unlimited.
+
+    Returns:
+        tuple[bool, float, dict, dict[str, int]]: Whether the assignment fits, its cost, the flavor per VmType and
+            the projected usage.
+    """
+    type_names = list(candidates)
+
+    def evaluate(assignment: dict):
+        used, cost = get_assignment_usage(fixed, candidates, assignment, limits)
+        fits = fits_quota(used, limits)
+        return (fits, -quota_overuse(used, limits), -cost), (fits, cost, assignment, used)
+
+    if math.prod(len(candidates[t][1]) for t in type_names) <= MAX_COMBINATIONS:
+        # without planned VmTypes the product contains a single empty assignment
+        best = None
+        for flavors in itertools.product(*(candidates[t][1] for t in type_names)):
+            key, result = evaluate(dict(zip(type_names, flavors)))
+            if best is None or (key[0], key[2]) > (best[0][0], best[0][2]):
+                best = (key, result)
+        return best[1]
+
+    best = evaluate({t: candidates[t][1][0] for t in type_names})
+    improved = True
+    while improved:
+        improved = False
+        for type_name in type_names:
+            for flavor in candidates[type_name][1]:
+                if flavor is best[1][2][type_name]:
+                    continue
+                option = evaluate({**best[1][2], type_name: flavor})
+                if option[0] > best[0]:
+                    best = option
+                    improved = True
+    return best[1]
+
+
+def plan_flavors(conn: openstack.connection.Connection, cluster_data: ClusterData) -> FlavorPlan:
+    """
+    Chooses the flavor of every VmType with an empty openstack_flavor. Among the cheapest fitting flavors of every
+    planned VmType the assignment with the lowest total cost that fits the quota is taken (see search_assignment). VmTypes with a hand-picked
+    flavor and the master nodes keep their flavors but count against the quota.
+
+    Args:
+        conn (openstack.connection.Connection): Valid openstack connection.
+        cluster_data (ClusterData): The cluster configuration.
+
+    Returns:
+        FlavorPlan: The chosen flavors and the projected quota usage. fits is False if no assignment fits the quota.
+
+    Raises:
+        Q8sFatalError: If a VmType is not defined or no flavor is large enough for a planned VmType.
+    """
+    cluster_def = cluster_data.cluster_definition
+    compute_limits = openstack_communication.get_openstack_compute_limits(conn)
+    volume_limits = openstack_communication.get_openstack_volume_limits(conn)
+    plan = FlavorPlan()
+    plan.limits = {
+        "instances": compute_limits["max_instances"],
+        "cores": compute_limits["max_cores"],
+        "ram": compute_limits["max_ram"],
+        "disk": volume_limits["max_size"],
+    }
+    plan.used_now = {
+        "instances": compute_limits["used_instances"],
+        "cores": compute_limits["used_cores"],
+        "ram": compute_limits["used_ram"],
+        "disk": volume_limits["used_size"],
+    }
+
+    flavors = {flavor.name: flavor for flavor in conn.compute.flavors(details=True) if not getattr(flavor, "is_disabled", False)}
+    resolver = openstack_resolver.get_resolver(conn)
+
+    def by_name(name: str):
+        # private flavors are not always listed but can be looked up by name
+        return flavors.get(name) or resolver.flavor(name)
+
+    # resources used by the master nodes and the hand-picked flavors
+    fixed = dict(plan.used_now)
+    fixed_nodes = [(cluster_def.master_node_flavor, int(cluster_def.number_additional_master_nodes))]
+    candidates = {}
+    for type_name, count in cluster_def.worker.items():
+        if type_name not in cluster_data.vm_types.types:
+            raise exceptions.Q8sFatalError(f"VmType {type_name} is not defined in vm_types.")
+        vm_type = cluster_data.vm_types.types[type_name]
+        requirements = get_host_requirements(vm_type)
+        plan.requirements[type_name] = requirements
+        if vm_type.openstack_flavor:
+            plan.flavors[type_name] = vm_type.openstack_flavor
+            fixed_nodes.append((vm_type.openstack_flavor, int(count)))
+            flavor = by_name(vm_type.openstack_flavor)
+            if flavor is not None and (flavor.vcpus < requirements.vcpus or flavor.ram < requirements.ram):
+                logger.warning(f"Flavor {flavor.name} of VmType {type_name} is smaller than the recommended {requirements.vcpus} vCPUs and {requirements.ram} MB RAM.")
+            continue
+        fitting = [f for f in flavors.values() if f.vcpus >= requirements.vcpus and f.ram >= requirements.ram and f.disk >= requirements.disk]
+        if not fitting:
+            raise exceptions.Q8sFatalError(f"No flavor has the {requirements.vcpus} vCPUs, {requirements.ram} MB RAM and {requirements.disk} GB disk required by VmType {type_name}.")
+        fitting.sort(key=lambda f: (flavor_cost(f, plan.limits), f.vcpus, f.ram, f.disk, f.name))
+        candidates[type_name] = (int(count), fitting[:MAX_CANDIDATES])
+        plan.planned.add(type_name)
+
+    for flavor_name, count in fixed_nodes:
+        flavor = by_name(flavor_name)
+        if flavor is None:
+            raise exceptions.Q8sFatalError(f"Flavor {flavor_name} does not exist.")
+        fixed["instances"] += count
+        fixed["cores"] += count * flavor.vcpus
+        fixed["ram"] += count * flavor.ram
+        fixed["disk"] += count * flavor.disk
+
+    plan.fits, _, assignment, plan.used_after = search_assignment(candidates, fixed, plan.limits)
+    for type_name, flavor in assignment.items():
+        plan.flavors[type_name] = flavor.name
+    return plan
+
+
+def apply_flavor_plan(cluster_data: ClusterData, plan: FlavorPlan):
+    """
+    Sets the planned flavors in the cluster configuration, so the hosts are spawned with them.
+
+    Args:
+        cluster_data (ClusterData): The cluster configuration to change.
+        plan (FlavorPlan): The plan created by plan_flavors.
+    """
+    for type_name in plan.planned:
+        cluster_data.vm_types.types[type_name].openstack_flavor = plan.flavors[type_name]
+
+
+def format_flavor_plan(plan: FlavorPlan) -> str:
+    """
+    Creates a table of the flavor of every VmType followed by the projected quota usage and headroom.
+
+    Args:
+        plan (FlavorPlan): The plan created by plan_flavors.
+
+    Returns:
+        str: The formatted plan.
+    """
+    dash = "-" * 72
+    output = "{:<20s}{:>8s}{:>8s}{:>10s}  {:<16s}{:<10s}".format("VmType", "vCPUs", "RAM", "Disk", "Flavor", "Source") + "\n"
+    output = output + dash + "\n"
+    for type_name, flavor in sorted(plan.flavors.items()):
+        requirements = plan.requirements[type_name]
+        output = output + "{:<20s}{:>8d}{:>8d}{:>10d}  {:<16s}{:<10s}".format(
+            type_name, requirements.vcpus, requirements.ram, requirements.disk, flavor,
+            "planned" if type_name in plan.planned else "fixed"
+        ) + "\n"
+    output = output + "\n" + "{:<12s}{:>12s}{:>12s}{:>12s}{:>12s}".format("Resource", "Used Now", "Used After", "Max", "Headroom") + "\n"
+    output = output + "-" * 60 + "\n"
+    for key, label in (("instances", "Instances"), ("cores", "VCPUs"), ("ram", "RAM"), ("disk", "Volume size")):
+        limit = plan.limits[key]
+        headroom = "unlimited" if limit < 0 else str(limit - plan.used_after[key])
+        output = output + "{:<12s}{:>12d}{:>12d}{:>12s}{:>12s}".format(
+            label, plan.used_now[key], plan.used_after[key], "unlimited" if limit < 0 else str(limit), headroom
+        ) + "\n"
+    if not plan.fits:
+        output = output + "\nThe cluster does not fit into the quota of the project.\n"
+    return output
@@ -0,0 +1,274 @@
+"""
+License: MIT
+
+Kubernetes-ready guest images. 'q8s bake-guest' runs install_kubernetes.sh once per architecture on top of the cached
+Ubuntu cloud image and saves the result in the image cache of the initial instance, served to the workers as
+'q8s-k8s-<cloud image name>'. VMs booting from it only get their hostname, SSH key and join command from cloud-init
+instead of installing containerd and Kubernetes under emulation. A build is identified by the hash of the install
+script, the Kubernetes version and the digest of the cloud image, so changing one of them requires baking again.
+
+The image is customized offline with virt-customize if the architecture matches the initial instance, otherwise it is
+built once in an emulated VM.
+
+    master: build_guest_image(architecture, base_image, base_digest)
+    worker: fetch_prebuilt_image(architecture, cache_url)
+"""
+import hashlib
+import logging
+import os
+from pathlib import Path
+import platform
+import re
+import shutil
+import subprocess
+import tempfile
+import urllib.error
+from q8s.scripts.helper import exceptions, image_cache
+
+
+logger = logging.getLogger("logger")
+
+INSTALL_SCRIPT = Path(__file__).resolve().parents[2] / "resources" / "install_kubernetes.sh"
+KUBERNETES_VERSION = re.compile(r'^KUBERNETES_VERSION="?([^"\s]+)"?', re.MULTILINE)
+# space added to the cloud image for the packages, the disk of a VM is sized from the virtual size of its image
+BUILD_DISK_GB = 4
+BUILD_TIMEOUT = 4 * 3600
+READY_MARKER = "Q8S-GUEST-IMAGE-READY"
+HOST_ARCHITECTURES = {"x86_64": "x86_64", "aarch64": "arm_64"}
+
+
+def get_kubernetes_version(script: Path = INSTALL_SCRIPT) -> str:
+    """
+    Returns the Kubernetes version installed by the install script.
+
+    Raises:
+        Q8sFatalError: If the script does not set KUBERNETES_VERSION.
+    """
+    match = KUBERNETES_VERSION.search(script.read_text(encoding="utf-8"))
+    if match is None:
+        raise exceptions.Q8sFatalError(f"{script} does not set KUBERNETES_VERSION.")
+    return match.group(1)
+
+
+def get_build_hash(base_digest: str, script: Path = INSTALL_SCRIPT) -> str:
+    """
+    Returns the hash identifying a guest image build.
+
+    Args:
+        base_digest (str): SHA256 digest of the cloud image the build starts from.
+        script (Path): The install script run in the image.
+
+    Returns:
+        str: The first 12 hex digits of the SHA256 of script, Kubernetes version and base digest.
+    """
+    digest = hashlib.sha256(script.read_bytes())
+    digest.update(get_kubernetes_version(script).encode("utf-8"))
+    digest.update(base_digest.encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+def get_prebuilt_image_name(architecture: str) -> str:
+    """Returns the name under which the Kubernetes-ready image of an architecture is listed in the image cache."""
+    return f"q8s-k8s-{image_cache.get_image_name(architecture)}"
+
+
+def find_prebuilt_image(architecture: str, base_digest: str, cache_dir: str = image_cache.CACHE_DIR) -> str:
+    """
+    Looks up the Kubernetes-ready image built from a cloud image with the current install script.
+
+    Args:
+        architecture (str): Architecture of the VM type.
+        base_digest (str): SHA256 digest of the cached cloud image.
+        cache_dir (str): The image cache directory.
+
+    Returns:
+        str: The SHA256 digest of the prebuilt image, None if it was not built.
+    """
+    record = Path(cache_dir) / f"q8s-k8s-{architecture}-{get_build_hash(base_digest)}.sha256"
+    if not record.is_file():
+        return None
+    digest = record.read_text(encoding="utf-8").strip()
+    if not (Path(cache_dir) / f"{digest}.img").is_file():
+        return None
+    return digest
+
+
+def require_tools(*tools: str):
+    """
+    Raises:
+        Q8sFatalError: If one of the tools is not installed.
+    """
+    missing = [tool for tool in tools if shutil.which(tool) is None]
+    if missing:
+        raise exceptions.Q8sFatalError(f"Building guest images requires {', '.join(missing)}, install qemu-utils, qemu-system-x86, "
+                                       "qemu-system-arm, qemu-efi-aarch64, cloud-image-utils and libguestfs-tools.")
+
+
+def build_guest_image(architecture: str, base_image: Path, base_digest: str, cache_dir: str = image_cache.CACHE_DIR, force: bool = False) -> str:
+    """
+    Builds the Kubernetes-ready image of an architecture unless it exists for the current build hash.
+
+    Args:
+        architecture (str): Architecture of the VM type.
+        base_image (Path): The cached cloud image, it is not modified.
+        base_digest (str): SHA256 digest of the cloud image.
+        cache_dir (str): The image cache directory, the image is saved as '<sha256>.img'.
+        force (bool): Build the image even if it exists.
+
+    Returns:
+        str: The SHA256 digest of the image.
+
+    Raises:
+        Q8sFatalError: If the image cannot be built.
+    """
+    build_hash = get_build_hash(base_digest)
+    digest = find_prebuilt_image(architecture, base_digest, cache_dir)
+    if digest is not None and not force:
+        logger.info(f"Guest image for {architecture} ({build_hash}) already exists, the install script did not change.")
+        return digest
+
+    require_tools("qemu-img")
+    with tempfile.TemporaryDirectory(dir=cache_dir, prefix="q8s-build-") as work_dir:
+        disk = Path(work_dir) / "build.qcow2"
+        for command in (["qemu-img", "create", "-f", "qcow2", "-F", "qcow2", "-b", str(base_image), str(disk)],
+                        ["qemu-img", "resize", str(disk), f"+{BUILD_DISK_GB}G"]):
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise exceptions.Q8sFatalError(f"Cannot create build disk: {result.stderr}")
+        native = HOST_ARCHITECTURES.get(platform.machine()) == architecture
+        if native and shutil.which("virt-customize") is not None:
+            logger.info(f"Customizing guest image for {architecture} ({build_hash}) with virt-customize...")
+            customize_image(disk)
+        else:
+            logger.info(f"Building guest image for {architecture} ({build_hash}) in an emulated VM, this takes a while...")
+            emulate_build(architecture, disk, Path(work_dir), Path(cache_dir) / f"q8s-k8s-{architecture}-build.log", native)
+
+        # flatten the overlay, so the image does not depend on the cloud image any more
+        flat = Path(work_dir) / "flat.qcow2"
+        result = subprocess.run(["qemu-img", "convert", "-c", "-O", "qcow2", str(disk), str(flat)], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise exceptions.Q8sFatalError(f"Cannot convert guest image: {result.stderr}")
+        digest = image_cache.sha256_file(flat)
+        flat.replace(Path(cache_dir) / f"{digest}.img")
+    with open(Path(cache_dir) / f"q8s-k8s-{architecture}-{build_hash}.sha256", "w", encoding="utf-8") as f:
+        f.write(digest + "\n")
+    logger.info(f"Guest image for {architecture} ({build_hash}) saved as {digest[:12]}, Kubernetes {get_kubernetes_version()}.")
+    return digest
+
+
+def customize_image(disk: Path):
+    """
+    Installs Kubernetes into a disk image of the architecture of this machine offline, with virt-customize.
+
+    Raises:
+        Q8sFatalError: If virt-customize fails.
+    """
+    result = subprocess.run([
+        "virt-customize", "-a", str(disk),
+        # the root file system of the cloud image is grown into the space added for the build
+        "--run-command", "growpart /dev/sda 1 && resize2fs /dev/sda1",
+        "--run", str(INSTALL_SCRIPT),
+        "--run-command", "kubeadm version",
+        "--run-command", "cloud-init clean --logs",
+        "--truncate", "/etc/machine-id",
+    ], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise exceptions.Q8sFatalError(f"virt-customize failed: {result.stderr[-2000:]}")
+
+
+def get_build_user_data() -> str:
+    """
+    Creates the cloud-config of the build VM, which runs the install script, resets cloud-init, prints the ready
+    marker on the console if Kubernetes is installed and powers off.
+    """
+    script = "".join(f"        {line}\n" for line in INSTALL_SCRIPT.read_text(encoding="utf-8").splitlines())
+    return (
+        "#cloud-config\n"
+        "write_files:\n"
+        "    - path: /run/scripts/install_kubernetes.sh\n"
+        "      permissions: '0755'\n"
+        "      content: |\n"
+        f"{script}"
+        "runcmd:\n"
+        "    - [\"bash\", \"/run/scripts/install_kubernetes.sh\"]\n"
+        f"    - [\"sh\", \"-c\", \"kubeadm version && cloud-init clean --logs && truncate -s 0 /etc/machine-id && sync && echo {READY_MARKER} > /dev/console\"]\n"
+        "    - [\"poweroff\"]\n"
+    )
+
+
+def emulate_build(architecture: str, disk: Path, work_dir: Path, log: Path, native: bool, timeout: float = BUILD_TIMEOUT):
+    """
+    Boots a disk image in a QEMU VM with a cloud-init seed that installs Kubernetes and waits until it powers off.
+
+    Args:
+        architecture (str): Architecture of the image.
+        disk (Path): The disk image, modified in place.
+        work_dir (Path): Directory for the seed.
+        log (Path): File the console output of the VM is written to.
+        native (bool): True if the architecture matches this machine, KVM is used if available.
+        timeout (float): Seconds after which the build is given up.
+
+    Raises:
+        Q8sFatalError: If the VM does not finish in time or Kubernetes was not installed.
+    """
+    if architecture == "x86_64":
+        command = ["qemu-system-x86_64", "-machine", "q35"]
+    elif architecture == "arm_64":
+        command = ["qemu-system-aarch64", "-machine", "virt", "-bios", "/usr/share/qemu-efi-aarch64/QEMU_EFI.fd"]
+    else:
+        raise exceptions.Q8sFatalError(f"Unsupported architecture {architecture}")
+    require_tools(command[0], "cloud-localds")
+
+    (work_dir / "user-data").write_text(get_build_user_data(), encoding="utf-8")
+    (work_dir / "meta-data").write_text("instance-id: q8s-guest-build\nlocal-hostname: q8s-guest-build\n", encoding="utf-8")
+    seed = work_dir / "seed.img"
+    result = subprocess.run(["cloud-localds", str(seed), str(work_dir / "user-data"), str(work_dir / "meta-data")], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise exceptions.Q8sFatalError(f"Cannot create seed of the build VM: {result.stderr}")
+
+    accelerator = "kvm" if native and os.access("/dev/kvm", os.W_OK) else "tcg"
+    command += [
+        "-accel", accelerator, "-cpu", "max", "-smp", str(min(4, os.cpu_count() or 1)), "-m", "4096",
+        "-drive", f"file={disk},if=virtio,format=qcow2",
+        "-drive", f"file={seed},if=virtio,format=raw",
+        "-nic", "user,model=virtio-net-pci",
+        "-nographic", "-no-reboot",
+    ]
+    logger.debug(f"Build VM: {' '.join(command)}, console log in {log}")
+    with open(log, "w", encoding="utf-8", errors="replace") as f:
+        try:
+            subprocess.run(command, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise exceptions.Q8sFatalError(f"Build VM for {architecture} did not finish within {timeout // 60:.0f} minutes, see {log}.")
+    if READY_MARKER not in log.read_text(encoding="utf-8", errors="replace"):
+        raise exceptions.Q8sFatalError(f"Kubernetes could not be installed in the guest image for {architecture}, see {log}.")
+
+
+def fetch_prebuilt_image(architecture: str, cache_url: str, cache_dir: str = image_cache.CACHE_DIR) -> Path:
+    """
+    Returns the Kubernetes-ready image of an architecture from the local cache, downloading it from the image cache
+    of the master if it lists one.
+
+    Args:
+        architecture (str): Architecture of the VM type.
+        cache_url (str): URL of the image cache of the master.
+        cache_dir (str): The local cache directory.
+
+    Returns:
+        Path: Path of the cached image named by its SHA256 digest, None if the master has no prebuilt image.
+    """
+    try:
+        digest = image_cache.fetch_checksums(cache_url).get(get_prebuilt_image_name(architecture))
+    except (urllib.error.URLError, OSError) as exception:
+        logger.warning(f"Image cache {cache_url} not available: {exception}")
+        return None
+    if not digest:
+        return None
+    path = Path(cache_dir) / f"{digest}.img"
+    if path.is_file():
+        return path
+    try:
+        return image_cache.download(f"{cache_url}/sha256/{digest}", path, digest)
+    except exceptions.Q8sFatalError as exception:
+        logger.warning(f"{exception} Using the cloud image instead.")
+        return None
@@ -4,70 +4,39 @@ Licence: MIT
 
 Helper functions for Q8S.
 """
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
-import os
 from pathlib import Path
 import socket
 import time
 import paramiko
 from kubernetes import client, config
-from q8s.scripts.helper import exceptions
+from q8s.scripts.helper import exceptions, q8s_tracer, setup_progress, ssh_pool, ssh_probe
 from q8s.scripts.helper.cluster_def import ClusterDefinition
 
 
 logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
 
-def check_if_ip_is_reachable(ip: str, port: int = 80, retries: int=40) -> bool:
+@tracer.traced("reachability", "ip")
+def check_if_ip_is_reachable(ip: str, port: int = ssh_probe.SSH_PORT, timeout: float = 600) -> bool:
     """
-    Checks if a given IP is reachable over a specified port, retrying a given number of times.
+    Checks if the SSH daemon of a given IP accepts connections, probing with backoff until the timeout passed.
 
     Args:
         ip (str): The IP address to check.
-        port (int): The port to check reachability on (default is 80).
-        retries (int): The number of retry attempts (default is 40).
+        port (int): The SSH port to probe (default is 22).
+        timeout (float): Seconds after which the host is given up (default is 600).
 
     Returns:
         bool: True if the IP is reachable, False otherwise.
     """
-    reachable = False
-    for i in range(retries):
-        logger.debug(f"Waiting for reachability of host {ip}, {i}th retry.")
-        if isReachable(ip, port):
-            reachable = True
-            break
-        else:
-            time.sleep(10)
-    return reachable
-
-
-
-def isReachable(ip, port) -> bool:
-    """
-    Checks if a given IP and port are reachable using a ping command.
-
-    Args:
-        ip (str): The IP address to ping.
-        port (int): The port to check reachability on.
+    return asyncio.run(ssh_probe.wait_for_ssh(ip, port, timeout))
 
-    Returns:
-        bool: True if the server is reachable, False if not.
-        
-    Raises:
-        Q8sFatalError: If the system cannot execute OS commands.
-    """
-    try:
-        code = os.system(f"ping -c 1 -W 3 {ip} -p {port} >/dev/null 2>&1")
-        if code == 0:
-            logger.debug(f"Server with ip {ip} is reachable.")
-            return True
-        else: return False
-    except Exception as e:
-        print(f"Cannot execute python os.system commands. Aborting...")
-        logger.error(f"Cannot execute python os.system commands. Aborting...")
-        raise exceptions.Q8sFatalError(f"Cannot execute python os.system commands. Aborting...")
-    
 
 
+@tracer.traced("ssh_connect", "ip")
 def get_ssh_client(ip: str, key_filepath: str=str(Path.home()) + ("/.ssh/q8s-cluster")) -> paramiko.SSHClient:
     """
     Establishes an SSH connection to a given IP address using a private key.
@@ -117,32 +86,142 @@ def get_ssh_client(ip: str, key_filepath: str=str(Path.home()) + ("/.ssh/q8s-clu
 
 
 
-def send_file_via_sftp(ips: list[str], filepath: str, destination_path: str, key_filepath: str=str(Path.home()) + ("/.ssh/q8s-cluster")):
+def execute_ssh_command(ip: str, command: str, key_filepath: str=str(Path.home()) + ("/.ssh/q8s-cluster")) -> int:
+    """
+    Executes a command on a remote host via SSH and waits for it to finish. The pooled connection of the host is used.
+
+    Args:
+        ip (str): The IP address of the host.
+        command (str): The command to execute.
+        key_filepath (str): The path to the SSH private key file (default is ~/.ssh/q8s-cluster).
+
+    Returns:
+        int: The exit code of the command.
+
+    Raises:
+        Q8sFatalError: If the SSH connection fails.
+    """
+    with ssh_pool.get_ssh_pool().client(ip, key_filepath) as client:
+        _, stdout, stderr = client.exec_command(command)
+        code = stdout.channel.recv_exit_status()
+        if code != 0:
+            logger.debug(f"Command '{command}' on host {ip} exited with code {code}: {stderr.read().decode(errors='replace')}")
+    return code
+
+
+
+def stream_ssh_command(ip: str, command: str, label: str, role: str, inactivity_timeout: float = 1200,
+                       key_filepath: str=str(Path.home()) + ("/.ssh/q8s-cluster")) -> int:
+    """
+    Executes a long running command on a remote host and streams its combined stdout and stderr into the log while
+    it runs, each line prefixed with the host and its current step. Step markers update the setup progress.
+
+    Args:
+        ip (str): The IP address of the host.
+        command (str): The command to execute.
+        label (str): Name of the host used in the log, e.g. the instance name.
+        role (str): Role of the host shown in the progress, e.g. "host" or "master".
+        inactivity_timeout (float): Seconds without any output after which the host is considered stuck.
+        key_filepath (str): The path to the SSH private key file (default is ~/.ssh/q8s-cluster).
+
+    Returns:
+        int: The exit code of the command.
+
+    Raises:
+        Q8sFatalError: If the SSH connection fails or the command did not print anything for inactivity_timeout seconds.
     """
-    Sends a file to multiple IP addresses via SFTP.
+    progress = setup_progress.get_setup_progress()
+    progress.start(label, role)
+    with ssh_pool.get_ssh_pool().client(ip, key_filepath) as client:
+        channel = client.get_transport().open_session()
+        try:
+            channel.set_combine_stderr(True)
+            # recv returns at least every second, so a silent host is noticed without blocking on it
+            channel.settimeout(1.0)
+            channel.exec_command(command)
+            buffer = b""
+            last_output = time.monotonic()
+            while True:
+                try:
+                    data = channel.recv(32768)
+                except socket.timeout:
+                    if time.monotonic() - last_output > inactivity_timeout:
+                        logger.error(f"[{label}|{progress.step(label)}] No output for {inactivity_timeout:.0f}s, the setup seems to be stuck.")
+                        raise exceptions.Q8sFatalError(f"Setup of {label} stuck in step '{progress.step(label)}', no output for {inactivity_timeout:.0f}s.")
+                    continue
+                if not data:
+                    break
+                last_output = time.monotonic()
+                *lines, buffer = (buffer + data).split(b"\n")
+                for line in lines:
+                    log_remote_line(label, line)
+            if buffer:
+                log_remote_line(label, buffer)
+            code = channel.recv_exit_status()
+        finally:
+            channel.close()
+            progress.finish(label)
+    return code
+
+
+def log_remote_line(label: str, line: bytes):
+    """Logs a line of remote output prefixed with the host and its current step and passes it to the setup progress."""
+    progress = setup_progress.get_setup_progress()
+    # progress bars of apt and pip redraw the line with carriage returns, only the last state is kept
+    text = line.decode("utf-8", errors="replace").rstrip("\r").rsplit("\r", maxsplit=1)[-1]
+    logger.debug(f"[{label}|{progress.step(label)}] {text}")
+    progress.output(label, text)
+
+
+
+def send_file_via_sftp(ips: list[str], filepath: str, destination_path: str, key_filepath: str=str(Path.home()) + ("/.ssh/q8s-cluster"),
+                       parallelism: int = 16, raise_on_error: bool = True) -> dict[str, Exception]:
+    """
+    Sends a file to multiple IP addresses via SFTP, to up to parallelism hosts at the same time, using the pooled
+    connection of every host. A failing host does not stop the transfer to the other hosts.
 
     Args:
         ips (list[str]): A list of IP addresses to send the file to.
         filepath (str): The local path to the file to be sent.
         destination_path (str): The remote destination path where the file should be placed.
         key_filepath (str): The path to the SSH private key file (default is ~/.ssh/q8s-cluster).
-    
+        parallelism (int): Maximum number of hosts the file is sent to at the same time.
+        raise_on_error (bool): Whether to raise after all transfers finished if the file could not be sent to a host.
+
+    Returns:
+        dict[str, Exception]: The error of every host, None for hosts that received the file.
+
     Raises:
-        Q8sFatalError: If SSH connection to any IP fails.
+        Q8sFatalError: If raise_on_error is set and the file could not be sent to at least one host.
     """
-    for ip in ips:
-        ssh_client = get_ssh_client(ip, key_filepath)
-        if ssh_client == None:
-            raise exceptions.Q8sFatalError(f"Host {ip} cannot be reached via SSH to send join command.")
-        
-        sftp_client = paramiko.SFTPClient.from_transport(ssh_client.get_transport())
+    def send(ip: str):
+        with ssh_pool.get_ssh_pool().sftp(ip, key_filepath) as sftp_client:
+            with tracer.span("sftp_put", ip, file=destination_path):
+                try:
+                    sftp_client.chdir(destination_path.rsplit("/", maxsplit=1)[0])
+                except IOError:
+                    sftp_client.mkdir(destination_path.rsplit("/", maxsplit=1)[0])
+
+                sftp_client.put(filepath, destination_path)
+        logger.debug(f"File {filepath} sent to instance {ip}.")
 
+    results = {}
+    if len(ips) == 1:
+        # a single host is the common case of the per node stages, no thread needed
         try:
-            sftp_client.chdir(destination_path.rsplit("/", maxsplit=1)[0])
-        except IOError:
-            sftp_client.mkdir(destination_path.rsplit("/", maxsplit=1)[0])
-            
-        sftp_client.put(filepath, destination_path)
-        logger.debug(f"File {filepath} sent to instance {ip}.")
-        sftp_client.close()
-        ssh_client.close()
\ No newline at end of file
+            send(ips[0])
+            results[ips[0]] = None
+        except Exception as exception:
+            results[ips[0]] = exception
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(ips))), thread_name_prefix="q8s-sftp") as executor:
+            futures = {executor.submit(send, ip): ip for ip in ips}
+            for future in as_completed(futures):
+                results[futures[future]] = future.exception()
+
+    failed = {ip: error for ip, error in results.items() if error is not None}
+    for ip, error in failed.items():
+        logger.error(f"Could not send {filepath} to instance {ip}: {error}")
+    if failed and raise_on_error:
+        raise exceptions.Q8sFatalError(f"File {filepath} could not be sent to {sorted(failed)}.")
+    return results
@@ -0,0 +1,304 @@
+"""
+License: MIT
+
+Cluster-local cache of the Ubuntu cloud images the emulated VMs boot from. The initial master downloads the image of
+every required architecture once, verifies it against the upstream SHA256SUMS and serves it over HTTP (with range
+requests, so interrupted transfers are resumed). Worker hosts fetch the image from the master, falling back to
+upstream, and keep it in a content-addressed cache named by its SHA256 digest.
+
+    master: cache_images(...) ──> ImageCacheServer(...).start()
+    worker: fetch_guest_image(architecture, cache_url)
+"""
+import hashlib
+import http.server
+import logging
+from pathlib import Path
+import re
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+from q8s.scripts.helper import exceptions
+
+
+logger = logging.getLogger("logger")
+
+GUEST_IMAGE_BASE_URL = "https://cloud-images.ubuntu.com/jammy/current"
+GUEST_IMAGES = {"x86_64": "jammy-server-cloudimg-amd64.img", "arm_64": "jammy-server-cloudimg-arm64.img"}
+CACHE_DIR = "/home/cloud/image-cache"
+CHUNK_SIZE = 1024 * 1024
+DIGEST_PATH = re.compile(r"^/sha256/([0-9a-f]{64})$")
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def get_image_name(architecture: str) -> str:
+    """
+    Returns the file name of the cloud image of an architecture.
+
+    Raises:
+        Q8sFatalError: If the architecture is unsupported.
+    """
+    if architecture not in GUEST_IMAGES:
+        raise exceptions.Q8sFatalError(f"Unsupported architecture {architecture}")
+    return GUEST_IMAGES[architecture]
+
+
+def parse_checksums(text: str) -> dict[str, str]:
+    """Parses a SHA256SUMS file into the digests by file name."""
+    checksums = {}
+    for line in text.splitlines():
+        parts = line.split(maxsplit=1)
+        if len(parts) == 2:
+            checksums[parts[1].lstrip("*").strip()] = parts[0].lower()
+    return checksums
+
+
+def fetch_checksums(base_url: str, timeout: float = 30) -> dict[str, str]:
+    """
+    Downloads and parses the SHA256SUMS file of an image directory.
+
+    Args:
+        base_url (str): URL of the directory containing SHA256SUMS.
+        timeout (float): Seconds to wait for the server.
+
+    Returns:
+        dict[str, str]: The digests by file name.
+    """
+    with urllib.request.urlopen(f"{base_url}/SHA256SUMS", timeout=timeout) as response:
+        return parse_checksums(response.read().decode("utf-8"))
+
+
+def sha256_file(path: Path) -> str:
+    """Returns the SHA256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download(url: str, destination: Path, expected_sha256: str, retries: int = 5, timeout: float = 60) -> Path:
+    """
+    Downloads a file and verifies its digest. The data is written to '<destination>.part' first, an interrupted
+    download continues with a range request where it stopped. The file is only moved to destination once verified.
+
+    Args:
+        url (str): URL of the file.
+        destination (Path): Path of the verified file.
+        expected_sha256 (str): The SHA256 digest the file must have.
+        retries (int): Number of attempts.
+        timeout (float): Seconds to wait for the server before an attempt fails.
+
+    Returns:
+        Path: The destination.
+
+    Raises:
+        Q8sFatalError: If the file could not be downloaded or verified within the given number of attempts.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    part = destination.with_name(destination.name + ".part")
+    for attempt in range(retries):
+        offset = part.stat().st_size if part.exists() else 0
+        request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                # a server without range support sends the whole file again
+                with open(part, "ab" if offset and response.status == 206 else "wb") as f:
+                    shutil.copyfileobj(response, f, CHUNK_SIZE)
+        except urllib.error.HTTPError as exception:
+            # 416: the partial file is already complete
+            if exception.code != 416:
+                logger.warning(f"Download of {url} failed with HTTP {exception.code}, attempt {attempt + 1} of {retries}.")
+                time.sleep(min(30, 2 ** attempt))
+                continue
+        except (urllib.error.URLError, OSError) as exception:
+            logger.warning(f"Download of {url} interrupted ({exception}), attempt {attempt + 1} of {retries}.")
+            time.sleep(min(30, 2 ** attempt))
+            continue
+        digest = sha256_file(part)
+        if digest == expected_sha256:
+            part.replace(destination)
+            return destination
+        logger.warning(f"Checksum of {url} is {digest}, expected {expected_sha256}. Downloading again.")
+        part.unlink()
+    raise exceptions.Q8sFatalError(f"Could not download {url} with checksum {expected_sha256}.")
+
+
+def cache_images(architectures: set[str], cache_dir: str = CACHE_DIR, base_url: str = GUEST_IMAGE_BASE_URL) -> dict[str, str]:
+    """
+    Downloads the cloud images of the given architectures into the cache unless an image with the current upstream
+    digest is cached already, and writes the SHA256SUMS of the cached images served to the workers.
+
+    Args:
+        architectures (set[str]): Architectures of the VM types of the cluster.
+        cache_dir (str): The cache directory, images are saved as '<sha256>.img'.
+        base_url (str): URL of the upstream image directory.
+
+    Returns:
+        dict[str, str]: The digests of the cached images by file name.
+
+    Raises:
+        Q8sFatalError: If an image is not listed upstream or cannot be downloaded.
+    """
+    upstream = fetch_checksums(base_url)
+    cached = {}
+    for architecture in sorted(architectures):
+        if architecture not in GUEST_IMAGES:
+            logger.warning(f"No cloud image for architecture {architecture}, it is not cached.")
+            continue
+        name = GUEST_IMAGES[architecture]
+        if name not in upstream:
+            raise exceptions.Q8sFatalError(f"Image {name} is not listed in {base_url}/SHA256SUMS.")
+        path = Path(cache_dir) / f"{upstream[name]}.img"
+        if path.is_file():
+            logger.debug(f"Image {name} ({upstream[name][:12]}) is cached already.")
+        else:
+            logger.info(f"Downloading image {name} into the cluster image cache...")
+            download(f"{base_url}/{name}", path, upstream[name])
+        cached[name] = upstream[name]
+    write_checksums(cached, cache_dir)
+    return cached
+
+
+def write_checksums(images: dict[str, str], cache_dir: str = CACHE_DIR):
+    """
+    Writes the SHA256SUMS of the images served to the workers.
+
+    Args:
+        images (dict[str, str]): The digests of the cached images by the name they are served with.
+        cache_dir (str): The cache directory.
+    """
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    with open(Path(cache_dir) / "SHA256SUMS", "w", encoding="utf-8") as f:
+        f.write("".join(f"{digest} *{name}\n" for name, digest in sorted(images.items())))
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves '/SHA256SUMS' and the cached images as '/sha256/<digest>', supporting single byte range requests."""
+
+    def do_HEAD(self):
+        self.send_cached_file(head=True)
+
+    def do_GET(self):
+        self.send_cached_file(head=False)
+
+    def send_cached_file(self, head: bool):
+        cache_dir = Path(self.server.cache_dir)
+        match = DIGEST_PATH.match(self.path)
+        if self.path == "/SHA256SUMS":
+            path = cache_dir / "SHA256SUMS"
+        elif match:
+            path = cache_dir / f"{match.group(1)}.img"
+        else:
+            path = None
+        if path is None or not path.is_file():
+            self.send_error(404)
+            return
+
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        range_match = RANGE_HEADER.match(self.headers.get("Range", ""))
+        if range_match and (range_match.group(1) or range_match.group(2)):
+            if range_match.group(1):
+                start = int(range_match.group(1))
+                end = min(int(range_match.group(2)), size - 1) if range_match.group(2) else size - 1
+            else:
+                # suffix range: the last n bytes
+                start = max(0, size - int(range_match.group(2)))
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if head:
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Image cache: {self.address_string()} {format % args}")
+
+
+class ImageCacheServer:
+    """HTTP server serving the image cache to the worker hosts from a background thread."""
+
+    def __init__(self, port: int, cache_dir: str = CACHE_DIR):
+        self.port = port
+        self.cache_dir = cache_dir
+        self._server = None
+
+    def start(self):
+        """Starts serving, does nothing if the server is running already."""
+        if self._server is not None:
+            return
+        self._server = http.server.ThreadingHTTPServer(("", self.port), RangeRequestHandler)
+        self._server.daemon_threads = True
+        self._server.cache_dir = self.cache_dir
+        threading.Thread(target=self._server.serve_forever, name="q8s-image-cache", daemon=True).start()
+        logger.debug(f"Image cache served on port {self.port}.")
+
+    def stop(self):
+        """Stops serving."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def fetch_guest_image(architecture: str, cache_url: str = None, cache_dir: str = CACHE_DIR) -> Path:
+    """
+    Returns the verified cloud image of an architecture from the local content-addressed cache, downloading it from
+    the image cache of the master or, if that fails, from upstream.
+
+    Args:
+        architecture (str): Architecture of the VM type.
+        cache_url (str): URL of the image cache of the master, e.g. "http://10.254.1.10:8008", None to use upstream.
+        cache_dir (str): The local cache directory.
+
+    Returns:
+        Path: Path of the cached image, named by its SHA256 digest.
+
+    Raises:
+        Q8sFatalError: If the architecture is unsupported or the image cannot be downloaded.
+    """
+    name = get_image_name(architecture)
+    sources = []
+    digest = None
+    if cache_url:
+        try:
+            digest = fetch_checksums(cache_url).get(name)
+        except (urllib.error.URLError, OSError) as exception:
+            logger.warning(f"Image cache {cache_url} not available: {exception}")
+        if digest:
+            sources.append(f"{cache_url}/sha256/{digest}")
+    if not digest:
+        digest = fetch_checksums(GUEST_IMAGE_BASE_URL).get(name)
+        if not digest:
+            raise exceptions.Q8sFatalError(f"Image {name} is not listed in {GUEST_IMAGE_BASE_URL}/SHA256SUMS.")
+    sources.append(f"{GUEST_IMAGE_BASE_URL}/{name}")
+
+    path = Path(cache_dir) / f"{digest}.img"
+    if path.is_file():
+        return path
+    for url in sources:
+        try:
+            return download(url, path, digest)
+        except exceptions.Q8sFatalError as exception:
+            logger.warning(f"{exception} Trying the next source.")
+    raise exceptions.Q8sFatalError(f"Could not download image {name} from {sources}.")
@@ -2,7 +2,109 @@
 Author: Vincent Hasse
 Licence: MIT
 """
-from kubernetes import config, client
+import functools
+import logging
+import time
+from typing import Callable
+from kubernetes import config, client, watch
+
+
+logger = logging.getLogger("logger")
+
+
+@functools.lru_cache(maxsize=None)
+def get_core_api() -> client.CoreV1Api:
+    """
+    Loads the kube-config once and returns a shared CoreV1Api client.
+
+    Returns:
+        client.CoreV1Api: The API client for the cluster configured in the kube-config.
+    """
+    config.load_kube_config()
+    return client.CoreV1Api()
+
+
+def is_node_ready(node: client.V1Node) -> bool:
+    """
+    Checks if the 'Ready' condition of a node is 'True'.
+
+    Args:
+        node (client.V1Node): The node as returned by the Kubernetes API.
+
+    Returns:
+        bool: True if the node is in 'Ready' state, False otherwise.
+    """
+    conditions = node.status.conditions if node.status else None
+    ready_condition = next((cond for cond in conditions or [] if cond.type == "Ready"), None)
+    return ready_condition is not None and ready_condition.status == "True"
+
+
+def watch_nodes_ready(expected_nodes: set, on_ready: Callable[[str], None] = None, check_pending: Callable[[set], set] = None, interval: int = 60) -> dict[str, float]:
+    """
+    Watches the nodes of the cluster until all expected nodes have registered and are in 'Ready' state. Instead of
+    listing all nodes periodically, the nodes are listed once and then followed with the watch API, so every node is
+    handled the moment it turns 'Ready'.
+
+    Args:
+        expected_nodes (set): A set of node names that are expected to join the cluster.
+        on_ready (Callable[[str], None]): Called with the name of each expected node as soon as it is 'Ready'.
+        check_pending (Callable[[set], set]): Called with the names of the pending nodes every `interval` seconds.
+            Returns the names of nodes that should not be waited for any longer.
+        interval (int): Maximum time in seconds a single watch request stays open.
+
+    Returns:
+        dict[str, float]: The time (as returned by time.time()) at which each expected node was seen 'Ready'. Nodes
+            given up by check_pending are missing.
+    """
+    api_client = get_core_api()
+    pending = set(expected_nodes)
+    registered = set()
+    ready = {}
+
+    def handle(node: client.V1Node):
+        name = node.metadata.name
+        if name not in pending:
+            return
+        if name not in registered:
+            registered.add(name)
+            logger.info(f"Node {name} registered in the cluster.")
+        if is_node_ready(node):
+            pending.discard(name)
+            ready[name] = time.time()
+            logger.info(f"Node {name} is ready. {len(pending)} nodes pending.")
+            if on_ready is not None:
+                on_ready(name)
+
+    resource_version = None
+    while pending:
+        if resource_version is None:
+            node_list = api_client.list_node()
+            for node in node_list.items:
+                handle(node)
+            resource_version = node_list.metadata.resource_version
+        node_watch = watch.Watch()
+        try:
+            for event in node_watch.stream(api_client.list_node, resource_version=resource_version, timeout_seconds=interval):
+                node = event["object"]
+                resource_version = node.metadata.resource_version
+                if event["type"] in ("ADDED", "MODIFIED"):
+                    handle(node)
+                if not pending:
+                    node_watch.stop()
+                    break
+        except client.ApiException as e:
+            if e.status != 410:
+                raise
+            # resource version too old, start over with a fresh list
+            logger.debug("Node watch expired, listing nodes again.")
+            resource_version = None
+        if pending and check_pending is not None:
+            given_up = check_pending(set(pending))
+            if given_up:
+                logger.warning(f"No longer waiting for nodes {sorted(given_up)} to join the cluster.")
+                pending -= given_up
+    return ready
+
 
 def check_joined_nodes(expected_nodes: set):
     """
@@ -17,8 +119,7 @@ def check_joined_nodes(expected_nodes: set):
             - list[str]: A list of missing node names (nodes that have not joined).
             - list[str]: A list of node names that are not in the 'Ready' state.
     """
-    config.load_kube_config()
-    api_client = client.CoreV1Api()
+    api_client = get_core_api()
     nodes = api_client.list_node().items
     #extract node names
     curr_nodes = set(node.metadata.name for node in nodes)
@@ -52,8 +153,7 @@ def annotate_node(node_name: str, annotations: dict) -> bool:
     Returns:
         bool: True if the annotations were successfully applied, False if there was an error.
     """
-    config.load_kube_config()
-    api_client = client.CoreV1Api()
+    api_client = get_core_api()
     # patch with new annotations
     body = {
         "metadata": {
@@ -63,5 +163,23 @@ def annotate_node(node_name: str, annotations: dict) -> bool:
     try:
         result = api_client.patch_node(node_name, body)
         return True
-    except client.ApiException.ApiException as e:
-        return False
\ No newline at end of file
+    except client.ApiException as e:
+        return False
+
+
+def delete_node(node_name: str) -> bool:
+    """
+    Deletes a node from the Kubernetes cluster.
+
+    Args:
+        node_name (str): The name of the node to delete.
+
+    Returns:
+        bool: True if the node was deleted or does not exist, False if there was an error.
+    """
+    api_client = get_core_api()
+    try:
+        api_client.delete_node(node_name)
+        return True
+    except client.ApiException as e:
+        return e.status == 404
@@ -0,0 +1,195 @@
+"""
+License: MIT
+
+Instrumentation of the OpenStack API. Every HTTP request of a connection is recorded with method, service, resource,
+status, latency and retries, so the report at the end of a deployment shows which calls are frequent or slow.
+Should be used as
+
+    "api_stats = openstack_api_stats.get_api_stats()"
+"""
+from dataclasses import asdict, dataclass
+import json
+import logging
+from pathlib import Path
+import re
+import threading
+import time
+from urllib.parse import urlparse
+from openstack.connection import Connection
+
+
+logger = logging.getLogger("logger")
+
+# path segments that identify a single resource, replaced by {id} so calls on different servers are grouped
+ID_SEGMENT = re.compile(r"^([0-9a-fA-F-]{16,}|\d+|req-[0-9a-fA-F-]+)$")
+
+
+@dataclass
+class ApiCall:
+    """A single request to the OpenStack API."""
+
+    method: str
+    service: str
+    resource: str
+    status: int
+    latency: float
+    retries: int
+    started: float
+
+
+def normalize_resource(url: str) -> str:
+    """
+    Converts the URL of a request into the resource it addresses, e.g. "/servers/{id}/action".
+
+    Args:
+        url (str): Absolute or relative URL of the request.
+
+    Returns:
+        str: The path with ids replaced by {id}, without query.
+    """
+    path = urlparse(url).path
+    return "/" + "/".join("{id}" if ID_SEGMENT.match(segment) else segment for segment in path.split("/") if segment)
+
+
+def get_service(url: str, kwargs: dict) -> str:
+    """Returns the service type a request is sent to, e.g. "compute", or the host for absolute URLs."""
+    endpoint_filter = kwargs.get("endpoint_filter") or {}
+    service = endpoint_filter.get("service_type") or kwargs.get("service_type")
+    if service:
+        return service
+    return urlparse(url).hostname or "unknown"
+
+
+class ApiStats:
+    """Thread-safe collector of API calls."""
+
+    def __init__(self):
+        self.calls: list[ApiCall] = []
+        self._lock = threading.Lock()
+
+    def record(self, method: str, service: str, resource: str, status: int, latency: float, retries: int = 0, started: float = None):
+        """
+        Records a finished request.
+
+        Args:
+            method (str): HTTP method.
+            service (str): Service type, e.g. "compute" or "network".
+            resource (str): Normalized path, see normalize_resource.
+            status (int): HTTP status, 0 if no response was received.
+            latency (float): Time in seconds including all retries.
+            retries (int): Number of times the request was repeated.
+            started (float): Start time as returned by time.time().
+        """
+        with self._lock:
+            self.calls.append(ApiCall(method.upper(), service, resource, status, latency, retries, started or time.time() - latency))
+
+    def instrument(self, conn: Connection):
+        """
+        Wraps the request method of the session of a connection, so all proxies (compute, network, image, ...)
+        and the authentication are recorded. Instrumenting a connection twice has no effect. Retries made by
+        openstack_retry are counted if it was installed before.
+
+        Args:
+            conn (Connection): The OpenStack connection to instrument.
+        """
+        session = conn.session
+        if getattr(session, "_q8s_instrumented", False):
+            return
+        request = session.request
+
+        def instrumented_request(url, method, *args, **kwargs):
+            started = time.time()
+            status = 0
+            retries = 0
+            try:
+                response = request(url, method, *args, **kwargs)
+                status = response.status_code
+                retries = getattr(response, "q8s_retries", 0)
+                return response
+            except Exception as exception:
+                status = getattr(exception, "http_status", None) or getattr(getattr(exception, "response", None), "status_code", 0) or 0
+                retries = getattr(exception, "q8s_retries", 0)
+                raise
+            finally:
+                self.record(method, get_service(url, kwargs), normalize_resource(url), status, time.time() - started, retries, started)
+
+        session.request = instrumented_request
+        session._q8s_instrumented = True
+
+    def grouped(self) -> dict[tuple[str, str, str], list[ApiCall]]:
+        """Returns the calls grouped by service, method and resource."""
+        with self._lock:
+            calls = list(self.calls)
+        groups = {}
+        for call in calls:
+            groups.setdefault((call.service, call.method, call.resource), []).append(call)
+        return groups
+
+    def summary(self, top: int = 10) -> str:
+        """
+        Creates tables of the most frequent and the slowest calls.
+
+        Args:
+            top (int): Number of rows per table.
+
+        Returns:
+            str: The formatted report.
+        """
+        groups = self.grouped()
+        total = sum(len(calls) for calls in groups.values())
+        total_time = sum(c.latency for calls in groups.values() for c in calls)
+        output = f"{total} OpenStack API calls, {total_time:.1f}s in total.\n"
+        if total == 0:
+            return output
+
+        header = "{:<10s}{:<8s}{:<44s}{:>7s}{:>8s}{:>9s}{:>10s}{:>10s}".format("Service", "Method", "Resource", "Count", "Errors", "Retries", "Mean [s]", "Max [s]") + "\n"
+        dash = "-" * 106 + "\n"
+
+        def row(key, calls):
+            latencies = [c.latency for c in calls]
+            return "{:<10s}{:<8s}{:<44s}{:>7d}{:>8d}{:>9d}{:>10.2f}{:>10.2f}".format(
+                key[0][:9], key[1], key[2][:43], len(calls), sum(1 for c in calls if c.status == 0 or c.status >= 400),
+                sum(c.retries for c in calls), sum(latencies) / len(latencies), max(latencies)
+            ) + "\n"
+
+        output = output + "\nMost frequent calls:\n" + header + dash
+        for key, calls in sorted(groups.items(), key=lambda g: -len(g[1]))[:top]:
+            output = output + row(key, calls)
+        output = output + "\nSlowest calls (by total time):\n" + header + dash
+        for key, calls in sorted(groups.items(), key=lambda g: -sum(c.latency for c in g[1]))[:top]:
+            output = output + row(key, calls)
+        return output
+
+    def export_json(self, path: Path):
+        """
+        Writes all recorded calls and the per resource aggregates as JSON.
+
+        Args:
+            path (Path): The file to write the report to.
+        """
+        aggregates = []
+        for (service, method, resource), calls in self.grouped().items():
+            latencies = [c.latency for c in calls]
+            aggregates.append({
+                "service": service,
+                "method": method,
+                "resource": resource,
+                "count": len(calls),
+                "errors": sum(1 for c in calls if c.status == 0 or c.status >= 400),
+                "retries": sum(c.retries for c in calls),
+                "total_latency": sum(latencies),
+                "max_latency": max(latencies),
+            })
+        with self._lock:
+            calls = [asdict(c) for c in self.calls]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"aggregates": aggregates, "calls": calls}, f, indent=2)
+        logger.info(f"OpenStack API report written to {path}.")
+
+
+_api_stats = ApiStats()
+
+
+def get_api_stats() -> ApiStats:
+    """Returns the API statistics shared by the whole program."""
+    return _api_stats
@@ -0,0 +1,93 @@
+"""
+License: MIT
+
+On-disk cache of the Keystone token and service catalog, so consecutive q8s commands reuse the authentication of
+the previous command until the token expires instead of authenticating and discovering the catalog again.
+The cache contains a valid token, it is only readable by the current user.
+"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from openstack.connection import Connection
+
+
+logger = logging.getLogger("logger")
+
+CACHE_DIR = Path.home() / ".cache" / "q8s"
+# tokens expiring within this time are not reused
+MIN_REMAINING_SECONDS = 300
+
+
+def get_cache_file(conn: Connection) -> Path:
+    """
+    Returns the cache file of the credentials of a connection. Different clouds, users or projects use different
+    files, a changed password leads to a new file.
+
+    Args:
+        conn (Connection): The OpenStack connection, it does not need to be authenticated.
+
+    Returns:
+        Path: The cache file.
+    """
+    auth = dict(conn.config.config.get("auth", {}))
+    key = json.dumps({"auth": auth, "auth_type": conn.config.config.get("auth_type"), "region": conn.config.get_region_name()}, sort_keys=True, default=str)
+    return CACHE_DIR / f"auth-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.json"
+
+
+def load_auth_state(conn: Connection) -> bool:
+    """
+    Restores token and service catalog of a previous command into the connection if they are still valid.
+
+    Args:
+        conn (Connection): The OpenStack connection, not authenticated yet.
+
+    Returns:
+        bool: True if a valid cached authentication was restored, False if the connection has to authenticate.
+    """
+    cache_file = get_cache_file(conn)
+    plugin = conn.session.auth
+    if not cache_file.is_file() or not hasattr(plugin, "set_auth_state"):
+        return False
+    try:
+        plugin.set_auth_state(cache_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError, KeyError) as exception:
+        logger.debug(f"Ignoring unreadable auth cache {cache_file}: {exception}")
+        invalidate_auth_state(conn)
+        return False
+    auth_ref = getattr(plugin, "auth_ref", None)
+    if auth_ref is None or auth_ref.will_expire_soon(MIN_REMAINING_SECONDS):
+        logger.debug("Cached OpenStack token expired.")
+        plugin.invalidate()
+        return False
+    logger.debug(f"Reusing cached OpenStack token valid until {auth_ref.expires}.")
+    return True
+
+
+def save_auth_state(conn: Connection):
+    """
+    Writes token and service catalog of an authenticated connection to the cache, readable only by the current user.
+
+    Args:
+        conn (Connection): The authenticated OpenStack connection.
+    """
+    plugin = conn.session.auth
+    state = plugin.get_auth_state() if hasattr(plugin, "get_auth_state") else None
+    if state is None:
+        return
+    cache_file = get_cache_file(conn)
+    try:
+        CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(state)
+        os.replace(tmp_file, cache_file)
+    except OSError as exception:
+        logger.warning(f"Could not write auth cache {cache_file}: {exception}")
+
+
+def invalidate_auth_state(conn: Connection):
+    """Deletes the cached authentication of a connection, e.g. after the credentials were rejected."""
+    get_cache_file(conn).unlink(missing_ok=True)
@@ -1,4 +1,7 @@
+import asyncio
 import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 from pathlib import Path
 import openstack
@@ -6,100 +9,119 @@ from openstack.connection import Connection
 from openstack.config.loader import OpenStackConfig
 import openstack.compute.v2.server as osserver
 import os
-from q8s.scripts.helper.cluster_def import ClusterData, VmType, VmTypes, get_worker_name
+import time
+import uuid
+from q8s.scripts.helper.cluster_def import ClusterData, VmType, VmTypes, get_node_names, parse_host_name, parse_worker_name
 import q8s.scripts.helper.helper_functions
 import q8s.scripts.helper.exceptions as exceptions
+from q8s.scripts.helper import openstack_api_stats, openstack_auth_cache, openstack_resolver, openstack_retry, q8s_tracer
 from keystoneauth1.exceptions import EndpointNotFound, SSLError, Unauthorized
 from openstack.exceptions import ConflictException, SDKException
 
 
 logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
+
+def get_desired_security_group_rules(cluster_data: ClusterData) -> set[tuple]:
+    """
+    Computes the ingress rules the 'q8s-cluster' security group needs according to the cluster configuration.
+
+    Args:
+        cluster_data (ClusterData): The configuration data of the Kubernetes cluster, containing required ports and other settings.
+
+    Returns:
+        set[tuple]: The rules as tuples of protocol, minimal port, maximal port and remote IP prefix.
+    """
+    prefix = cluster_data.remote_ip_prefix
+    rules = set()
+    for tcp_port in cluster_data.required_tcp_ports:
+        rules.add(("tcp", int(tcp_port), int(tcp_port), prefix))
+    for udp_port in cluster_data.required_udp_ports:
+        rules.add(("udp", int(udp_port), int(udp_port), prefix))
+    for protocol in ("tcp", "udp"):
+        rules.add((protocol, int(cluster_data.worker_port_range_min), int(cluster_data.worker_port_range_max), prefix))
+    # image cache of the initial master, see image_cache
+    rules.add(("tcp", int(cluster_data.image_cache_port), int(cluster_data.image_cache_port), prefix))
+    rules.add(("icmp", None, None, prefix))
+    return rules
+
+
+# description of the security group rules created by Q8S, only these rules are ever deleted again
+Q8S_RULE_DESCRIPTION = "managed by q8s"
+
 
 def create_security_group(conn: openstack.connection.Connection, cluster_data: ClusterData) -> bool:
     """
-    Creates a OpenStack security group for the Kubernetes cluster if it does not already exist, 
-    and adds the required TCP and UDP rules based on the cluster configuration as well as an ICMP rule.
+    Creates the OpenStack security group for the Kubernetes cluster if it does not already exist and applies the delta
+    to the cluster configuration: missing TCP, UDP and ICMP rules are added with a single bulk request. Rules that are
+    no longer required are only deleted if Q8S created them (tagged with Q8S_RULE_DESCRIPTION), rules added by hand or
+    by other users of the group are kept. A security group that is up to date costs two requests.
 
     Args:
         conn (openstack.connection.Connection): The OpenStack connection object used to interact with the OpenStack API.
         cluster_data (ClusterData): The configuration data of the Kubernetes cluster, containing required ports and other settings.
 
     Returns:
-        bool: True if the security group was created or already exists, False if any errors were encountered.
+        bool: True if the security group exists with the required rules.
 
     Raises:
-        Q8sFatalError: If there is any error in creating the security group or adding rules.
+        Q8sFatalError: If there is any error in creating the security group or changing its rules.
     """
     sgroup_name = "q8s-cluster"
-    security_groups = conn.list_security_groups()
-    if sgroup_name in map(lambda key: key.get("name"), security_groups):
-        logger.info(f"Security group with name {sgroup_name} already exists. Please check if the rules are appropriate.")
-        return True
-    
-    try:
-        conn.create_security_group(sgroup_name, f"Internal security group for q8s-cluster")
-    except (ConflictException, SDKException) as exception:
-        raise exceptions.Q8sFatalError(f"Error when trying to create new security group: {exception}")
-
-    try:
-        for tcp_port in cluster_data.required_tcp_ports:
-            conn.create_security_group_rule(
-                sgroup_name, tcp_port, tcp_port, "TCP", cluster_data.remote_ip_prefix
-            )
-    except (ConflictException, SDKException) as exception:
-        logger.error()
-        raise exceptions.Q8sFatalError(f"Error when adding rule [TCP, port: {tcp_port}] to security group: {exception}")
-    try:
-        for udp_port in cluster_data.required_udp_ports:
-            conn.create_security_group_rule(
-                sgroup_name, udp_port, udp_port, "UDP", cluster_data.remote_ip_prefix
-            )
-    except (ConflictException, SDKException) as exception:
-        logger.error()
-        raise exceptions.Q8sFatalError(f"Error when adding rule [UDP, port: {udp_port}] to security group: {exception}")
-        
-    try:
-        conn.create_security_group_rule(
-            sgroup_name,
-            cluster_data.worker_port_range_min,
-            cluster_data.worker_port_range_max,
-            "TCP",
-            cluster_data.remote_ip_prefix,
-        )
-    except (ConflictException, SDKException) as exception:
-        logger.error()
-        raise exceptions.Q8sFatalError(f"Error when adding rule [TCP, ports: {cluster_data.worker_port_range_min} - {cluster_data.worker_port_range_max}] to security group: {exception}")
-    try:    
-        conn.create_security_group_rule(
-            sgroup_name,
-            cluster_data.worker_port_range_min,
-            cluster_data.worker_port_range_max,
-            "UDP",
-            cluster_data.remote_ip_prefix,
-        )
-    except (ConflictException, SDKException) as exception:
-        logger.error()
-        raise exceptions.Q8sFatalError(f"Error when adding rule [UDP, ports: {cluster_data.worker_port_range_min} - {cluster_data.worker_port_range_max}] to security group: {exception}")
-    try:
-        conn.create_security_group_rule(
-            sgroup_name,
-            direction='ingress',
-            protocol='icmp',
-            remote_ip_prefix='10.254.1.0/24',
-            ethertype='IPv4'
-        )
-    except (ConflictException, SDKException) as exception:
-        logger.error()
-        raise exceptions.Q8sFatalError(f"Error when adding rule [ICMP, full subnet]] to security group: {exception}")
-
+    security_group = openstack_resolver.get_resolver(conn).security_group(sgroup_name)
+    if security_group is None:
+        try:
+            security_group = conn.network.create_security_group(name=sgroup_name, description="Internal security group for q8s-cluster")
+        except (ConflictException, SDKException) as exception:
+            raise exceptions.Q8sFatalError(f"Error when trying to create new security group: {exception}")
+        logger.debug(f"Created Security group {sgroup_name}")
+
+    desired = get_desired_security_group_rules(cluster_data)
+    existing = {}
+    for rule in conn.network.security_group_rules(security_group_id=security_group.id, direction="ingress"):
+        # rules referencing other security groups or IPv6 are not managed by Q8S
+        if rule.ethertype != "IPv4" or rule.remote_group_id is not None:
+            continue
+        key = ((rule.protocol or "").lower(), rule.port_range_min, rule.port_range_max, rule.remote_ip_prefix)
+        existing[key] = rule
+
+    missing = desired - set(existing)
+    if missing:
+        rules = [{
+            "security_group_id": security_group.id,
+            "direction": "ingress",
+            "ethertype": "IPv4",
+            "protocol": protocol,
+            "port_range_min": port_min,
+            "port_range_max": port_max,
+            "remote_ip_prefix": prefix,
+            "description": Q8S_RULE_DESCRIPTION,
+        } for protocol, port_min, port_max, prefix in sorted(missing, key=str)]
+        try:
+            conn.network.create_security_group_rules(rules)
+        except (ConflictException, SDKException) as exception:
+            raise exceptions.Q8sFatalError(f"Error when adding rules {sorted(missing, key=str)} to security group: {exception}")
+        logger.info(f"Added {len(missing)} rules to security group {sgroup_name}.")
+
+    foreign = sorted((key for key in set(existing) - desired if existing[key].description != Q8S_RULE_DESCRIPTION), key=str)
+    if foreign:
+        logger.info(f"Keeping {len(foreign)} rules of security group {sgroup_name} that were not created by Q8S: {foreign}")
+    for key in sorted(set(existing) - desired - set(foreign), key=str):
+        try:
+            conn.network.delete_security_group_rule(existing[key], ignore_missing=True)
+        except SDKException as exception:
+            raise exceptions.Q8sFatalError(f"Error when removing rule {key} from security group: {exception}")
+        logger.info(f"Removed rule {key} from security group {sgroup_name}, it is no longer required.")
 
-    logger.debug(f"Created Security group {sgroup_name}")
+    if not missing and len(existing) == len(desired):
+        logger.debug(f"Security group {sgroup_name} is up to date.")
     return True
 
 
 def calculate_free_resources(
     conn: openstack.connection.Connection,
-    cluster_data: ClusterData
+    cluster_data: ClusterData,
+    worker_placement: dict[str, list[str]] = None
 ) -> bool:
     """Check whether compute limits can satisfy requested deployment and give an overview.
 
@@ -110,6 +132,8 @@ def calculate_free_resources(
     Args:
         conn (openstack.connection.Connection): Valid openstack connection.
         cluster_data (q8s.scripts.helper.cluster_def.ClusterData): valid ClusterData
+        worker_placement (dict[str, list[str]]): The workers packed onto hosts of worker_host_flavor (see
+            placement.plan_placement), None if every worker gets its own instance.
     Returns:
         bool: A bool that is true if the required resources fit within the maximum allowed compute limits
     """
@@ -120,20 +144,25 @@ def calculate_free_resources(
     logger.debug(f"Received compute_limits: {compute_limits}")
     volume_limits = get_openstack_volume_limits(conn)
     logger.debug(f"Received volume_limits: {volume_limits}")
-    master_node_flavor = conn.compute.find_flavor(cluster_data.cluster_definition.master_node_flavor)
+    resolver = openstack_resolver.get_resolver(conn)
+    master_node_flavor = resolver.flavor(cluster_data.cluster_definition.master_node_flavor)
     used_instances_after = compute_limits["used_instances"] + int(cluster_def.number_additional_master_nodes) 
     used_vcpus_after = compute_limits["used_cores"] + int(cluster_def.number_additional_master_nodes) * master_node_flavor.vcpus
     used_ram_after = compute_limits["used_ram"]+ int(cluster_def.number_additional_master_nodes) * master_node_flavor.ram
     used_volume_number_after = volume_limits["used_number"] + int(cluster_def.number_additional_master_nodes)
     used_volume_size_after = volume_limits["used_size"] + int(cluster_def.number_additional_master_nodes) * master_node_flavor.disk
 
-    for w in cluster_def.worker:
-        flav = conn.compute.find_flavor(vm_types.types[w].openstack_flavor)
-        used_instances_after += cluster_def.worker[w]
-        used_vcpus_after += flav.vcpus * cluster_def.worker[w]
-        used_ram_after += flav.ram * cluster_def.worker[w]
-        used_volume_number_after += 1 * cluster_def.worker[w]
-        used_volume_size_after += flav.disk * cluster_def.worker[w]
+    # one instance per worker, or the hosts the workers are packed onto
+    worker_instances = [(vm_types.types[w].openstack_flavor, cluster_def.worker[w]) for w in cluster_def.worker]
+    if worker_placement is not None:
+        worker_instances = [(cluster_def.worker_host_flavor, len(worker_placement))]
+    for flavor_name, count in worker_instances:
+        flav = resolver.flavor(flavor_name)
+        used_instances_after += count
+        used_vcpus_after += flav.vcpus * count
+        used_ram_after += flav.ram * count
+        used_volume_number_after += 1 * count
+        used_volume_size_after += flav.disk * count
 
     output = ""
     dash = "-" * 48
@@ -306,6 +335,8 @@ def create_keypair(conn):
 def create_openstack_connection_from_file(path: Path) -> Connection:
     """
     Creates an OpenStack connection using the credentials from a specified configuration file (cloud.yaml).
+    A token cached by a previous command is reused until it expires (see openstack_auth_cache). Transient errors are
+    retried and the request rate is limited (see openstack_retry), all API calls are recorded (see openstack_api_stats).
 
     Args:
         path (Path): The file path to the cloud configuration file (typically a `cloud.yaml` file).
@@ -326,12 +357,19 @@ def create_openstack_connection_from_file(path: Path) -> Connection:
         logger.error("Cannot connect to cloud {cloud_name}. Make sure it exists in your cloud.yaml")
         raise exceptions.Q8sFatalError(f"Cannot connect to cloud {cloud_name}. Make sure it exists in your cloud.yaml")
     
+    openstack_retry.install(conn)
+    openstack_api_stats.get_api_stats().instrument(conn)
+    # a cached token proves the credentials were valid, the verification would only cost another authentication
+    if openstack_auth_cache.load_auth_state(conn):
+        return conn
     if not verify_openstack_connection(conn):
+        openstack_auth_cache.invalidate_auth_state(conn)
         raise exceptions.Q8sFatalError(
             f"Openstack verification failed. Could not access Openstack API with the"
             f" given credentials.\n"
             f"Please verify that your credentials and the given url are correct."
         )
+    openstack_auth_cache.save_auth_state(conn)
     return conn
 
 def verify_openstack_connection(conn: openstack.connection.Connection) -> bool:
@@ -369,7 +407,7 @@ def add_security_group_to_initial_instance(openstack_conn: openstack.connection.
     """
     logger.debug(f"Adding init instance with name {cluster_data.name_of_initial_instance} to q8s-cluster security group.")
     server = openstack_conn.compute.find_server(cluster_data.name_of_initial_instance)
-    security_group = openstack_conn.network.find_security_group('q8s-cluster')
+    security_group = openstack_resolver.get_resolver(openstack_conn).security_group('q8s-cluster')
     try:
         if not any(sg['name'] == 'q8s-cluster' for sg in server.security_groups):
             openstack_conn.compute.add_security_group_to_server(server, security_group)
@@ -378,13 +416,19 @@ def add_security_group_to_initial_instance(openstack_conn: openstack.connection.
 
 
 
-def spawn_openstack_instances(openstack_conn: openstack.connection.Connection, cluster_data: ClusterData) -> dict[str, list[openstack.compute.v2.server.Server]]:
+@tracer.traced("spawn_openstack_instances")
+def spawn_openstack_instances(openstack_conn: openstack.connection.Connection, cluster_data: ClusterData, wait: bool = True, skip_names: set[str] = frozenset(), master_names: list[str] = None, worker_names: list[str] = None) -> dict[str, list[openstack.compute.v2.server.Server]]:
     """
     Spawns OpenStack instances based on the provided cluster configuration and returns a dictionary containing the created server instances.
 
     Args:
         openstack_conn (openstack.connection.Connection): An OpenStack connection object used to interact with the OpenStack API.
         cluster_data (ClusterData): An object containing configuration data for the cluster, including network and instance details.
+        wait (bool): Whether to wait until all servers are active. If False, the servers are returned right after creation
+            and the caller has to wait for them (see ServerWaiter).
+        skip_names (set[str]): Names of instances that already exist and must not be spawned again.
+        master_names (list[str]): Names of the master nodes to spawn, defaults to all master nodes of the cluster configuration.
+        worker_names (list[str]): Names of the worker nodes to spawn, defaults to all worker nodes of the cluster configuration.
 
     Returns:
         dict[str, list[openstack.compute.v2.server.Server]]: A dictionary where keys are instance types ('master' and 'worker') and values are lists of created server instances of type `openstack.compute.v2.server.Server`.
@@ -395,123 +439,547 @@ def spawn_openstack_instances(openstack_conn: openstack.connection.Connection, c
     create_security_group(openstack_conn, cluster_data)
     add_security_group_to_initial_instance(openstack_conn, cluster_data)
     #print("private network id: " + cluster_data.private_network_id)
-    network = openstack_conn.network.find_network(cluster_data.private_network_id)
+    network = openstack_resolver.get_resolver(openstack_conn).network(cluster_data.private_network_id)
     if network is None:
         logger.error(f"Could not find valid subnet id for private network:{cluster_data.private_network_id}")
         raise exceptions.Q8sFatalError(
             f"Could not find valid subnet id for private network:"
             f" {cluster_data.private_network_id}")
 
-    servers["master"] = spawn_master_nodes(cluster_data, openstack_conn, keypair, network)
-    servers["worker"] = spawn_worker_nodes(cluster_data, openstack_conn, keypair, network)
+    servers["master"] = spawn_master_nodes(cluster_data, openstack_conn, keypair, network, skip_names, master_names)
+    servers["worker"] = spawn_worker_nodes(cluster_data, openstack_conn, keypair, network, skip_names, worker_names)
+
+    if not wait:
+        return servers
 
     # wait for servers to get their IP assigned
     logger.info("Waiting for OpenStack instances...")
-    for l in servers.values():
-        for server in l:
-            openstack_conn.compute.wait_for_server(server)
+    with tracer.span("wait_for_servers"):
+        active = wait_for_servers(openstack_conn, servers["master"] + servers["worker"])
+    servers["master"], servers["worker"] = active[:len(servers["master"])], active[len(servers["master"]):]
     logger.info("All servers created.")
     
     return servers
 
 
+def get_server_ip(conn: Connection, server: openstack.compute.v2.server.Server, cluster_data: ClusterData) -> str:
+    """
+    Returns the IP address of a server in the private network of the cluster.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        server (openstack.compute.v2.server.Server): A server that already has its addresses assigned.
+        cluster_data (ClusterData): An object containing configuration data for the cluster, including the private network id.
+
+    Returns:
+        str: The IP address of the server in the private network.
+    """
+    network_name = openstack_resolver.get_resolver(conn).network(cluster_data.private_network_id).name
+    return server.addresses[network_name][0]['addr']
+
+
+def allocate_host_addresses(conn: Connection, server: openstack.compute.v2.server.Server, cluster_data: ClusterData, count: int) -> list[str]:
+    """
+    Makes sure the port of a server in the private network has count fixed IPs, adding the missing ones in the subnet
+    of its first IP with a single request. Used for hosts running several worker VMs, every VM is reached via one IP.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        server (openstack.compute.v2.server.Server): An active server.
+        cluster_data (ClusterData): An object containing configuration data for the cluster, including the private network id.
+        count (int): Number of IPs the server needs.
+
+    Returns:
+        list[str]: The primary IP of the server followed by the additional IPs, in a stable order.
+
+    Raises:
+        Q8sFatalError: If the server has no port in the private network or the IPs cannot be added.
+    """
+    network = openstack_resolver.get_resolver(conn).network(cluster_data.private_network_id)
+    ports = list(conn.network.ports(device_id=server.id, network_id=network.id))
+    if not ports:
+        raise exceptions.Q8sFatalError(f"Server {server.name} has no port in network {network.name}.")
+    port = ports[0]
+    missing = count - len(port.fixed_ips)
+    if missing > 0:
+        subnet_id = port.fixed_ips[0]["subnet_id"]
+        try:
+            port = conn.network.update_port(port, fixed_ips=list(port.fixed_ips) + [{"subnet_id": subnet_id}] * missing)
+        except SDKException as exception:
+            raise exceptions.Q8sFatalError(f"Could not add {missing} IPs to server {server.name}: {exception}")
+        logger.debug(f"Added {missing} IPs to server {server.name}.")
+    primary = get_server_ip(conn, server, cluster_data)
+    additional = sorted((f["ip_address"] for f in port.fixed_ips if f["ip_address"] != primary), key=lambda ip: tuple(int(p) for p in ip.split(".")))
+    return ([primary] + additional)[:count]
+
+
+class ServerWaiter:
+    """
+    Waits for many servers at once with a single poll loop that lists all servers of the project once per interval.
+    Every waiting caller gets its server as soon as it is ACTIVE, so no server waits for the poll tail of another one,
+    and a server going into ERROR state is reported right away instead of after the timeout.
+    """
+
+    def __init__(self, conn: Connection, interval: int = 5, timeout: int = 1800):
+        self.conn = conn
+        self.interval = interval
+        self.timeout = timeout
+        self._pending: dict[str, tuple[str, asyncio.Future, float]] = {}
+        self._status: dict[str, str] = {}
+        self._poller: asyncio.Task = None
+
+    async def wait(self, server: openstack.compute.v2.server.Server) -> openstack.compute.v2.server.Server:
+        """
+        Waits until a server is ACTIVE. The poll loop is started with the first waiting server and stops when no
+        server is left to wait for.
+
+        Args:
+            server (openstack.compute.v2.server.Server): The server to wait for.
+
+        Returns:
+            openstack.compute.v2.server.Server: The refreshed server, including its addresses.
+
+        Raises:
+            Q8sServerError: If the server goes into ERROR state.
+            Q8sFatalError: If the server is not ACTIVE within the timeout.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending[server.id] = (server.name, future, time.time())
+        if self._poller is None or self._poller.done():
+            self._poller = loop.create_task(self._poll())
+        return await future
+
+    async def _poll(self):
+        """Lists all servers once per interval and resolves the futures of servers that became ACTIVE or ERROR."""
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            try:
+                servers = await loop.run_in_executor(None, lambda: list(self.conn.compute.servers()))
+            except Exception as exception:
+                logger.warning(f"Could not list servers, retrying: {exception}")
+                servers = []
+            by_id = {server.id: server for server in servers}
+            for server_id, (name, future, since) in list(self._pending.items()):
+                server = by_id.get(server_id)
+                if server is not None and server.status != self._status.get(server_id):
+                    logger.debug(f"Server {name}: {self._status.get(server_id, 'NEW')} -> {server.status}")
+                    self._status[server_id] = server.status
+                if future.done():
+                    del self._pending[server_id]
+                elif server is not None and server.status == "ACTIVE":
+                    del self._pending[server_id]
+                    future.set_result(server)
+                elif server is not None and server.status == "ERROR":
+                    del self._pending[server_id]
+                    fault = (server.fault or {}).get("message", "unknown fault")
+                    future.set_exception(exceptions.Q8sServerError(f"Server {name} went into ERROR state: {fault}", server))
+                elif time.time() - since > self.timeout:
+                    del self._pending[server_id]
+                    future.set_exception(exceptions.Q8sFatalError(f"Server {name} was not active within {self.timeout}s."))
+            if self._pending:
+                await asyncio.sleep(self.interval)
+
+
+def wait_for_servers(conn: Connection, servers: list[openstack.compute.v2.server.Server]) -> list[openstack.compute.v2.server.Server]:
+    """
+    Waits until all servers are active with a single poll loop.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        servers (list[openstack.compute.v2.server.Server]): The servers to wait for.
+
+    Returns:
+        list[openstack.compute.v2.server.Server]: The refreshed servers in the same order.
 
-def spawn_master_nodes(cluster_data: ClusterData, conn: Connection, keypair, network) -> list[openstack.compute.v2.server.Server]:
+    Raises:
+        Q8sFatalError: If a server goes into ERROR state or is not active within the timeout.
+    """
+    async def wait_all():
+        waiter = ServerWaiter(conn)
+        return await asyncio.gather(*(waiter.wait(server) for server in servers))
+    return asyncio.run(wait_all())
+
+
+def replace_server(conn: Connection, cluster_data: ClusterData, server: openstack.compute.v2.server.Server) -> openstack.compute.v2.server.Server:
+    """
+    Deletes a server, e.g. one in ERROR state, and spawns a new server with the same name.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        cluster_data (ClusterData): An object containing configuration data for the cluster.
+        server (openstack.compute.v2.server.Server): The server to replace.
+
+    Returns:
+        openstack.compute.v2.server.Server: The new server, not necessarily active yet.
+    """
+    conn.compute.delete_server(server)
+    keypair = conn.compute.find_keypair("q8s-cluster")
+    network = openstack_resolver.get_resolver(conn).network(cluster_data.private_network_id)
+    if server.name.startswith("master-"):
+        return spawn_master_nodes(cluster_data, conn, keypair, network, names=[server.name])[0]
+    return spawn_worker_nodes(cluster_data, conn, keypair, network, names=[server.name])[0]
+
+
+# scripts whose result is contained in a baked host image, a change of any of them requires a new image
+BAKED_SCRIPTS = ["prepare_host.sh", "install-k8s.sh"]
+
+
+def get_baked_image_name(cluster_data: ClusterData) -> str:
+    """
+    Returns the name of the host image created by 'q8s bake' for the current setup scripts and base image.
+
+    Args:
+        cluster_data (ClusterData): An object containing configuration data for the cluster, including the default image name.
+
+    Returns:
+        str: The image name in the format 'q8s-host-{hash}'.
+    """
+    digest = hashlib.sha256(cluster_data.default_image_name.encode("utf-8"))
+    scripts_dir = Path(__file__).resolve().parents[1]
+    for script in BAKED_SCRIPTS:
+        digest.update((scripts_dir / script).read_bytes())
+    return f"q8s-host-{digest.hexdigest()[:12]}"
+
+
+def get_host_image(conn: Connection, cluster_data: ClusterData):
+    """
+    Returns the image the master and worker instances boot from: the baked host image if it exists, the default
+    image otherwise.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        cluster_data (ClusterData): An object containing configuration data for the cluster, including the default image name.
+
+    Returns:
+        The image to boot from.
+    """
+    resolver = openstack_resolver.get_resolver(conn)
+    image = resolver.image(get_baked_image_name(cluster_data))
+    if image is not None and image.status == "active":
+        logger.info(f"Using baked host image {image.name}.")
+        return image
+    return resolver.image(cluster_data.default_image_name)
+
+
+# metadata key every server of a cluster is tagged with, its value is the name of the initial instance of the cluster
+CLUSTER_METADATA_KEY = "q8s-cluster"
+# name prefix of the servers of a multi-create request until they are renamed
+BATCH_NAME_PREFIX = "q8s-batch-"
+
+
+def get_cluster_metadata(cluster_data: ClusterData) -> dict[str, str]:
+    """Returns the metadata tagging the servers of the cluster, identifying the cluster by its initial instance."""
+    return {CLUSTER_METADATA_KEY: cluster_data.name_of_initial_instance}
+
+
+def create_servers(conn: Connection, names: list[str], image, flavor, network, keypair, user_data: str, sec_groups: list[dict], timeout: int = 120,
+                   metadata: dict[str, str] = None) -> list[openstack.compute.v2.server.Server]:
+    """
+    Creates servers that share image, flavor and user data with a single Nova multi-create request (min_count/max_count)
+    and renames them to the given names. A single server is created directly with its name.
+    The servers of a multi-create request are looked up by the reservation ID of the request, or by the unique request
+    name they are named after if the reservation ID is hidden by the policy of the cloud, and renamed in creation order,
+    independent of the multi_instance_display_name_template of Nova. If not all servers show up or a rename fails,
+    all servers of the request are deleted, so no server is left behind that no state file records.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        names (list[str]): The names of the servers to create.
+        image: The image of the servers.
+        flavor: The flavor of the servers.
+        network: The network the servers are attached to.
+        keypair: The SSH keypair to be associated with the servers.
+        user_data (str): Base64 encoded user data of the servers.
+        sec_groups (list[dict]): The security groups of the servers.
+        timeout (int): Maximum time in seconds to wait for all servers of the request to be listed.
+        metadata (dict[str, str]): Metadata the servers are tagged with, e.g. the cluster they belong to.
+
+    Returns:
+        list[openstack.compute.v2.server.Server]: The created servers in the order of names.
+
+    Raises:
+        Q8sFatalError: If not all servers of a multi-create request show up within the timeout or cannot be renamed.
+    """
+    if len(names) == 0:
+        return []
+    request_name = names[0] if len(names) == 1 else f"{BATCH_NAME_PREFIX}{uuid.uuid4().hex[:8]}"
+    with tracer.span("create_servers", count=len(names), flavor=flavor.name):
+        server = conn.compute.create_server(
+            name=request_name,
+            image_id=image.id,
+            flavor_id=flavor.id,
+            networks=[{"uuid": network.id}],
+            key_name=keypair.name,
+            user_data=user_data,
+            security_groups=sec_groups,
+            metadata=metadata or {},
+            min_count=len(names),
+            max_count=len(names)
+        )
+    if len(names) == 1:
+        logger.debug(f"Server {server.name} created.")
+        return [server]
+
+    # the response only contains the first server of the request, its reservation ID is shared by all of them
+    reservation_id = getattr(conn.compute.get_server(server.id), "reservation_id", None)
+    query = {"reservation_id": reservation_id} if reservation_id else {"name": f"^{request_name}"}
+    deadline = time.time() + timeout
+    while True:
+        batch = list(conn.compute.servers(**query))
+        if len(batch) >= len(names) or time.time() > deadline:
+            break
+        time.sleep(2)
+    batch.sort(key=lambda s: (s.launch_index if s.launch_index is not None else 0, s.created_at or "", s.id))
+
+    servers = []
+    try:
+        if len(batch) != len(names):
+            raise exceptions.Q8sFatalError(f"Multi-create request {request_name} returned {len(batch)} of {len(names)} servers.")
+        for name, server in zip(names, batch):
+            servers.append(conn.compute.update_server(server, name=name))
+            logger.debug(f"Server {name} created as {server.name}.")
+    except Exception as exception:
+        logger.error(f"Multi-create request {request_name} failed, deleting its {len(batch)} servers: {exception}")
+        for server in batch:
+            try:
+                conn.compute.delete_server(server, ignore_missing=True)
+            except SDKException as delete_exception:
+                logger.error(f"Could not delete server {server.id} of request {request_name}, 'q8s destroy' removes it: {delete_exception}")
+        if isinstance(exception, exceptions.Q8sFatalError):
+            raise
+        raise exceptions.Q8sFatalError(f"Renaming the servers of multi-create request {request_name} failed: {exception}")
+    return servers
+
+
+def spawn_master_nodes(cluster_data: ClusterData, conn: Connection, keypair, network, skip_names: set[str] = frozenset(), names: list[str] = None) -> list[openstack.compute.v2.server.Server]:
     """
     Spawns master nodes in OpenStack based on the provided cluster configuration and returns a list of created server instances.
+    All master nodes are created with a single multi-create request.
 
     Args:
         cluster_data (ClusterData): An object containing configuration data for the cluster, including node specifications, image names, and security groups.
         conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
         keypair: The SSH keypair to be associated with the created server instances.
         network: The network in which the master nodes will be created.
+        skip_names (set[str]): Names of master nodes that already exist and must not be spawned again.
+        names (list[str]): Names of the master nodes to spawn, defaults to all master nodes of the cluster configuration.
 
     Returns:
         list[openstack.compute.v2.server.Server]: A list of created server instances of type `openstack.compute.v2.server.Server`.
     """
     servers = []
-    if cluster_data.cluster_definition.number_additional_master_nodes > 0:
+    if names is None:
+        names = get_node_names(cluster_data)[0]
+    names = [name for name in names if name not in skip_names]
+    if len(names) > 0:
         try:
-            image = conn.image.find_image(cluster_data.default_image_name)
-            flavor = conn.compute.find_flavor(cluster_data.cluster_definition.master_node_flavor)
+            resolver = openstack_resolver.get_resolver(conn)
+            image = get_host_image(conn, cluster_data)
+            flavor = resolver.flavor(cluster_data.cluster_definition.master_node_flavor)
             user_data = base64.b64encode(f"#!/bin/bash\ncd ~\nsudo apt install -y git\ngit clone {cluster_data.git_url}".encode("utf-8")).decode('utf-8')
             sec_groups = []
             for n in cluster_data.security_groups:
                 sec_groups.append({'name': f'{n}'})
             logger.debug("Resources ready")
-            for i in range(cluster_data.cluster_definition.number_additional_master_nodes):
-                name = "master-" + str(i+1)
-                server = conn.compute.create_server(
-                    name=name,
-                    image_id=image.id,
-                    flavor_id=flavor.id,
-                    networks=[{"uuid": network.id}],
-                    key_name=keypair.name,
-                    user_data=user_data,
-                    security_groups=sec_groups
-                )
-                logger.debug(f"Server {server.name} created.")
-                servers.append(server)
+            servers = create_servers(conn, names, image, flavor, network, keypair, user_data, sec_groups, metadata=get_cluster_metadata(cluster_data))
 
             logger.info("Master nodes created.")
         except Exception as e:
             print(e)
-            logger.error("Cannot create server: " + str(e.with_traceback()))
+            logger.error("Cannot create server: " + str(e))
             raise exceptions.Q8sFatalError("Cannot create server: " + str(e))
         
     return servers
 
 
 
-def spawn_worker_nodes(cluster_data: ClusterData, conn: Connection, keypair, network) -> list[openstack.compute.v2.server.Server]:
+def spawn_worker_nodes(cluster_data: ClusterData, conn: Connection, keypair, network, skip_names: set[str] = frozenset(), names: list[str] = None) -> list[openstack.compute.v2.server.Server]:
     """
     Spawns worker nodes in OpenStack based on the provided cluster configuration and returns a list of created server instances.
+    The workers are grouped by flavor and every group is created with a single multi-create request.
 
     Args:
         cluster_data (ClusterData): An object containing configuration data for the cluster, including node specifications, image names, and security groups.
         conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
         keypair: The SSH keypair to be associated with the created server instances.
         network: The network in which the worker nodes will be created.
+        skip_names (set[str]): Names of worker nodes that already exist and must not be spawned again.
+        names (list[str]): Names of the worker nodes to spawn in the format 'worker-{number}-{VmType}', or 'host-{number}'
+            for hosts running several workers, defaults to all worker nodes of the cluster configuration.
 
     Returns:
         list[openstack.compute.v2.server.Server]: A list of created server instances of type `openstack.compute.v2.server.Server`.
     """
     logger.debug("Creating worker nodes")
     servers = []
-    workers = cluster_data.cluster_definition.worker
-    worker_number = 0
-    total = 0
+    if names is None:
+        names = get_node_names(cluster_data)[1]
     try:
-        image = conn.image.find_image(cluster_data.default_image_name)
+        resolver = openstack_resolver.get_resolver(conn)
+        image = get_host_image(conn, cluster_data)
         sec_groups = []
         for n in cluster_data.security_groups:
             sec_groups.append({'name': f'{n}'})
         user_data = base64.b64encode(f"#!/bin/bash\ncd ~\nsudo apt install -y git\ngit clone {cluster_data.git_url}".encode("utf-8")).decode('utf-8')
 
-        for vm_type, number in workers.items():
-            flavor = conn.compute.find_flavor(cluster_data.vm_types.types[vm_type].openstack_flavor)
-            logger.debug("Resources ready")
-            total += int(number)
-            for i in range(number):
-                if (worker_number+1) <= total:
-                    worker_number += 1
-                    name = get_worker_name(worker_number, cluster_data)
-                    server = conn.compute.create_server(
-                        name=name,
-                        image_id=image.id,
-                        flavor_id=flavor.id,
-                        networks=[{"uuid": network.id}],
-                        key_name=keypair.name,
-                        user_data=user_data,
-                        security_groups=sec_groups
-                    )
-                    logger.debug(f"Server {server.name} created.")
-                    servers.append(server)
+        # image and user data are the same for all workers, VmTypes sharing a flavor end up in the same request
+        groups = {}
+        for name in names:
+            if name in skip_names:
+                continue
+            if parse_host_name(name) is not None:
+                flavor_name = cluster_data.cluster_definition.worker_host_flavor
+            else:
+                flavor_name = cluster_data.vm_types.types[parse_worker_name(name)[1]].openstack_flavor
+            groups.setdefault(flavor_name, []).append(name)
+        logger.debug("Resources ready")
+
+        for flavor_name, group in groups.items():
+            servers += create_servers(conn, group, image, resolver.flavor(flavor_name), network, keypair, user_data, sec_groups,
+                                      metadata=get_cluster_metadata(cluster_data))
 
         logger.info("Worker nodes created.")
     except Exception as e:
         print(e)
-        logger.error("Cannot create server: " + str(e.with_traceback()))
+        logger.error("Cannot create server: " + str(e))
         raise exceptions.Q8sFatalError("Cannot create server: " + str(e))
 
-    return servers
\ No newline at end of file
+    return servers
+
+
+def list_cluster_servers(conn: Connection, cluster_data: ClusterData, server_ids: list[str] = ()) -> dict[str, openstack.compute.v2.server.Server]:
+    """
+    Lists the OpenStack instances of the Q8S cluster, i.e. all servers tagged with the metadata of the cluster (see
+    get_cluster_metadata) and the servers recorded in the deployment state. Other servers of the project are never
+    listed, even if their names follow the naming of the cluster.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        cluster_data (ClusterData): An object containing cluster configuration data, including the name of the initial instance.
+        server_ids (list[str]): IDs of the servers recorded in the deployment state.
+
+    Returns:
+        dict[str, openstack.compute.v2.server.Server]: The servers of the cluster by name.
+    """
+    cluster = get_cluster_metadata(cluster_data)[CLUSTER_METADATA_KEY]
+    server_ids = set(server_ids)
+    servers = {}
+    for server in conn.compute.servers():
+        if server.id in server_ids or (server.metadata or {}).get(CLUSTER_METADATA_KEY) == cluster:
+            servers[server.name] = server
+    return servers
+
+
+def list_servers_by_name(conn: Connection, known: dict[str, openstack.compute.v2.server.Server] = None) -> dict[str, openstack.compute.v2.server.Server]:
+    """
+    Lists the servers that are recognized as part of a Q8S cluster only by their name: 'master-{number}',
+    'worker-{number}-{VmType}', 'host-{number}' and the not yet renamed servers of a multi-create request
+    'q8s-batch-{id}-{index}'. Servers of other users of a shared project might match as well, so the result must be
+    confirmed before deleting it.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        known (dict[str, openstack.compute.v2.server.Server]): Servers already known to be part of the cluster, not listed again.
+
+    Returns:
+        dict[str, openstack.compute.v2.server.Server]: The matching servers by name.
+    """
+    known_ids = {server.id for server in (known or {}).values()}
+    servers = {}
+    for server in conn.compute.servers():
+        if server.id in known_ids:
+            continue
+        is_master = server.name.startswith("master-") and server.name.removeprefix("master-").isdigit()
+        if is_master or server.name.startswith(BATCH_NAME_PREFIX) or parse_worker_name(server.name) is not None or parse_host_name(server.name) is not None:
+            servers[server.name] = server
+    return servers
+
+
+def delete_servers(conn: Connection, servers: list[openstack.compute.v2.server.Server], parallelism: int = 10, timeout: int = 600, interval: int = 5) -> list[str]:
+    """
+    Deletes servers concurrently and waits for all deletions with a single poll loop listing all servers once per
+    interval, instead of waiting for each server on its own. A server is only reported once it still exists after the
+    timeout, Nova keeps servers in ERROR state while it processes their deletion.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        servers (list[openstack.compute.v2.server.Server]): The servers to delete.
+        parallelism (int): Maximum number of delete requests running at the same time.
+        timeout (int): Maximum time in seconds to wait for the deletions.
+        interval (int): Time in seconds between two polls.
+
+    Returns:
+        list[str]: Names of the servers that still exist after the timeout or could not be deleted.
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        futures = {executor.submit(conn.compute.delete_server, server): server for server in servers}
+        for future in as_completed(futures):
+            server = futures[future]
+            try:
+                future.result()
+                logger.debug(f"Deletion of server {server.name} requested.")
+            except SDKException as exception:
+                logger.error(f"Could not delete server {server.name}: {exception}")
+                failed.append(server.name)
+
+    remaining = {server.id: server.name for server in servers if server.name not in failed}
+    start = time.time()
+    while remaining:
+        existing = {server.id: server for server in conn.compute.servers()}
+        for server_id in list(remaining):
+            if server_id not in existing:
+                logger.info(f"Server {remaining.pop(server_id)} deleted.")
+        if not remaining:
+            break
+        if time.time() - start > timeout:
+            for server_id, name in remaining.items():
+                server = existing[server_id]
+                fault = (server.fault or {}).get("message")
+                logger.error(f"Server {name} was not deleted within {timeout}s (status {server.status}, task state {server.task_state}"
+                             + (f", fault: {fault})." if fault else ")."))
+            failed += remaining.values()
+            break
+        time.sleep(interval)
+    return failed
+
+
+def destroy_cluster(conn: Connection, cluster_data: ClusterData, servers: dict[str, openstack.compute.v2.server.Server], parallelism: int = 10) -> bool:
+    """
+    Deletes all OpenStack resources of the cluster: the master and worker instances, the 'q8s-cluster' security group
+    (after removing it from the initial instance) and the 'q8s-cluster' keypair. The initial instance itself is kept.
+
+    Args:
+        conn (Connection): An OpenStack connection object used to interact with the OpenStack API.
+        cluster_data (ClusterData): An object containing cluster configuration data, including the name of the initial instance.
+        servers (dict[str, openstack.compute.v2.server.Server]): The instances of the cluster by name, see list_cluster_servers.
+        parallelism (int): Maximum number of servers deleted at the same time.
+
+    Returns:
+        bool: True if all resources were deleted, False otherwise.
+    """
+    logger.info(f"Deleting {len(servers)} servers: {sorted(servers)}")
+    failed = delete_servers(conn, list(servers.values()), parallelism)
+    if failed:
+        logger.error(f"Servers {failed} could not be deleted, keeping security group and keypair.")
+        return False
+
+    resolver = openstack_resolver.get_resolver(conn)
+    security_group = resolver.security_group("q8s-cluster")
+    if security_group is not None:
+        initial_instance = conn.compute.find_server(cluster_data.name_of_initial_instance)
+        if initial_instance is not None and any(sg["name"] == "q8s-cluster" for sg in initial_instance.security_groups or []):
+            conn.compute.remove_security_group_from_server(initial_instance, security_group)
+            logger.debug(f"Removed security group q8s-cluster from {initial_instance.name}.")
+        try:
+            conn.network.delete_security_group(security_group)
+            resolver.invalidate("security_group", "q8s-cluster")
+            logger.info("Security group q8s-cluster deleted.")
+        except (ConflictException, SDKException) as exception:
+            logger.error(f"Could not delete security group q8s-cluster, it might still be in use: {exception}")
+            return False
+
+    conn.compute.delete_keypair("q8s-cluster", ignore_missing=True)
+    logger.info("Keypair q8s-cluster deleted.")
+    return True
@@ -0,0 +1,103 @@
+"""
+License: MIT
+
+Per-run cache for the lookup of OpenStack resources by name or id. Flavors, images, networks and security groups do
+not change during a deployment, so each of them is looked up once instead of once per server.
+Should be used as
+
+    "resolver = openstack_resolver.get_resolver(conn)"
+"""
+import logging
+import threading
+import weakref
+from openstack.connection import Connection
+
+
+logger = logging.getLogger("logger")
+
+
+class ResourceResolver:
+    """Thread-safe memoization of the find_* lookups of a single OpenStack connection."""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self._cache: dict[tuple[str, str], object] = {}
+        self._lock = threading.Lock()
+        self._finders = {
+            "flavor": conn.compute.find_flavor,
+            "image": conn.image.find_image,
+            "network": conn.network.find_network,
+            "security_group": conn.network.find_security_group,
+        }
+
+    def _find(self, kind: str, name_or_id: str):
+        """
+        Returns a cached resource or looks it up. Resources that are not found are not cached, so they are looked up
+        again once they have been created.
+
+        Args:
+            kind (str): The kind of the resource, one of "flavor", "image", "network" and "security_group".
+            name_or_id (str): Name or id of the resource.
+
+        Returns:
+            The resource or None if it does not exist.
+        """
+        key = (kind, name_or_id)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+        resource = self._finders[kind](name_or_id)
+        if resource is not None:
+            with self._lock:
+                self._cache[key] = resource
+        logger.debug(f"Resolved {kind} {name_or_id}.")
+        return resource
+
+    def flavor(self, name_or_id: str):
+        """Returns the flavor with the given name or id, None if it does not exist."""
+        return self._find("flavor", name_or_id)
+
+    def image(self, name_or_id: str):
+        """Returns the image with the given name or id, None if it does not exist."""
+        return self._find("image", name_or_id)
+
+    def network(self, name_or_id: str):
+        """Returns the network with the given name or id, None if it does not exist."""
+        return self._find("network", name_or_id)
+
+    def security_group(self, name_or_id: str):
+        """Returns the security group with the given name or id, None if it does not exist."""
+        return self._find("security_group", name_or_id)
+
+    def invalidate(self, kind: str = None, name_or_id: str = None):
+        """
+        Removes resources from the cache, e.g. after a resource was deleted or recreated.
+
+        Args:
+            kind (str): The kind of the resources to remove, all kinds if None.
+            name_or_id (str): Name or id of the resource to remove, all resources of the kind if None.
+        """
+        with self._lock:
+            for key in list(self._cache):
+                if (kind is None or key[0] == kind) and (name_or_id is None or key[1] == name_or_id):
+                    del self._cache[key]
+
+
+_resolvers: "weakref.WeakKeyDictionary[Connection, ResourceResolver]" = weakref.WeakKeyDictionary()
+_resolvers_lock = threading.Lock()
+
+
+def get_resolver(conn: Connection) -> ResourceResolver:
+    """
+    Returns the resolver of a connection, creating it on first use. The cache lives as long as the connection.
+
+    Args:
+        conn (Connection): The OpenStack connection the lookups are made with.
+
+    Returns:
+        ResourceResolver: The resolver shared by all users of the connection.
+    """
+    with _resolvers_lock:
+        if conn not in _resolvers:
+            _resolvers[conn] = ResourceResolver(conn)
+        return _resolvers[conn]
@@ -0,0 +1,191 @@
+"""
+License: MIT
+
+Retry policy and rate limiting of all requests of an OpenStack connection. Transient responses (429, 503 with
+Retry-After and for idempotent methods also 409, 502, 503, 504 and connection failures) are retried with exponential
+backoff and full jitter, honouring Retry-After. A token bucket shared by all threads limits the request rate of the whole program, so many
+concurrent node workflows do not overload a shared cloud.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+from keystoneauth1 import exceptions as ks_exceptions
+from openstack.connection import Connection
+
+
+logger = logging.getLogger("logger")
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+@dataclass
+class RetryPolicy:
+    """Which failed requests are retried and how long to wait before the next attempt."""
+
+    max_retries: int = 6
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    # retried for all methods, the request was rejected before it was processed
+    always_retry: set[int] = field(default_factory=lambda: {429})
+    # retried for all methods if the response carries Retry-After, i.e. the service itself asks to repeat the request
+    retry_after_retry: set[int] = field(default_factory=lambda: {503})
+    # retried only for idempotent methods, the request might have been processed (a 503 of a proxy can arrive after
+    # Nova accepted the request)
+    idempotent_retry: set[int] = field(default_factory=lambda: {409, 502, 503, 504})
+
+    def retryable_status(self, method: str, status: int, response=None) -> bool:
+        """Checks if a request that received the given HTTP status (and response, if any) may be repeated."""
+        if status in self.always_retry:
+            return True
+        if status in self.retry_after_retry and get_retry_after(response) is not None:
+            return True
+        return method.upper() in IDEMPOTENT_METHODS and status in self.idempotent_retry
+
+    def should_retry(self, method: str, exception: Exception) -> bool:
+        """
+        Checks if a request that raised an exception may be repeated.
+
+        Args:
+            method (str): HTTP method of the request.
+            exception (Exception): The exception raised by the session.
+
+        Returns:
+            bool: True if the request should be repeated.
+        """
+        if isinstance(exception, ks_exceptions.HttpError):
+            return self.retryable_status(method, exception.http_status, getattr(exception, "response", None))
+        return method.upper() in IDEMPOTENT_METHODS and isinstance(exception, (ks_exceptions.ConnectFailure, ks_exceptions.RetriableConnectionFailure))
+
+    def delay(self, attempt: int, response=None) -> float:
+        """
+        Returns the time to wait before the next attempt: a random time up to the exponential backoff, at least the
+        time requested by a Retry-After header.
+
+        Args:
+            attempt (int): Number of the failed attempt, starting with 0.
+            response: The failed response, None if no response was received.
+
+        Returns:
+            float: Time to wait in seconds.
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = get_retry_after(response)
+        if retry_after is not None:
+            return min(max(backoff, retry_after), self.max_delay * 4)
+        return backoff
+
+
+def get_retry_after(response) -> float:
+    """
+    Reads the Retry-After header of a failed response.
+
+    Args:
+        response: The failed response, may be None.
+
+    Returns:
+        float: The requested waiting time in seconds, None if the header is missing or invalid.
+    """
+    headers = getattr(response, "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing rate requests per second on average and bursts of up to burst requests."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_limiter = TokenBucket(rate=20, burst=40)
+_policy = RetryPolicy()
+
+
+def configure(rate: float = None, burst: int = None, policy: RetryPolicy = None):
+    """
+    Changes the global request rate limit and retry policy, also for connections that are already set up.
+
+    Args:
+        rate (float): Average number of requests per second of the whole program.
+        burst (int): Number of requests that may be sent at once after a quiet period.
+        policy (RetryPolicy): The retry policy to use.
+    """
+    global _policy
+    with _limiter._lock:
+        if rate is not None:
+            _limiter.rate = rate
+        if burst is not None:
+            _limiter.burst = burst
+            _limiter.tokens = min(_limiter.tokens, burst)
+    if policy is not None:
+        _policy = policy
+
+
+def install(conn: Connection):
+    """
+    Wraps the request method of the session of a connection with rate limiting and retries. The number of retries
+    is attached to the response (or the final exception) as q8s_retries. Installing twice has no effect.
+
+    Args:
+        conn (Connection): The OpenStack connection.
+    """
+    session = conn.session
+    if getattr(session, "_q8s_retrying", False):
+        return
+    request = session.request
+
+    def retrying_request(url, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            _limiter.acquire()
+            try:
+                response = request(url, method, *args, **kwargs)
+            except Exception as exception:
+                if attempt >= _policy.max_retries or not _policy.should_retry(method, exception):
+                    exception.q8s_retries = attempt
+                    raise
+                reason = getattr(exception, "http_status", None) or type(exception).__name__
+                delay = _policy.delay(attempt, getattr(exception, "response", None))
+            else:
+                # openstacksdk requests without raising and checks the status afterwards
+                if attempt >= _policy.max_retries or not _policy.retryable_status(method, response.status_code, response):
+                    response.q8s_retries = attempt
+                    return response
+                reason = response.status_code
+                delay = _policy.delay(attempt, response)
+            logger.debug(f"{method} {url} failed with {reason}, retry {attempt + 1} in {delay:.1f}s.")
+            time.sleep(delay)
+            attempt += 1
+
+    session.request = retrying_request
+    session._q8s_retrying = True
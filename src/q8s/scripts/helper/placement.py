@@ -0,0 +1,124 @@
+"""
+License: MIT
+
+Placement of several emulated worker VMs on a shared OpenStack host. If worker_host_flavor is set in the cluster
+definition, the workers are packed onto hosts 'host-{number}' of that flavor with first-fit decreasing, according to
+the vCPUs, RAM and disk every VM needs (see flavor_planner.get_host_requirements). Every VM gets an additional fixed IP
+on the port of its host, which is forwarded to the VM like the IP of a host running a single VM.
+"""
+import logging
+import openstack
+from q8s.scripts.helper import exceptions, flavor_planner, openstack_resolver
+from q8s.scripts.helper.cluster_def import ClusterData, format_host_name, get_node_names, parse_worker_name
+
+
+logger = logging.getLogger("logger")
+
+
+def get_vm_demand(cluster_data: ClusterData, vm_name: str) -> flavor_planner.HostRequirements:
+    """Returns the resources a worker VM uses on a shared host, without the resources of the host itself."""
+    requirements = flavor_planner.get_host_requirements(cluster_data.vm_types.types[parse_worker_name(vm_name)[1]])
+    return flavor_planner.HostRequirements(requirements.vcpus, requirements.ram - flavor_planner.HOST_RAM_MB,
+                                           requirements.disk - flavor_planner.HOST_DISK_GB)
+
+
+def plan_placement(conn: openstack.connection.Connection, cluster_data: ClusterData, worker_names: list[str] = None) -> dict[str, list[str]]:
+    """
+    Packs the worker VMs onto as few hosts of worker_host_flavor as possible. The largest VMs are placed first, every
+    VM goes to the first host with enough free vCPUs, RAM and disk. The same configuration always results in the same
+    placement, so a resumed deployment finds its hosts again.
+
+    Args:
+        conn (openstack.connection.Connection): Valid openstack connection.
+        cluster_data (ClusterData): The cluster configuration with worker_host_flavor set.
+        worker_names (list[str]): Names of the worker VMs, defaults to all workers of the cluster configuration.
+
+    Returns:
+        dict[str, list[str]]: The names of the VMs by host name, hosts numbered from 1.
+
+    Raises:
+        Q8sFatalError: If the flavor does not exist or a single VM does not fit onto an empty host.
+    """
+    flavor_name = cluster_data.cluster_definition.worker_host_flavor
+    flavor = openstack_resolver.get_resolver(conn).flavor(flavor_name)
+    if flavor is None:
+        raise exceptions.Q8sFatalError(f"Flavor {flavor_name} does not exist.")
+    capacity = flavor_planner.HostRequirements(flavor.vcpus, flavor.ram - flavor_planner.HOST_RAM_MB,
+                                               flavor.disk - flavor_planner.HOST_DISK_GB)
+    if worker_names is None:
+        worker_names = get_node_names(cluster_data)[1]
+
+    demands = {name: get_vm_demand(cluster_data, name) for name in worker_names}
+    hosts = []
+    for name in sorted(worker_names, key=lambda n: (-demands[n].vcpus, -demands[n].ram, -demands[n].disk, parse_worker_name(n)[0])):
+        demand = demands[name]
+        if demand.vcpus > capacity.vcpus or demand.ram > capacity.ram or demand.disk > capacity.disk:
+            raise exceptions.Q8sFatalError(f"Worker {name} needs {demand.vcpus} vCPUs, {demand.ram} MB RAM and {demand.disk} GB disk, more than a host of flavor {flavor_name} offers.")
+        for free, vms in hosts:
+            if demand.vcpus <= free.vcpus and demand.ram <= free.ram and demand.disk <= free.disk:
+                break
+        else:
+            free, vms = flavor_planner.HostRequirements(capacity.vcpus, capacity.ram, capacity.disk), []
+            hosts.append((free, vms))
+        free.vcpus -= demand.vcpus
+        free.ram -= demand.ram
+        free.disk -= demand.disk
+        vms.append(name)
+
+    placement = {}
+    for number, (_, vms) in enumerate(hosts):
+        placement[format_host_name(number + 1)] = sorted(vms, key=lambda n: parse_worker_name(n)[0])
+    logger.debug(f"Placement of {len(worker_names)} workers on {len(placement)} hosts of flavor {flavor_name}: {placement}")
+    return placement
+
+
+def fits_quota(conn: openstack.connection.Connection, cluster_data: ClusterData, placement: dict[str, list[str]], plan: flavor_planner.FlavorPlan) -> bool:
+    """
+    Checks whether the master nodes and the hosts of a placement fit into the quota of the project.
+
+    Args:
+        conn (openstack.connection.Connection): Valid openstack connection.
+        cluster_data (ClusterData): The cluster configuration.
+        placement (dict[str, list[str]]): The placement created by plan_placement.
+        plan (flavor_planner.FlavorPlan): A flavor plan, providing the current usage and the limits of the quota.
+
+    Returns:
+        bool: True if the cluster fits into the quota.
+
+    Raises:
+        Q8sFatalError: If the master or host flavor does not exist.
+    """
+    cluster_def = cluster_data.cluster_definition
+    resolver = openstack_resolver.get_resolver(conn)
+    used = dict(plan.used_now)
+    for flavor_name, count in [(cluster_def.master_node_flavor, int(cluster_def.number_additional_master_nodes)), (cluster_def.worker_host_flavor, len(placement))]:
+        flavor = resolver.flavor(flavor_name)
+        if flavor is None:
+            raise exceptions.Q8sFatalError(f"Flavor {flavor_name} does not exist.")
+        used["instances"] += count
+        used["cores"] += count * flavor.vcpus
+        used["ram"] += count * flavor.ram
+        used["disk"] += count * flavor.disk
+    return flavor_planner.fits_quota(used, plan.limits)
+
+
+def format_placement(cluster_data: ClusterData, placement: dict[str, list[str]]) -> str:
+    """
+    Creates a table of the hosts, their VMs and the resources the VMs use.
+
+    Args:
+        cluster_data (ClusterData): The cluster configuration.
+        placement (dict[str, list[str]]): The placement created by plan_placement.
+
+    Returns:
+        str: The formatted placement.
+    """
+    output = f"{sum(len(vms) for vms in placement.values())} workers on {len(placement)} hosts of flavor {cluster_data.cluster_definition.worker_host_flavor}\n"
+    output = output + "{:<12s}{:>6s}{:>8s}{:>10s}{:>10s}  {:<s}".format("Host", "VMs", "vCPUs", "RAM", "Disk", "Workers") + "\n"
+    output = output + "-" * 72 + "\n"
+    for host, vms in placement.items():
+        demands = [get_vm_demand(cluster_data, vm) for vm in vms]
+        output = output + "{:<12s}{:>6d}{:>8d}{:>10d}{:>10d}  {:<s}".format(
+            host, len(vms), sum(d.vcpus for d in demands), sum(d.ram for d in demands), sum(d.disk for d in demands), ", ".join(vms)
+        ) + "\n"
+    return output
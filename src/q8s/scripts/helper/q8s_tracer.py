@@ -0,0 +1,226 @@
+"""
+License: MIT
+
+Span based timeline of a deployment. Spans are recorded per node and phase and can be exported as Chrome-trace
+JSON (viewable in chrome://tracing or https://ui.perfetto.dev) and summarized as a table naming the critical path.
+Should be used in every file as
+
+    "tracer = q8s_tracer.get_tracer()"
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import functools
+import json
+import logging
+from pathlib import Path
+import threading
+import time
+
+
+logger = logging.getLogger("logger")
+
+
+@dataclass
+class Span:
+    """A timed phase of the deployment, optionally belonging to a single node."""
+
+    name: str
+    start: float
+    end: float
+    node: str = ""
+    category: str = "phase"
+    args: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Tracer:
+    """Thread-safe collector of spans."""
+
+    def __init__(self):
+        self.origin = time.time()
+        self.spans: list[Span] = []
+        self.node_aliases: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def set_node_alias(self, alias: str, node: str):
+        """
+        Registers an alternative identifier for a node, e.g. its IP, so spans recorded with the IP are shown under the
+        name of the node.
+
+        Args:
+            alias (str): The alternative identifier, e.g. an IP address.
+            node (str): The name of the node.
+        """
+        with self._lock:
+            self.node_aliases[alias] = node
+
+    def add_span(self, name: str, start: float, end: float, node: str = "", category: str = "phase", **args) -> Span:
+        """
+        Records a span that has already finished.
+
+        Args:
+            name (str): Name of the phase, e.g. "sftp_put".
+            start (float): Start time as returned by time.time().
+            end (float): End time as returned by time.time().
+            node (str): Name or IP of the node the span belongs to, empty for cluster wide phases.
+            category (str): Category of the span, "stage" is used for the stages of the deployment graph.
+            **args: Additional information shown with the span.
+
+        Returns:
+            Span: The recorded span.
+        """
+        with self._lock:
+            span = Span(name, start, end, self.node_aliases.get(node, node), category, args)
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, node: str = "", category: str = "phase", **args):
+        """Context manager recording the time spent in its body as a span, also if the body raises."""
+        start = time.time()
+        try:
+            yield
+        except Exception as exception:
+            args["error"] = str(exception)
+            raise
+        finally:
+            self.add_span(name, start, time.time(), node, category, **args)
+
+    def traced(self, name: str, node_arg: str = None):
+        """
+        Decorator recording every call of a function as a span.
+
+        Args:
+            name (str): Name of the phase.
+            node_arg (str): Name of the keyword or first positional argument that identifies the node, e.g. "ip".
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                node = ""
+                if node_arg is not None:
+                    node = str(kwargs.get(node_arg, args[0] if args else ""))
+                with self.span(name, node):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def to_chrome_trace(self) -> dict:
+        """
+        Converts the spans to the Chrome trace event format, using one track per node.
+
+        Returns:
+            dict: The trace, ready to be dumped as JSON.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        tracks = {"controller": 0}
+        events = []
+        for span in sorted(spans, key=lambda s: s.start):
+            node = self.node_aliases.get(span.node, span.node) or "controller"
+            if node not in tracks:
+                tracks[node] = len(tracks)
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": int((span.start - self.origin) * 1e6),
+                "dur": int(span.duration * 1e6),
+                "pid": 1,
+                "tid": tracks[node],
+                "args": span.args,
+            })
+        for node, tid in tracks.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": node}})
+        events.append({"name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": "q8s deploy"}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path: Path):
+        """
+        Writes the spans as Chrome-trace/Perfetto JSON.
+
+        Args:
+            path (Path): The file to write the trace to.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome_trace(), f)
+        logger.info(f"Deployment trace written to {path}. Open it with https://ui.perfetto.dev or chrome://tracing.")
+
+    def critical_path(self) -> list[Span]:
+        """
+        Follows the stages of the deployment graph back from the stage that finished last, always to the dependency
+        that finished last, as that is the one the stage had to wait for.
+
+        Returns:
+            list[Span]: The stage spans on the critical path in execution order.
+        """
+        with self._lock:
+            stages = {s.name: s for s in self.spans if s.category == "stage"}
+        if not stages:
+            return []
+        path = [max(stages.values(), key=lambda s: s.end)]
+        while True:
+            deps = [stages[d] for d in path[-1].args.get("depends_on", []) if d in stages]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda s: s.end))
+        return list(reversed(path))
+
+    def summary(self) -> str:
+        """
+        Creates a table of all phases per VM type with count, mean and maximum duration, followed by the critical path.
+
+        Returns:
+            str: The formatted summary.
+        """
+        with self._lock:
+            spans = [s for s in self.spans if s.category != "stage"]
+        groups = {}
+        for span in spans:
+            groups.setdefault((span.name, vm_type_of(self.node_aliases.get(span.node, span.node))), []).append(span.duration)
+
+        dash = "-" * 76
+        output = "{:<28s}{:<16s}{:>8s}{:>12s}{:>12s}".format("Phase", "VM type", "Count", "Mean [s]", "Max [s]") + "\n"
+        output = output + dash + "\n"
+        for (name, vm_type), durations in sorted(groups.items(), key=lambda g: -max(g[1])):
+            output = output + "{:<28s}{:<16s}{:>8d}{:>12.1f}{:>12.1f}".format(
+                name, vm_type, len(durations), sum(durations) / len(durations), max(durations)
+            ) + "\n"
+
+        path = self.critical_path()
+        if path:
+            output = output + "\nCritical path ({:.1f}s):\n".format(path[-1].end - path[0].start)
+            for span in path:
+                output = output + "  {:<44s}{:>10.1f}s\n".format(span.name, span.duration)
+        return output
+
+
+def vm_type_of(node: str) -> str:
+    """
+    Derives the VM type from a node name.
+
+    Args:
+        node (str): Name of the node, e.g. "worker-1-x86-small", "vm-worker-1-x86-small" or "master-1".
+
+    Returns:
+        str: The VM type for workers, "master" for master nodes and "-" for cluster wide spans.
+    """
+    node = node.removeprefix("vm-")
+    if node.startswith("worker-"):
+        parts = node.split("-", maxsplit=2)
+        if len(parts) == 3:
+            return parts[2]
+    if node.startswith("master-"):
+        return "master"
+    return "-"
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """Returns the tracer shared by the whole program."""
+    return _tracer
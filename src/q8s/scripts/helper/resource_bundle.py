@@ -0,0 +1,124 @@
+"""
+License: MIT
+
+Resource bundles: all files a node role needs in /home/cloud/resources, packed into one compressed archive that is
+streamed over a single SSH channel and unpacked on the node. The files only appear in the resources directory after
+the whole archive was extracted, and a node that already has the exact content of a bundle (e.g. when resuming) is
+skipped without sending the archive.
+"""
+from dataclasses import dataclass
+import hashlib
+import io
+import logging
+from pathlib import Path
+import shlex
+import tarfile
+from q8s.scripts.helper import exceptions, q8s_tracer, ssh_pool
+
+
+logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
+
+RESOURCES_DIR = "/home/cloud/resources"
+
+
+@dataclass
+class ResourceBundle:
+    """A compressed archive of the files of a node role and the checksums of its content."""
+
+    role: str
+    data: bytes
+    checksums: str
+    digest: str
+
+    @property
+    def manifest_name(self) -> str:
+        """Name of the checksum file saved next to the unpacked files."""
+        return f".q8s-bundle-{self.role}.sha256"
+
+
+def build_bundle(role: str, files: dict[str, str]) -> ResourceBundle:
+    """
+    Packs files into a reproducible tar.gz archive, the same content always results in the same digest.
+
+    Args:
+        role (str): Name of the node role, e.g. "worker" or "master".
+        files (dict[str, str]): Local paths by their file names in the resources directory.
+
+    Returns:
+        ResourceBundle: The bundle, ready to be pushed to any number of nodes.
+    """
+    contents = {name: Path(path).read_bytes() for name, path in sorted(files.items())}
+    # same format as sha256sum, so the node can verify the files with 'sha256sum -c'
+    checksums = "".join(f"{hashlib.sha256(content).hexdigest()}  {name}\n" for name, content in contents.items())
+    digest = hashlib.sha256(checksums.encode("utf-8")).hexdigest()
+
+    bundle = ResourceBundle(role, b"", checksums, digest)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz", compresslevel=6) as archive:
+        for name, content in list(contents.items()) + [(bundle.manifest_name, checksums.encode("utf-8"))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            info.mtime = 0
+            archive.addfile(info, io.BytesIO(content))
+    bundle.data = buffer.getvalue()
+    return bundle
+
+
+def get_unpack_command(bundle: ResourceBundle, remote_dir: str) -> str:
+    """
+    Creates the remote command that prints UNCHANGED if the node already has the content of the bundle, otherwise
+    prints SEND, reads the archive from stdin into a staging directory and moves the files into remote_dir.
+    The checksum file is moved last, so an interrupted push is repeated.
+    """
+    directory = shlex.quote(remote_dir)
+    manifest = shlex.quote(f"{remote_dir}/{bundle.manifest_name}")
+    return (
+        f"set -e; mkdir -p {directory}; "
+        f"if [ \"$(cat {manifest} 2>/dev/null | sha256sum | cut -d' ' -f1)\" = {bundle.digest} ] "
+        f"&& (cd {directory} && sha256sum -c --status {manifest}); then echo UNCHANGED; exit 0; fi; "
+        "echo SEND; "
+        f"staging=$(mktemp -d {directory}/.q8s-bundle.XXXXXX); trap 'rm -rf \"$staging\"' EXIT; "
+        "tar -xzf - -C \"$staging\"; "
+        f"for f in \"$staging\"/*; do mv -f \"$f\" {directory}/; done; "
+        f"mv -f \"$staging\"/{bundle.manifest_name} {manifest}"
+    )
+
+
+def push_bundle(ip: str, bundle: ResourceBundle, remote_dir: str = RESOURCES_DIR, key_filepath: str = ssh_pool.DEFAULT_KEY_FILEPATH) -> bool:
+    """
+    Sends a bundle to a node over a single exec channel of the pooled SSH connection and unpacks it there.
+
+    Args:
+        ip (str): The IP address of the node.
+        bundle (ResourceBundle): The bundle to send.
+        remote_dir (str): The directory on the node the files are unpacked into.
+        key_filepath (str): The path to the SSH private key file (default is ~/.ssh/q8s-cluster).
+
+    Returns:
+        bool: True if the bundle was sent, False if the node already had its content.
+
+    Raises:
+        Q8sFatalError: If the node cannot be reached or unpacking fails.
+    """
+    with ssh_pool.get_ssh_pool().client(ip, key_filepath) as client:
+        with tracer.span("bundle_push", ip, role=bundle.role, bytes=len(bundle.data)):
+            channel = client.get_transport().open_session()
+            try:
+                channel.exec_command(get_unpack_command(bundle, remote_dir))
+                answer = channel.makefile("r").readline().strip()
+                if answer == "SEND":
+                    channel.sendall(bundle.data)
+                    channel.shutdown_write()
+                code = channel.recv_exit_status()
+                error = channel.makefile_stderr("r").read().strip() if code != 0 else ""
+            finally:
+                channel.close()
+    if code != 0 or answer not in ("SEND", "UNCHANGED"):
+        raise exceptions.Q8sFatalError(f"Could not unpack the {bundle.role} bundle on {ip} (exit code {code}): {error}")
+    if answer == "UNCHANGED":
+        logger.debug(f"Instance {ip} already has the {bundle.role} bundle {bundle.digest[:12]}, skipping it.")
+        return False
+    logger.debug(f"{bundle.role.capitalize()} bundle {bundle.digest[:12]} ({len(bundle.data)} bytes) unpacked on instance {ip}.")
+    return True
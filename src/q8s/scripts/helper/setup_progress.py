@@ -0,0 +1,111 @@
+"""
+License: MIT
+
+Live progress of the remote setups. The setup scripts print step markers ("Q8S-STEP <description>") which are picked
+up from the streamed output of every host, logged as soon as a host reaches a new step and recorded as spans.
+Should be used as
+
+    "progress = setup_progress.get_setup_progress()"
+"""
+from dataclasses import dataclass
+import logging
+import threading
+import time
+from q8s.scripts.helper import q8s_tracer
+
+
+logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
+
+STEP_MARKER = "Q8S-STEP "
+
+
+@dataclass
+class HostProgress:
+    """The current step of the setup of a single host."""
+
+    host: str
+    role: str
+    step: str
+    number: int
+    step_started: float
+    last_output: float
+    finished: bool = False
+
+
+class SetupProgress:
+    """Thread-safe tracker of the setup steps of all hosts."""
+
+    def __init__(self):
+        self.hosts: dict[str, HostProgress] = {}
+        self._lock = threading.Lock()
+
+    def start(self, host: str, role: str, step: str = "connecting"):
+        """Registers the start of the setup of a host."""
+        now = time.time()
+        with self._lock:
+            self.hosts[host] = HostProgress(host, role, step, 0, now, now)
+
+    def output(self, host: str, line: str):
+        """
+        Processes a line of output of a host, moving the host to the next step if the line is a step marker.
+
+        Args:
+            host (str): Name or IP of the host.
+            line (str): The line without line break.
+        """
+        now = time.time()
+        with self._lock:
+            progress = self.hosts[host]
+            progress.last_output = now
+            if not line.startswith(STEP_MARKER):
+                return
+            previous, started = progress.step, progress.step_started
+            step = line[len(STEP_MARKER):].strip()
+            progress.step = step
+            progress.number += 1
+            progress.step_started = now
+            number = progress.number
+        tracer.add_span(previous, started, now, host, category="step")
+        logger.info(f"[{host}] step {number}: {step} ({now - started:.0f}s for '{previous}')")
+
+    def finish(self, host: str):
+        """Marks the setup of a host as finished and records its last step."""
+        now = time.time()
+        with self._lock:
+            progress = self.hosts[host]
+            progress.finished = True
+            step, started = progress.step, progress.step_started
+        tracer.add_span(step, started, now, host, category="step")
+
+    def step(self, host: str) -> str:
+        """Returns the current step of a host."""
+        with self._lock:
+            return self.hosts[host].step
+
+    def summary(self) -> str:
+        """
+        Creates a table of all hosts whose setup is still running, slowest step first.
+
+        Returns:
+            str: The formatted table, empty if no setup is running.
+        """
+        now = time.time()
+        with self._lock:
+            running = sorted((p for p in self.hosts.values() if not p.finished), key=lambda p: p.step_started)
+        if not running:
+            return ""
+        output = "{:<24s}{:<8s}{:<40s}{:>12s}{:>14s}".format("Host", "Role", "Step", "In step [s]", "Silent [s]") + "\n"
+        output = output + "-" * 98 + "\n"
+        for p in running:
+            output = output + "{:<24s}{:<8s}{:<40s}{:>12.0f}{:>14.0f}".format(
+                p.host[:23], p.role[:7], f"{p.number}: {p.step}"[:39], now - p.step_started, now - p.last_output) + "\n"
+        return output
+
+
+_setup_progress = SetupProgress()
+
+
+def get_setup_progress() -> SetupProgress:
+    """Returns the setup progress shared by the whole program."""
+    return _setup_progress
@@ -0,0 +1,170 @@
+"""
+License: MIT
+
+Process-wide pool of authenticated SSH connections, one per host and key. SFTP sessions and commands of all stages
+are opened as channels on the pooled transport, so a host is connected and authenticated only once per deployment.
+Should be used as
+
+    "with ssh_pool.get_ssh_pool().client(ip) as client:"
+"""
+import atexit
+from contextlib import contextmanager
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+import threading
+import time
+import paramiko
+from q8s.scripts.helper import exceptions
+
+
+logger = logging.getLogger("logger")
+
+DEFAULT_KEY_FILEPATH = str(Path.home()) + ("/.ssh/q8s-cluster")
+
+
+@dataclass
+class PooledConnection:
+    """A connected SSH client and its usage."""
+
+    client: paramiko.SSHClient
+    last_used: float
+    users: int = 0
+
+
+class SSHConnectionPool:
+    """
+    Thread-safe pool of SSH connections keyed by host and key file. Connections are checked before they are handed
+    out and reconnected if the transport died, connections that were not used for idle_timeout seconds are closed.
+    """
+
+    def __init__(self, idle_timeout: int = 300, keepalive: int = 30):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._connections: dict[tuple[str, str], PooledConnection] = {}
+        self._host_locks: dict[tuple[str, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_healthy(client: paramiko.SSHClient) -> bool:
+        """Checks that the transport of a client is still connected and authenticated."""
+        transport = client.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, OSError, paramiko.SSHException):
+            return False
+        return True
+
+    def _acquire(self, ip: str, key_filepath: str) -> paramiko.SSHClient:
+        """Returns a healthy pooled client for a host, connecting if necessary, and marks it as used."""
+        key = (ip, key_filepath)
+        self.evict_idle()
+        with self._lock:
+            host_lock = self._host_locks.setdefault(key, threading.Lock())
+        # only one thread connects to a host, the others wait and reuse its connection
+        with host_lock:
+            with self._lock:
+                pooled = self._connections.get(key)
+            if pooled is not None and not self.is_healthy(pooled.client):
+                logger.debug(f"Pooled SSH connection to {ip} is broken, reconnecting.")
+                self._discard(key, pooled)
+                pooled = None
+            if pooled is None:
+                # imported here, helper_functions uses the pool itself
+                from q8s.scripts.helper import helper_functions
+                client = helper_functions.get_ssh_client(ip, key_filepath)
+                if client is None:
+                    raise exceptions.Q8sFatalError(f"Host {ip} cannot be reached via SSH.")
+                client.get_transport().set_keepalive(self.keepalive)
+                pooled = PooledConnection(client, time.time())
+                with self._lock:
+                    self._connections[key] = pooled
+            with self._lock:
+                pooled.users += 1
+                pooled.last_used = time.time()
+            return pooled.client
+
+    def _release(self, ip: str, key_filepath: str):
+        """Marks a client as no longer used by the caller."""
+        with self._lock:
+            pooled = self._connections.get((ip, key_filepath))
+            if pooled is not None:
+                pooled.users = max(0, pooled.users - 1)
+                pooled.last_used = time.time()
+
+    def _discard(self, key: tuple[str, str], pooled: PooledConnection):
+        """Removes a connection from the pool and closes it."""
+        with self._lock:
+            if self._connections.get(key) is pooled:
+                del self._connections[key]
+        pooled.client.close()
+
+    @contextmanager
+    def client(self, ip: str, key_filepath: str = DEFAULT_KEY_FILEPATH):
+        """
+        Context manager handing out the pooled SSH client of a host. The client must not be closed by the caller.
+
+        Args:
+            ip (str): The IP address of the host.
+            key_filepath (str): The path to the SSH private key file (default is ~/.ssh/q8s-cluster).
+
+        Raises:
+            Q8sFatalError: If the host cannot be reached via SSH.
+        """
+        client = self._acquire(ip, key_filepath)
+        try:
+            yield client
+        finally:
+            self._release(ip, key_filepath)
+
+    @contextmanager
+    def sftp(self, ip: str, key_filepath: str = DEFAULT_KEY_FILEPATH):
+        """
+        Context manager opening an SFTP session as a channel of the pooled connection of a host.
+
+        Args:
+            ip (str): The IP address of the host.
+            key_filepath (str): The path to the SSH private key file (default is ~/.ssh/q8s-cluster).
+
+        Raises:
+            Q8sFatalError: If the host cannot be reached via SSH.
+        """
+        with self.client(ip, key_filepath) as client:
+            sftp_client = client.open_sftp()
+            try:
+                yield sftp_client
+            finally:
+                sftp_client.close()
+
+    def evict_idle(self):
+        """Closes all connections that are not in use and were not used for idle_timeout seconds."""
+        now = time.time()
+        with self._lock:
+            idle = [(key, pooled) for key, pooled in self._connections.items()
+                    if pooled.users == 0 and now - pooled.last_used > self.idle_timeout]
+        for key, pooled in idle:
+            logger.debug(f"Closing idle SSH connection to {key[0]}.")
+            self._discard(key, pooled)
+
+    def close(self, ip: str = None):
+        """
+        Closes the connections to a host, e.g. before it reboots, or all connections.
+
+        Args:
+            ip (str): The IP address of the host, all hosts if None.
+        """
+        with self._lock:
+            closing = [(key, pooled) for key, pooled in self._connections.items() if ip is None or key[0] == ip]
+        for key, pooled in closing:
+            self._discard(key, pooled)
+
+
+_ssh_pool = SSHConnectionPool()
+atexit.register(_ssh_pool.close)
+
+
+def get_ssh_pool() -> SSHConnectionPool:
+    """Returns the SSH connection pool shared by the whole program."""
+    return _ssh_pool
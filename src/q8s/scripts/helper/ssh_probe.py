@@ -0,0 +1,73 @@
+"""
+License: MIT
+
+Asynchronous reachability probing of the SSH daemon of instances. A host counts as reachable as soon as a TCP
+connection to its SSH port is accepted and the server sends its SSH identification banner, so the setup can start
+the moment sshd is ready instead of after a fixed waiting time. Probes of many hosts share one event loop.
+"""
+import asyncio
+import logging
+import random
+import time
+
+
+logger = logging.getLogger("logger")
+
+SSH_PORT = 22
+
+
+async def probe_ssh(ip: str, port: int = SSH_PORT, connect_timeout: float = 3.0) -> bool:
+    """
+    Connects once to the SSH port of a host and reads its identification banner.
+
+    Args:
+        ip (str): The IP address of the host.
+        port (int): The SSH port (default is 22).
+        connect_timeout (float): Seconds to wait for the connection and the banner.
+
+    Returns:
+        bool: True if the host answered with an SSH banner, False otherwise.
+    """
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), connect_timeout)
+        banner = await asyncio.wait_for(reader.readline(), connect_timeout)
+        return banner.startswith(b"SSH-")
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def wait_for_ssh(ip: str, port: int = SSH_PORT, timeout: float = 600, initial_delay: float = 1.0,
+                       max_delay: float = 15.0, connect_timeout: float = 3.0) -> bool:
+    """
+    Probes the SSH port of a host with exponential backoff and jitter until it is ready or the deadline passed.
+
+    Args:
+        ip (str): The IP address of the host.
+        port (int): The SSH port (default is 22).
+        timeout (float): Seconds after which the host is given up.
+        initial_delay (float): Seconds to wait after the first failed probe, doubled after each further probe.
+        max_delay (float): Upper limit of the time between two probes.
+        connect_timeout (float): Seconds to wait for the connection and the banner of a single probe.
+
+    Returns:
+        bool: True if the host became reachable before the deadline, False otherwise.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    attempt = 0
+    while True:
+        attempt += 1
+        if await probe_ssh(ip, port, connect_timeout):
+            logger.debug(f"SSH on host {ip} is ready after {attempt} probes.")
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.debug(f"SSH on host {ip} not ready after {attempt} probes, giving up.")
+            return False
+        logger.debug(f"Waiting for SSH on host {ip}, probe {attempt} failed.")
+        await asyncio.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(max_delay, delay * 2)
@@ -8,86 +8,119 @@ from pathlib import Path
 import logging
 import time
 from q8s.scripts import helper
-from q8s.scripts.helper import helper_functions
+from q8s.scripts.helper import helper_functions, q8s_tracer, setup_progress
 import q8s.scripts.helper.exceptions as exceptions
 
 
 logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
 
 
-def init_host_setup(giturl: str, ip: str):
+def get_hostname_command(hostname: str) -> str:
+    """
+    Creates the commands setting the hostname of an instance. Instances spawned with a single multi-create request
+    boot with the hostname of the request, but the setup derives the VmType and the Kubernetes node name from it.
+    cloud-init is told to keep the hostname, so it survives reboots.
+
+    Args:
+        hostname (str): The name of the OpenStack instance.
+
+    Returns:
+        str: The shell commands, empty if no hostname is given.
+    """
+    if not hostname:
+        return ""
+    return (f"sudo hostnamectl set-hostname {hostname}; "
+            f"grep -q ' {hostname}$' /etc/hosts || echo '127.0.1.1 {hostname}' | sudo tee -a /etc/hosts > /dev/null; "
+            "echo 'preserve_hostname: true' | sudo tee /etc/cloud/cloud.cfg.d/99-q8s-hostname.cfg > /dev/null; ")
+
+
+def get_bootstrap_command(giturl: str, hostname: str = None) -> str:
+    """
+    Creates the commands preparing an instance for its setup script: waiting for cloud-init, setting the hostname
+    and installing Q8S. Each part prints a step marker for the setup progress. pipefail makes the exit code of the
+    setup script survive the tee into setup.log.
+
+    Args:
+        giturl (str): A URL that can be used to clone Q8S.
+        hostname (str): The name of the OpenStack instance.
+
+    Returns:
+        str: The shell commands, followed by the setup script.
+    """
+    # export  GNUTLS_CPUID_OVERRIDE=0x1 to make git clone work; see https://askubuntu.com/questions/1420966/method-https-has-died-unexpectedly-sub-process-https-received-signal-4-after
+    return (f"set -o pipefail; echo '{setup_progress.STEP_MARKER}Waiting for cloud-init'; cloud-init status --wait  > /dev/null 2>&1; "
+            f"{get_hostname_command(hostname)}export  GNUTLS_CPUID_OVERRIDE=0x1; cd ~; "
+            f"echo '{setup_progress.STEP_MARKER}Cloning Q8S'; sudo apt update; sudo apt install -y git; git clone {giturl}; cd ~/Q8S; "
+            f"echo '{setup_progress.STEP_MARKER}Installing Q8S'; sudo apt install -y python3-pip; pip install .; ")
+
+
+def init_host_setup(giturl: str, ip: str, hostname: str = None, check_reachable: bool = True):
     """
     Initializes a host setup on a remote server by executing a series of commands via SSH.
 
     Args:
         giturl (str): A URL that can be used to clone Q8S.
         ip (str): The IP address of the remote host to be set up.
+        hostname (str): The name of the OpenStack instance, set as hostname before the setup starts.
+        check_reachable (bool): Whether to wait for SSH first, not needed if the caller already waited for it
+            (e.g. the 'reachable:<node>' stage of a deployment).
 
     Returns:
         int: The exit code from the setup command execution. A return code of 0 indicates success.
 
     Raises:
-        exceptions.Q8sFatalError: If the host is unreachable or if the SSH client cannot be established.
+        exceptions.Q8sFatalError: If the host is unreachable, if the SSH client cannot be established or if the setup stops printing output.
     """
     PATH_TO_HOST_SETUP_SCRIPT = "~/Q8S/src/q8s/scripts/setup_host.sh"
-    # export  GNUTLS_CPUID_OVERRIDE=0x1 to make git clone work; see https://askubuntu.com/questions/1420966/method-https-has-died-unexpectedly-sub-process-https-received-signal-4-after
-    COMMAND = f"echo 'wait for cloud-init'; cloud-init status --wait  > /dev/null 2>&1; export  GNUTLS_CPUID_OVERRIDE=0x1; cd ~; sudo apt update; sudo apt install -y git; echo 'cloning git repo'; git clone {giturl}; cd ~/Q8S; sudo apt install -y python3-pip; pip install .; bash {PATH_TO_HOST_SETUP_SCRIPT} > /home/cloud/setup.log"
-
-    reachable = helper_functions.check_if_ip_is_reachable(ip)
-    if not(reachable):
-        print(f"Host with ip: {ip} not reachable for initialization. Aborting cluster creation.")
-        logger.debug(f"Host with ip: {ip} not reachable for initialization. Aborting cluster creation.")
-        raise exceptions.Q8sFatalError(f"Host with ip: {ip} not reachable for initialization. Aborting cluster creation.")
-    logger.debug(f"Host {ip} reachable with ping. Starting setup via ssh")
-    
-    client = helper_functions.get_ssh_client(ip)
-    
-    if client == None:
-        logger.debug(f"Host {ip} cannot be reached for setup via SSH.")
-        raise exceptions.Q8sFatalError(f"Host {ip} cannot be reached for setup via SSH.")
-
-    _, stdout, stderr = client.exec_command(COMMAND)
-    code = stdout.channel.recv_exit_status()
-    #mit print nicht parallel -> ohne? nicht getested, ansonsten das ganze in subprocesses verpacken
-    #print(f"\nSTDERR:\n{stderr.readlines()}\n\nSTDOUT:\n{stdout.readlines()}")
-
-    client.close()
+    COMMAND = f"{get_bootstrap_command(giturl, hostname)}bash {PATH_TO_HOST_SETUP_SCRIPT} 2>&1 | tee /home/cloud/setup.log"
+
+    if check_reachable:
+        reachable = helper_functions.check_if_ip_is_reachable(ip)
+        if not(reachable):
+            print(f"Host with ip: {ip} not reachable for initialization. Aborting cluster creation.")
+            logger.debug(f"Host with ip: {ip} not reachable for initialization. Aborting cluster creation.")
+            raise exceptions.Q8sFatalError(f"Host with ip: {ip} not reachable for initialization. Aborting cluster creation.")
+        logger.debug(f"Host {ip} reachable via SSH. Starting setup via ssh")
+
+    with tracer.span("setup_script", ip, role="host"):
+        code = helper_functions.stream_ssh_command(ip, COMMAND, hostname or ip, "host")
+
     logger.debug(f"Server {ip} setup return code: {code}. Should be 0.")
     return code
 
 
-def init_master_setup(giturl: str, ip: str) -> str:
+def init_master_setup(giturl: str, ip: str, hostname: str = None, check_reachable: bool = True) -> str:
     """
     Initializes the setup of a master node on a remote server by executing a series of commands via SSH.
 
     Args:
         giturl (str): A URL that can be used to clone Q8S.
         ip (str): The IP address of the master node to be set up.
+        hostname (str): The name of the OpenStack instance, set as hostname before the setup starts.
+        check_reachable (bool): Whether to wait for SSH first, not needed if the caller already waited for it
+            (e.g. the 'reachable:<node>' stage of a deployment).
 
     Returns:
         int: The exit code from the setup command execution. A return code of 0 indicates success.
 
     Raises:
-        exceptions.Q8sFatalError: If the master node is unreachable or if the SSH client cannot be established.
+        exceptions.Q8sFatalError: If the master node is unreachable, if the SSH client cannot be established or if the setup stops printing output.
     """
     PATH_TO_MASTER_SETUP_SCRIPT = "~/Q8S/src/q8s/scripts/setup_master.sh"
-    COMMAND = f"echo 'wait for cloud-init'; cloud-init status --wait  > /dev/null 2>&1; export  GNUTLS_CPUID_OVERRIDE=0x1; cd ~; sudo apt update; sudo apt install -y git; echo 'cloning git repo'; git clone {giturl}; cd ~/Q8S; sudo apt install -y python3-pip; pip install .; bash {PATH_TO_MASTER_SETUP_SCRIPT} > /home/cloud/setup.log"
-
-    reachable = helper_functions.check_if_ip_is_reachable(ip)
-    if not(reachable):
-        print(f"Master node with ip: {ip} not reachable for initialization. Aborting cluster creation.")
-        logger.debug(f"Master node with ip: {ip} not reachable for initialization. Aborting cluster creation.")
-        raise exceptions.Q8sFatalError(f"Master node with ip: {ip} not reachable for initialization. Aborting cluster creation.")
-    logger.debug(f"Master node {ip} reachable with ping. Starting setup via ssh")
-
-    client = helper_functions.get_ssh_client(ip)
-    if client == None:
-        raise exceptions.Q8sFatalError(f"Host {ip} cannot be reached for setup via SSH.")
-    
-    _, stdout, stderr = client.exec_command(COMMAND)
-    code = stdout.channel.recv_exit_status()
+    COMMAND = f"{get_bootstrap_command(giturl, hostname)}bash {PATH_TO_MASTER_SETUP_SCRIPT} 2>&1 | tee /home/cloud/setup.log"
+
+    if check_reachable:
+        reachable = helper_functions.check_if_ip_is_reachable(ip)
+        if not(reachable):
+            print(f"Master node with ip: {ip} not reachable for initialization. Aborting cluster creation.")
+            logger.debug(f"Master node with ip: {ip} not reachable for initialization. Aborting cluster creation.")
+            raise exceptions.Q8sFatalError(f"Master node with ip: {ip} not reachable for initialization. Aborting cluster creation.")
+        logger.debug(f"Master node {ip} reachable via SSH. Starting setup via ssh")
+
+    with tracer.span("setup_script", ip, role="master"):
+        code = helper_functions.stream_ssh_command(ip, COMMAND, hostname or ip, "master")
     logger.debug(f"Server {ip} setup return code: {code}. Should be 0.")
-    client.close()
     return code
 
 
@@ -1,26 +1,30 @@
 """
 :author: Vincent Hasse
 License: MIT
-installs new QEMU VM in libvirt based on config file
+installs the QEMU VMs of the host in libvirt based on config file and the list of VMs of the host
 """
 
 from itertools import takewhile
+import json
 import os
 from pathlib import Path
 import subprocess
 import socket
-from q8s.scripts.helper import exceptions
+from q8s.scripts.helper import exceptions, guest_image, image_cache
 from q8s.scripts.helper.cluster_def import VmType, load_cluster_data
-import urllib.request
 
-def write_virsh_command(path_to_cluster_data: str="/home/cloud/resources/cluster.yaml", path_to_keyfile: str="/home/cloud/resources/q8s-cluster.pub", path_to_join_command: str="/home/cloud/resources/join_command.txt"):
+def write_virsh_command(path_to_cluster_data: str="/home/cloud/resources/cluster.yaml", path_to_keyfile: str="/home/cloud/resources/q8s-cluster.pub", path_to_join_command: str="/home/cloud/resources/join_command.txt",
+                        path_to_image_cache_url: str="/home/cloud/resources/image_cache.txt", path_to_vm_list: str="/home/cloud/resources/vms.txt"):
     """
-    Downloads a cloud image, resizes it, creates necessary metadata, and generates a virsh command for VM setup.
+    Fetches the guest images from the image cache, and for every VM of the host creates an overlay disk on top of its image, the necessary metadata and a virsh command for VM setup.
+    The Kubernetes-ready image of an architecture is used if the master serves one, the cloud image otherwise, in which case the VM installs Kubernetes on first boot.
 
     Args:
         path_to_cluster_data (str): The path to the cluster data YAML file. Default is "/home/cloud/resources/cluster.yaml".
         path_to_keyfile (str): The path to the SSH public key file. Default is "/home/cloud/resources/q8s-cluster.pub".
         path_to_join_command (str): The path to the join command file. Default is "/home/cloud/resources/join_command.txt".
+        path_to_image_cache_url (str): The path to the file containing the URL of the image cache of the master. Default is "/home/cloud/resources/image_cache.txt".
+        path_to_vm_list (str): The path to the list of VMs of the host, see read_vm_list. Default is "/home/cloud/resources/vms.txt".
 
     Returns:
         None: The function does not return a value, but it performs several file operations.
@@ -32,39 +36,101 @@ def write_virsh_command(path_to_cluster_data: str="/home/cloud/resources/cluster
         print(f"Cannot find {path_to_cluster_data}!")
         return
     cluster_data = load_cluster_data(Path(path_to_cluster_data))
-    hostname = socket.gethostname()
-    vm_typename = hostname.split("-", maxsplit=2)[2]
-    vm_type = cluster_data.vm_types.types[vm_typename]
+    vms = read_vm_list(path_to_vm_list)
     ssh_key = open(path_to_keyfile, "r").read()
     join_command = open(path_to_join_command, "r").read().rstrip()
+    cache_url = None
+    if Path(path_to_image_cache_url).is_file():
+        cache_url = open(path_to_image_cache_url, "r").read().strip()
 
-    #download respective iso, resize, for arm create pflash images for boot
-    url = ""
-    if vm_type.architecture == "x86_64":
-        url = "https://cloud-images.ubuntu.com/jammy/current/jammy-server-cloudimg-amd64.img"
-    elif vm_type.architecture == "arm_64":
-        url = "https://cloud-images.ubuntu.com/jammy/current/jammy-server-cloudimg-arm64.img"
-    else:         
-        raise exceptions.Q8sFatalError(f"Unsupported architecture {vm_type.architecture}")
-    print(f"Downloading image from {url}...")
-    urllib.request.urlretrieve(url, "/home/cloud/resources/" + url.rsplit("/", maxsplit=1)[1])
-    
-    print(f"Resizing image...")
-    if vm_type.architecture == "x86_64":
-        subprocess.run(f"qemu-img resize /home/cloud/resources/jammy-server-cloudimg-amd64.img +{vm_type.storage}G", shell=True)
-    elif vm_type.architecture == "arm_64":
-        subprocess.run(f"qemu-img resize /home/cloud/resources/jammy-server-cloudimg-arm64.img +{vm_type.storage}G", shell=True)
-        create_arm_efi_and_nvram("/home/cloud/resources")
+    cached_images = {}
+    prebuilt = {}
+    for vm_name in vms:
+        vm_type = cluster_data.vm_types.types[vm_name.split("-", maxsplit=2)[2]]
+        #get respective image from the image cache of the master once per architecture, for arm create pflash images for boot
+        if vm_type.architecture not in cached_images:
+            image = guest_image.fetch_prebuilt_image(vm_type.architecture, cache_url) if cache_url else None
+            prebuilt[vm_type.architecture] = image is not None
+            if image is None:
+                image_name = image_cache.get_image_name(vm_type.architecture)
+                print(f"Fetching image {image_name} from {cache_url or image_cache.GUEST_IMAGE_BASE_URL}...")
+                image = image_cache.fetch_guest_image(vm_type.architecture, cache_url)
+            cached_images[vm_type.architecture] = image
+            print(f"Image verified: {image}{' (Kubernetes preinstalled)' if prebuilt[vm_type.architecture] else ''}")
+            if vm_type.architecture == "arm_64":
+                create_arm_efi_and_nvram("/home/cloud/resources")
+
+        print(f"Creating overlay disk of vm-{vm_name}...")
+        disk = f"/home/cloud/resources/{vm_name}.qcow2"
+        create_overlay_disk(cached_images[vm_type.architecture], Path(disk), vm_type.storage)
+
+        #create user and metadata, starting from the unmodified user-data for every VM
+        Path("/home/cloud/resources/user-data").unlink(missing_ok=True)
+        seed = f"{vm_name}-seed.img"
+        create_cloudimg_seed("/home/cloud/resources", ssh_key, f"vm-{vm_name}", join_command, seed, not prebuilt[vm_type.architecture])
+        print(f"{seed} created.")
+        #create command
+        command = create_virsh_command(f"vm-{vm_name}", vm_type, disk, f"/home/cloud/resources/{seed}")
+        with open(f"/home/cloud/resources/virsh-command-{vm_name}.txt", "w", encoding='utf-8') as f:
+            f.write(command)
+
+def read_vm_list(path_to_vm_list: str) -> list[str]:
+    """
+    Reads the names of the VMs to run on this host. Every line of the list contains the name of a VM, the IP it is
+    reached with and its IP in the libvirt network. A missing list is created for a single VM named like the host.
+
+    Args:
+        path_to_vm_list (str): The path to the list of VMs.
+
+    Returns:
+        list[str]: The names of the VMs in the format 'worker-{number}-{VmType}'.
+    """
+    if not Path(path_to_vm_list).is_file():
+        host_ip = get_host_ip()
+        digits = host_ip.split(".")[3]
+        with open(path_to_vm_list, "w", encoding='utf-8') as f:
+            f.write(f"{socket.gethostname()} {host_ip} 192.11.{digits}.{digits}\n")
+    with open(path_to_vm_list, "r", encoding='utf-8') as f:
+        return [line.split()[0] for line in f if line.strip()]
 
-    #create user and metadata
-    create_cloudimg_seed("/home/cloud/resources", ssh_key, f"vm-{hostname}", join_command)
-    print("seed.img created.")
-    #create command
-    command = create_virsh_command(f"vm-{hostname}",vm_type)
-    with open("/home/cloud/resources/virsh-command.txt", "w", encoding='utf-8') as f:
-        f.write(command)
+def get_host_ip() -> str:
+    """Returns the IP address of the outgoing network interface of the host."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(0)
+    try:
+        # doesn't have to be reachable
+        s.connect(('10.254.254.254', 1))
+        return s.getsockname()[0]
+    except Exception:
+        return '127.0.0.1'
+    finally:
+        s.close()
+
+def create_overlay_disk(base_image: Path, disk: Path, storage: int):
+    """
+    Creates the disk of a VM as a thin qcow2 overlay backed by a cloud image. The VM only writes to the overlay, so
+    the base image stays pristine, can be shared by VMs and the disk can be recreated from it at any time.
 
-def create_virsh_command(name: str, vm_type: VmType) -> str:
+    Args:
+        base_image (Path): The cached qcow2 cloud image, made read-only.
+        disk (Path): The path of the overlay disk, an existing disk is replaced.
+        storage (int): Storage in GB added to the virtual size of the base image.
+
+    Raises:
+        exceptions.Q8sFatalError: If the base image cannot be read or the overlay cannot be created.
+    """
+    info = subprocess.run(["qemu-img", "info", "--output=json", str(base_image)], capture_output=True, text=True)
+    if info.returncode != 0:
+        raise exceptions.Q8sFatalError(f"Cannot read base image {base_image}: {info.stderr}")
+    size = json.loads(info.stdout)["virtual-size"] + storage * 1024 ** 3
+    os.chmod(base_image, 0o444)
+    disk.unlink(missing_ok=True)
+    result = subprocess.run(["qemu-img", "create", "-f", "qcow2", "-F", "qcow2", "-b", str(base_image), str(disk), str(size)], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise exceptions.Q8sFatalError(f"Cannot create overlay disk {disk}: {result.stderr}")
+    print(f"Overlay disk {disk} created, backed by {base_image}, virtual size {size // 1024 ** 3}G.")
+
+def create_virsh_command(name: str, vm_type: VmType, disk: str, seed: str) -> str:
     """
     Generates a virsh command for creating a virtual machine with the specified configuration.
 
@@ -72,6 +138,8 @@ def create_virsh_command(name: str, vm_type: VmType) -> str:
         name (str): The name of the virtual machine.
         vm_type (VmType): An object containing the specifications of the virtual machine, 
                           including architecture, CPU model, number of CPUs, and RAM.
+        disk (str): The path of the overlay disk of the virtual machine.
+        seed (str): The path of the cloud-init seed image of the virtual machine.
 
     Returns:
         str: The constructed virsh command for creating the VM.
@@ -96,15 +164,15 @@ def create_virsh_command(name: str, vm_type: VmType) -> str:
         - The generated command can be executed in the terminal to set up the VM.
     """
     if vm_type.architecture == "x86_64":
-        virshCommand = f'sudo virt-install --connect qemu:///system --import --virt-type qemu --name={name} --os-variant=ubuntu22.04 --cpu {vm_type.cpu_model} --vcpus={vm_type.num_cpus} --ram={vm_type.ram} --disk path=/home/cloud/resources/jammy-server-cloudimg-amd64.img,format=qcow2 --disk=/home/cloud/resources/seed.img,device=cdrom --network bridge=virbr0 --noautoconsole'
+        virshCommand = f'sudo virt-install --connect qemu:///system --import --virt-type qemu --name={name} --os-variant=ubuntu22.04 --cpu {vm_type.cpu_model} --vcpus={vm_type.num_cpus} --ram={vm_type.ram} --disk path={disk},format=qcow2 --disk={seed},device=cdrom --network bridge=virbr0 --noautoconsole'
     elif vm_type.architecture == "arm_64":
-        virshCommand = f'sudo virt-install --connect qemu:///system --import --virt-type qemu --name={name} --os-variant=ubuntu22.04 --arch aarch64 --boot uefi,loader=/home/cloud/resources/efi.img,loader_type=pflash,nvram_template=/home/cloud/resources/flash1.img --cpu {vm_type.cpu_model} --vcpus={vm_type.num_cpus} --ram={vm_type.ram} --disk path=/home/cloud/resources/jammy-server-cloudimg-arm64.img,format=qcow2 --disk=/home/cloud/resources/seed.img,device=cdrom --network bridge=virbr0 --noautoconsole'
+        virshCommand = f'sudo virt-install --connect qemu:///system --import --virt-type qemu --name={name} --os-variant=ubuntu22.04 --arch aarch64 --boot uefi,loader=/home/cloud/resources/efi.img,loader_type=pflash,nvram_template=/home/cloud/resources/flash1.img --cpu {vm_type.cpu_model} --vcpus={vm_type.num_cpus} --ram={vm_type.ram} --disk path={disk},format=qcow2 --disk={seed},device=cdrom --network bridge=virbr0 --noautoconsole'
     else:
         raise exceptions.Q8sFatalError(f"Unsupported architecture {vm_type.architecture}")
     print(f"Virsh command created: {virshCommand}")
     return virshCommand
 
-def create_cloudimg_seed(path: str, public_key:str, vm_hostname: str, join_command: str):
+def create_cloudimg_seed(path: str, public_key:str, vm_hostname: str, join_command: str, seed_name: str = "seed.img", install_kubernetes: bool = True):
     """
     Creates a cloud-init seed image for an Ubuntu cloud image.
 
@@ -113,20 +181,23 @@ def create_cloudimg_seed(path: str, public_key:str, vm_hostname: str, join_comma
         public_key (str): The SSH public key to be injected into the VM for user access.
         vm_hostname (str): The hostname to be assigned to the virtual machine.
         join_command (str): The command to join the cluster, which will be included in the user data.
+        seed_name (str): The file name of the seed image. Default is "seed.img".
+        install_kubernetes (bool): Whether the VM installs Kubernetes on first boot, False for a Kubernetes-ready image.
     """
-    create_user_data(Path("/home/cloud/resources/user-data"), public_key, vm_hostname, join_command)
-    create_meta_data(path)
-    subprocess.run(f'cd {path}; cloud-localds seed.img user-data meta-data', shell=True)
+    create_user_data(Path("/home/cloud/resources/user-data"), public_key, vm_hostname, join_command, install_kubernetes)
+    create_meta_data(path, vm_hostname)
+    subprocess.run(f'cd {path}; cloud-localds {seed_name} user-data meta-data', shell=True)
 
-def create_user_data(existing_udata: Path, public_key: str, vm_hostname: str, join_command: str):
+def create_user_data(existing_udata: Path, public_key: str, vm_hostname: str, join_command: str, install_kubernetes: bool = True):
     """
-    Creates or modifies a user data file for cloud-init with SSH key and join command.
+    Creates or modifies a user data file for cloud-init with SSH key and join command, preceded by the installation of Kubernetes unless the image has it already.
 
     Args:
         existing_udata (Path): The path to the existing user data file.
         public_key (str): The SSH public key to be added to the user data for authentication.
         vm_hostname (str): The hostname to be assigned to the virtual machine.
         join_command (str): The command for the VM to join the cluster, which will be included in the user data.
+        install_kubernetes (bool): Whether install_kubernetes.sh is added to the user data and run before joining.
 
     Raises:
         exceptions.Q8sFatalError: If the base user data file cannot be found or accessed.
@@ -141,7 +212,6 @@ def create_user_data(existing_udata: Path, public_key: str, vm_hostname: str, jo
             with open(existing_udata, "r") as udata:
                 #add ssh-key to user-creation
                 insert_ssh = False
-                insert_runcmd = False
                 for l in udata.readlines():
                     if insert_ssh == True:
                         white = list(takewhile(str.isspace, l))
@@ -152,42 +222,43 @@ def create_user_data(existing_udata: Path, public_key: str, vm_hostname: str, jo
                     elif " name:" in l:
                         new.write(l)
                         insert_ssh = True             
-                    elif "runcmd:" in l:
-                        new.write(l)
-                        insert_runcmd = True
-                    elif insert_runcmd == True:
-                        white = list(takewhile(str.isspace, l))
-                        #first install kubernetes
-                        new.write(l)
-                        #then add join-command execution
-                        new.write("\n")
-                        new.write("".join(white) + "- " + str(join_command.split(" ")) + "\n")
-                        insert_runcmd = False
                     else: new.write(l)
 
+            if install_kubernetes:
+                #first install kubernetes
+                new.write("write_files:\n    - path: /run/scripts/install_kubernetes.sh\n      permissions: '0755'\n      content: |\n")
+                for l in guest_image.INSTALL_SCRIPT.read_text(encoding="utf-8").splitlines():
+                    new.write(f"        {l}\n")
+            new.write("runcmd:\n")
+            if install_kubernetes:
+                new.write('    - ["bash", "/run/scripts/install_kubernetes.sh"]\n')
+            #then add join-command execution
+            new.write("    - " + str(join_command.split(" ")) + "\n")
             new.write(f"\nhostname: '{vm_hostname}'")
     else: raise exceptions.Q8sFatalError("cannot find user-data base for VMs")
 
     os.rename(existing_udata, os.path.dirname(existing_udata) + "/user-data.bak")
     os.rename(str(Path.home())+"/resources/user-data_new", str(Path.home())+"/resources/user-data")
     
-def create_meta_data(path: str):
+def create_meta_data(path: str, vm_hostname: str = None):
     """
-    Creates an empty meta-data file for cloud-init to provide instance information.
+    Creates a meta-data file for cloud-init to provide instance information.
 
     Args:
         path (str): The directory path where the meta-data file will be created.
+        vm_hostname (str): The hostname of the virtual machine, used as instance id so that cloud-init configures a VM
+            booted from a prebuilt image as a new instance.
 
     Raises:
         OSError: If there is an error writing the meta-data file.
 
     Notes:
         - The generated meta-data file will be named `meta-data` and placed in the specified directory.
-        - The current implementation creates an empty file. Consider adding instance information as needed.
+        - Without a hostname an empty file is created.
     """
     data = open(f"{path + '/meta-data'}", "w")
-    #TODO ?
-
+    if vm_hostname:
+        data.write(f"instance-id: {vm_hostname}\nlocal-hostname: {vm_hostname}\n")
     data.close()
 
 def create_arm_efi_and_nvram(destination_path: str):
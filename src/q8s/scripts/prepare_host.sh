@@ -0,0 +1,30 @@
+#!bin/bash
+# Author: Vincent Hasse
+# License: MIT
+# installs the packages required on emulation hosts (QEMU, libvirt, cloud-image-utils), independent of the node
+# used by setup_host.sh and by 'q8s bake', which saves the prepared host as an image
+
+#otherwise there might be problems with apt update 
+sudo sh -c 'grep -q "^GNUTLS_CPUID_OVERRIDE" /etc/environment || echo "GNUTLS_CPUID_OVERRIDE=0x1" >> /etc/environment'
+
+sudo apt update
+echo -e "Installing packages\n"
+#automatically select default option in case of conflicts with configuration files 
+sudo apt upgrade -y -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold"
+
+sudo apt install -y net-tools dnsutils git cloud-image-utils
+
+#QEMU
+sudo apt install -y qemu-system-x86 qemu-system-aarch64 qemu-efi-aarch64 
+
+#libvirt
+echo -e "\nInstalling libvirt\n"
+sudo apt install -y libvirt-daemon-system virtinst
+sudo sed -i 's|#user = "root"|user = "root"|g' /etc/libvirt/qemu.conf 
+sudo sed -i 's|#group = "root"|group = "root"|g' /etc/libvirt/qemu.conf 
+sudo systemctl restart libvirtd
+#sudo adduser $USER libvirt --> not necessary as cloud is member of 'sudo'-group
+
+#marks the host as prepared, instances booted from a baked image skip this script
+sudo mkdir -p /etc/q8s
+sudo touch /etc/q8s/host-prepared
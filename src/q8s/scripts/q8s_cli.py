@@ -1,21 +1,20 @@
 import logging
 import sys
-from q8s.scripts import initialize_setups, install_guest
-from q8s.scripts.helper import helper_functions
-from q8s.scripts.helper import exceptions, openstack_communication
+from q8s.scripts.helper import exceptions, flavor_planner, openstack_communication, placement
 from q8s.scripts.helper.openstack_conn import create_and_test_openstack_connection, load_openstack_data
 from q8s.scripts.helper.cluster_def import load_cluster_data, ClusterDefinition, ClusterData
-from q8s.scripts.helper import kubernetes_helper
-from q8s.scripts import routing_master
+from q8s.scripts.deployment import Deployment, build_deploy_graph
+from q8s.scripts.scaling import Scaling, build_scale_graph, plan_scaling
+from q8s.scripts.bake import bake_host_image
+from q8s.scripts.helper.deploy_state import DEFAULT_STATE_FILE, DeployStateFile, check_cluster_data_file, create_deploy_state, get_cluster_data_digest, get_server_ids, load_deploy_state
+from q8s.scripts.helper import guest_image, image_cache, openstack_api_stats, openstack_retry, q8s_tracer
 from pathlib import Path
 import click
-import subprocess
-import multiprocessing
 from q8s.scripts.helper.q8s_logger import setup_logger
-import time
 
 
 logger = logging.getLogger("logger")
+tracer = q8s_tracer.get_tracer()
 
 
 @click.group()
@@ -37,7 +36,14 @@ def q8s_cli(verbose=False):
 @click.argument("openstack_conf_file", type=click.Path(path_type=Path), required=True)
 @click.argument("cluster_data_file", type=click.Path(path_type=Path), required=True)
 @click.option("-d", "--dry-run", is_flag=True, default=False, help="Start dry-run, no data will be written.")
-def deploy(openstack_conf_file: Path, cluster_data_file: Path, dry_run: bool) -> None:
+@click.option("-r", "--resume", is_flag=True, default=False, help="Resume a failed deployment, only failed stages and nodes are retried.")
+@click.option("-f", "--force", is_flag=True, default=False, help="Start a new deployment even if the state file of a previous deployment exists, its servers are no longer tracked.")
+@click.option("--state-file", type=click.Path(path_type=Path), default=DEFAULT_STATE_FILE, show_default=True, help="File in which the deployment state is saved.")
+@click.option("--trace-file", type=click.Path(path_type=Path), default=None, help="Write a Chrome-trace/Perfetto JSON timeline of the deployment to this file.")
+@click.option("-p", "--parallelism", type=click.IntRange(min=1), default=32, show_default=True, help="Maximum number of deployment stages (e.g. node setups) running at the same time.")
+@click.option("--api-report", type=click.Path(path_type=Path), default=None, help="Write every OpenStack API call of the deployment and per resource aggregates as JSON to this file.")
+@click.option("--api-rate", type=click.FloatRange(min=0.1), default=20, show_default=True, help="Maximum average number of OpenStack API requests per second.")
+def deploy(openstack_conf_file: Path, cluster_data_file: Path, dry_run: bool, resume: bool, force: bool, state_file: Path, trace_file: Path, parallelism: int, api_report: Path, api_rate: float) -> None:
     """:param name: openstack authentication file -> e.g. clouds.yaml from Openstack Dashboard with username and password fields added
     :param name: cluster definition file
     :return:
@@ -51,118 +57,253 @@ def deploy(openstack_conf_file: Path, cluster_data_file: Path, dry_run: bool) ->
             logger.info(f"Path to openstack_config_file is not valid: {openstack_conf_file.absolute}")
             raise exceptions.Q8sFatalError(f"Path to openstack_config_file is not valid: {openstack_conf_file.absolute}")   
         #openstack.enable_logging(debug=True)
+        openstack_retry.configure(rate=api_rate, burst=max(1, int(api_rate * 2)))
         conn = openstack_communication.create_openstack_connection_from_file(openstack_conf_file)
         cluster_data = load_cluster_data(cluster_data_file)
-        #resource calculation/checking
-        openstack_communication.calculate_free_resources(conn, cluster_data)
+        #flavor planning, resource calculation/checking
+        _, worker_placement = plan_host_flavors(conn, cluster_data)
+        openstack_communication.calculate_free_resources(conn, cluster_data, worker_placement)
         if dry_run:
             print("End of dry run.")
             logger.debug("End of dry run.")
             return
 
-        # launch all OpenstackInstances
-        servers = openstack_communication.spawn_openstack_instances(conn, cluster_data)
-        
-        #TODO:let it run in parallel
-        #automatically select default option in case of conflicts with configuration files 
-        subprocess.run("sudo apt upgrade -y -o Dpkg::Options::='--force-confdef' -o Dpkg::Options::='--force-confold'", shell=True)
-        logger.info("Installing kubernetes...")
-        result = subprocess.run("bash /home/cloud/Q8S/src/q8s/scripts/install-k8s.sh", capture_output=True, text=True, shell=True)
-        if result.returncode != 0:
-            logger.error(f"Could not install Kubernetes on the initializing instance. Stderr: {result.stderr}")
-            raise exceptions.Q8sFatalError(f"Could not install Kubernetes on the initializing instance. Stderr: {result.stderr}")
-        logger.info("Initializing kubernetes cluster...")
-        result = subprocess.run("bash /home/cloud/Q8S/src/q8s/scripts/setup-kube-ctl.sh", capture_output=True, text=True, shell=True)
-        if result.returncode != 0:
-            logger.error(f"Could not initialize Kubernetes Cluster. Stderr: {result.stderr}")
-            raise exceptions.Q8sFatalError(f"Could not initialize Kubernetes Cluster. Stderr: {result.stderr}")
-
-        # save IPs of worker and master instances
-        worker_nodes = {}
-        master_nodes = {}
-        for s in servers["worker"]:
-            worker_nodes[s.name] = s.addresses[conn.network.find_network(cluster_data.private_network_id).name][0]['addr']
-        for s in servers["master"]:
-            master_nodes[s.name] = s.addresses[conn.network.find_network(cluster_data.private_network_id).name][0]['addr']
-        logger.debug(f"Worker: {worker_nodes}\nMaster: {master_nodes}")
-        
-        #create routing rules 
-        logger.info("Creating routing rules.")
-        routing_master.create_master_routing(worker_nodes.values())
-        #make them persistent
-        subprocess.run("bash /home/cloud/Q8S/src/q8s/scripts/helper/make_master_routing_persistent.sh", shell=True)
-
-        logger.info("Sending cluster info to workers.")
-        helper_functions.send_file_via_sftp(worker_nodes.values(), str(cluster_data_file), "/home/cloud/resources/cluster.yaml")
-        helper_functions.send_file_via_sftp(worker_nodes.values(), "/home/cloud/.ssh/q8s-cluster.pub", "/home/cloud/resources/q8s-cluster.pub")
-        #different join command for workers and master nodes
-        helper_functions.send_file_via_sftp(worker_nodes.values(), "/home/cloud/resources/join_command_worker.txt", "/home/cloud/resources/join_command.txt")
-        helper_functions.send_file_via_sftp(master_nodes.values(), "/home/cloud/resources/join_command_master.txt", "/home/cloud/resources/join_command.txt")
-
-        #send worker_nodes to master nodes
-        with open("/home/cloud/resources/worker_ips.txt", "w", encoding='utf-8') as f:
-            f.write(str(list(worker_nodes.values())))
-        with open("/home/cloud/resources/master_ips.txt", "w", encoding='utf-8') as f:
-            f.write(str(list(master_nodes.values())))
-        helper_functions.send_file_via_sftp(master_nodes.values(), "/home/cloud/resources/worker_ips.txt", "/home/cloud/resources/worker_ips.txt")
-
-        #start host-setups in parallel
-        logger.debug(f"Starting init_host_setup for workers with servers: {worker_nodes}")
-        processes = []
-        for ip in worker_nodes.values():
-            processes.append(multiprocessing.Process(target=initialize_setups.init_host_setup, args=[cluster_data.git_url,ip,]))
-        for ip in master_nodes.values():
-            processes.append(multiprocessing.Process(target=initialize_setups.init_master_setup, args=[cluster_data.git_url, ip,]))
-        for p in processes:
-            p.start()
-        logger.info("Setups started. Waiting for callbacks... this might take some time (15+ min)")
-        #wait for setups to finish
-        for p in processes:
-            p.join()
-        #copy kube-config to master nodes
-        helper_functions.send_file_via_sftp(master_nodes.values(), "/home/cloud/.kube/config", "/home/cloud/.kube/config")
-        logger.info("Host setups finished. VMs booting. Waiting for nodes to join the cluster... This might take some time (30min+)")
-
-        cluster_nodes = {}
-        for k, v in master_nodes.items():
-            cluster_nodes[k] = v
-        for k, v in worker_nodes.items():
-            cluster_nodes["vm-"+str(k)] = v
-        all_joined = False
-        elapsed = 0
-        #wait for all nodes to join the cluster
-        while not all_joined:
-            time.sleep(60)
-            elapsed += 1
-            all_joined, missing_nodes, not_ready_nodes = kubernetes_helper.check_joined_nodes(set(cluster_nodes.keys()))
-            logger.debug(f"Waiting for nodes {missing_nodes} to join the cluster.")
-            if all_joined:
-                logger.info("All nodes have joined the cluster. Setting up networking.")
-                for name, ip in cluster_nodes.items():
-                    #annotate nodes for Flannel communication using public-ip
-                    annotations = {
-                        "flannel.alpha.coreos.com/public-ip": f"{ip}",
-                        "flannel.alpha.coreos.com/public-ip-overwrite": f"{ip}"
-                    }
-                    result = kubernetes_helper.annotate_node(name, annotations)
-                    if result:
-                        logger.debug(f"Node {name} annotated with {annotations}")
-                    else: logger.error(f"Node {name} could not be annotated. This will affect networking. Please annotate the node by hand with {annotations}.")
-                logger.debug("Restarting Flannel daemonset...")
-                result = subprocess.run("kubectl rollout restart daemonset kube-flannel-ds -n kube-flannel", capture_output=True, text=True, shell=True)
-                if result.returncode != 0:
-                    logger.warning(f"Could not restart Flannel daemonset. Please check, if cluster communication works. Try restarting it by executing 'kubectl rollout restart daemonset kube-flannel-ds -n kube-flannel'.\nSdterr: {result.stderr}")
-            elif elapsed > 40:
-                logger.info(f"{elapsed} minutes have passed since the setup for the VMs has been initialized. Nodes {missing_nodes} are missing. There may be something wrong. You can check the VM status by opening a new console, SSH to the host and run 'sudo virsh list'. It should list the VM as started. For further information you can open a console with 'sudo virsh console <vm-name>'.")
-        if len(not_ready_nodes) > 0:
-            logger.info(f"Nodes {not_ready_nodes} are not showing 'Ready' state. Check if the problem persists after ~1min using 'kubectl get nodes'. I it does persist you can use 'kubectl describe node <node-name>' to get more information about the node's state.")
+        if resume:
+            state = load_deploy_state(state_file, required=True)
+            check_cluster_data_file(state, cluster_data_file)
+        else:
+            if state_file.is_file():
+                if not force:
+                    raise exceptions.Q8sFatalError(f"The state file {state_file} of a previous deployment exists. Run with --resume to continue it, "
+                                                   f"'q8s destroy' to delete its servers or --force to start a new deployment anyway.")
+                logger.warning(f"Overwriting deployment state {state_file} of a previous deployment, its servers are no longer tracked.")
+            state = create_deploy_state(cluster_data_file)
+        deploy_state = DeployStateFile(state_file, state)
+        deploy_state.save()
+
+        # spawn instances, install the initial master, push files and run host setups as a graph of stages
+        deployment = Deployment(conn, cluster_data, cluster_data_file, deploy_state, worker_placement=worker_placement)
+        completed = deployment.prepare_resume() if resume else set()
+        graph = build_deploy_graph(deployment)
+        logger.info("Deployment started. Setups run in parallel once their instances are ready... this might take some time (15+ min)")
+        try:
+            graph.run(parallelism, completed=completed, on_stage_completed=deploy_state.mark_stage_completed)
+        finally:
+            deployment.stop_image_cache()
+            report_timeline(trace_file)
+            report_api_calls(api_report)
 
     except exceptions.Q8sFatalError as exception:
         print(exception)
-        print("Exiting application - no cleanup yet!")
+        print(f"Exiting application - no cleanup yet! Run the same command with --resume to retry only the failed stages (state saved in {state_file}).")
         logger.critical("exiting application - no cleanup yet!")
         logger.critical(exception)
         sys.exit(1)
         
     logger.info("Q8S setup finished. You can check the nodes of the cluster using 'kubectl get nodes'.")
 
+
+
+@q8s_cli.command(name="scale",
+                 short_help="Add or remove emulated workers of a running cluster according to the changed cluster_config file.")
+@click.argument("openstack_conf_file", type=click.Path(path_type=Path), required=True)
+@click.argument("cluster_data_file", type=click.Path(path_type=Path), required=True)
+@click.option("-d", "--dry-run", is_flag=True, default=False, help="Only show which workers would be added and removed.")
+@click.option("-y", "--yes", is_flag=True, default=False, help="Remove workers without asking for confirmation.")
+@click.option("--state-file", type=click.Path(path_type=Path), default=DEFAULT_STATE_FILE, show_default=True, help="File in which the deployment state is saved.")
+@click.option("-p", "--parallelism", type=click.IntRange(min=1), default=32, show_default=True, help="Maximum number of stages (e.g. node setups) running at the same time.")
+def scale(openstack_conf_file: Path, cluster_data_file: Path, dry_run: bool, yes: bool, state_file: Path, parallelism: int) -> None:
+    """:param name: openstack authentication file -> e.g. clouds.yaml from Openstack Dashboard with username and password fields added
+    :param name: cluster definition file with the new number of workers
+    :return:
+    """
+    logger.debug(f"Cluster scaling started with files: OpenstackAuthentication: {openstack_conf_file}, ClusterDefinition: {cluster_data_file}")
+    try:
+        conn = openstack_communication.create_openstack_connection_from_file(openstack_conf_file)
+        cluster_data = load_cluster_data(cluster_data_file)
+        if cluster_data.cluster_definition.worker_host_flavor:
+            raise exceptions.Q8sFatalError("Scaling a cluster whose workers share hosts (worker_host_flavor) is not supported.")
+        plan_host_flavors(conn, cluster_data)
+        deploy_state = DeployStateFile(state_file, load_deploy_state(state_file))
+        servers = openstack_communication.list_cluster_servers(conn, cluster_data, get_server_ids(deploy_state.state))
+        to_add, to_remove = plan_scaling(cluster_data, [n for n in servers if not n.startswith("master-")])
+        logger.info(f"Workers to add: {to_add or 'none'}. Workers to remove: {to_remove or 'none'}.")
+        if dry_run or (not to_add and not to_remove):
+            return
+        if to_remove and not yes:
+            click.confirm(f"Drain and delete workers {to_remove}?", abort=True)
+
+        scaling = Scaling(conn, cluster_data, cluster_data_file, deploy_state, servers, to_add, to_remove)
+        graph = build_scale_graph(scaling)
+        try:
+            graph.run(parallelism)
+        finally:
+            scaling.stop_image_cache()
+            report_timeline()
+        # the state now describes the scaled cluster, so a later 'deploy --resume' uses the changed definition
+        with deploy_state.update() as state:
+            state.cluster_data_file = str(cluster_data_file)
+            state.cluster_data_digest = get_cluster_data_digest(cluster_data_file)
+    except exceptions.Q8sFatalError as exception:
+        print(exception)
+        logger.critical(exception)
+        sys.exit(1)
+
+    logger.info("Q8S scaling finished. You can check the nodes of the cluster using 'kubectl get nodes'.")
+
+
+
+@q8s_cli.command(name="plan",
+                 short_help="Show the flavors chosen for the emulation hosts and the projected quota headroom.")
+@click.argument("openstack_conf_file", type=click.Path(path_type=Path), required=True)
+@click.argument("cluster_data_file", type=click.Path(path_type=Path), required=True)
+def plan(openstack_conf_file: Path, cluster_data_file: Path) -> None:
+    """:param name: openstack authentication file -> e.g. clouds.yaml from Openstack Dashboard with username and password fields added
+    :param name: cluster definition file, VmTypes with an empty openstack_flavor are planned
+    :return:
+    """
+    try:
+        conn = openstack_communication.create_openstack_connection_from_file(openstack_conf_file)
+        cluster_data = load_cluster_data(cluster_data_file)
+        fits, _ = plan_host_flavors(conn, cluster_data)
+        if not fits:
+            sys.exit(1)
+    except exceptions.Q8sFatalError as exception:
+        print(exception)
+        logger.critical(exception)
+        sys.exit(1)
+
+
+
+@q8s_cli.command(name="bake",
+                 short_help="Create a host image with QEMU, libvirt and Kubernetes preinstalled, used by following deployments.")
+@click.argument("openstack_conf_file", type=click.Path(path_type=Path), required=True)
+@click.argument("cluster_data_file", type=click.Path(path_type=Path), required=True)
+@click.option("-f", "--force", is_flag=True, default=False, help="Create the image even if it already exists for the current setup scripts.")
+def bake(openstack_conf_file: Path, cluster_data_file: Path, force: bool) -> None:
+    """:param name: openstack authentication file -> e.g. clouds.yaml from Openstack Dashboard with username and password fields added
+    :param name: cluster definition file
+    :return:
+    """
+    try:
+        conn = openstack_communication.create_openstack_connection_from_file(openstack_conf_file)
+        cluster_data = load_cluster_data(cluster_data_file)
+        bake_host_image(conn, cluster_data, force)
+    except exceptions.Q8sFatalError as exception:
+        print(exception)
+        logger.critical(exception)
+        sys.exit(1)
+
+
+
+@q8s_cli.command(name="bake-guest",
+                 short_help="Build guest images with containerd and Kubernetes preinstalled for the architectures of the workers, served by following deployments.")
+@click.argument("cluster_data_file", type=click.Path(path_type=Path), required=True)
+@click.option("-f", "--force", is_flag=True, default=False, help="Build the images even if they exist for the current install script.")
+def bake_guest(cluster_data_file: Path, force: bool) -> None:
+    """:param name: cluster definition file, images are built for the architectures of its workers
+    :return:
+    """
+    try:
+        cluster_data = load_cluster_data(cluster_data_file)
+        architectures = {cluster_data.vm_types.types[t].architecture for t in cluster_data.cluster_definition.worker}
+        cached = image_cache.cache_images(architectures)
+        for architecture in sorted(architectures):
+            digest = cached.get(image_cache.get_image_name(architecture))
+            if digest is None:
+                raise exceptions.Q8sFatalError(f"The cloud image for architecture {architecture} is not cached, cannot build its guest image.")
+            guest_image.build_guest_image(architecture, Path(image_cache.CACHE_DIR) / f"{digest}.img", digest, force=force)
+    except exceptions.Q8sFatalError as exception:
+        print(exception)
+        logger.critical(exception)
+        sys.exit(1)
+
+    logger.info("Guest images built, following deployments boot the workers from them.")
+
+
+
+@q8s_cli.command(name="destroy",
+                 short_help="Delete all OpenStack instances, the security group and the keypair of the cluster.")
+@click.argument("openstack_conf_file", type=click.Path(path_type=Path), required=True)
+@click.argument("cluster_data_file", type=click.Path(path_type=Path), required=True)
+@click.option("-p", "--parallelism", type=click.IntRange(min=1), default=10, show_default=True, help="Maximum number of servers deleted at the same time.")
+@click.option("-y", "--yes", is_flag=True, default=False, help="Delete without asking for confirmation.")
+@click.option("--state-file", type=click.Path(path_type=Path), default=DEFAULT_STATE_FILE, show_default=True, help="File in which the deployment state is saved, removed after teardown.")
+@click.option("--match-names", is_flag=True, default=False, help="Also delete untagged servers named like cluster instances (master-N, worker-N-*, host-N, q8s-batch-*), after confirmation.")
+def destroy(openstack_conf_file: Path, cluster_data_file: Path, parallelism: int, yes: bool, state_file: Path, match_names: bool) -> None:
+    """:param name: openstack authentication file -> e.g. clouds.yaml from Openstack Dashboard with username and password fields added
+    :param name: cluster definition file
+    :return:
+    """
+    try:
+        conn = openstack_communication.create_openstack_connection_from_file(openstack_conf_file)
+        cluster_data = load_cluster_data(cluster_data_file)
+        # servers are found by the metadata they are tagged with and the IDs in the state, never by name alone
+        servers = openstack_communication.list_cluster_servers(conn, cluster_data, get_server_ids(load_deploy_state(state_file)))
+        if match_names:
+            untagged = openstack_communication.list_servers_by_name(conn, servers)
+            if untagged:
+                click.confirm(f"Servers {sorted(untagged)} are not tagged as part of the cluster but named like its instances. "
+                              f"Delete them as well? They might belong to other users of the project.", abort=True)
+                servers.update(untagged)
+        if not yes:
+            click.confirm(f"Delete the {len(servers)} instances {sorted(servers)}, the security group and the keypair of the q8s-cluster?", abort=True)
+        if not openstack_communication.destroy_cluster(conn, cluster_data, servers, parallelism):
+            raise exceptions.Q8sFatalError("Not all resources of the cluster could be deleted, please check the log and run destroy again.")
+        state_file.unlink(missing_ok=True)
+    except exceptions.Q8sFatalError as exception:
+        print(exception)
+        logger.critical(exception)
+        sys.exit(1)
+
+    logger.info("Q8S cluster destroyed.")
+
+
+def plan_host_flavors(conn, cluster_data: ClusterData) -> tuple[bool, dict[str, list[str]]]:
+    """
+    Chooses the flavors of all VmTypes without an openstack_flavor, sets them in the cluster data and shows the plan.
+    If the workers are packed onto hosts of worker_host_flavor, the placement of the workers is shown as well.
+
+    Args:
+        conn (openstack.connection.Connection): Valid openstack connection.
+        cluster_data (ClusterData): The cluster configuration, changed in place.
+
+    Returns:
+        tuple[bool, dict[str, list[str]]]: True if the cluster fits into the quota of the project, and the workers by
+            the host they are packed onto (None unless worker_host_flavor is set).
+    """
+    flavor_plan = flavor_planner.plan_flavors(conn, cluster_data)
+    flavor_planner.apply_flavor_plan(cluster_data, flavor_plan)
+    print(flavor_planner.format_flavor_plan(flavor_plan))
+    logger.debug(f"Flavor plan:\n{flavor_planner.format_flavor_plan(flavor_plan)}")
+    if cluster_data.cluster_definition.worker_host_flavor:
+        worker_placement = placement.plan_placement(conn, cluster_data)
+        print(placement.format_placement(cluster_data, worker_placement))
+        logger.debug(f"Placement:\n{placement.format_placement(cluster_data, worker_placement)}")
+        return placement.fits_quota(conn, cluster_data, worker_placement, flavor_plan), worker_placement
+    return flavor_plan.fits, None
+
+
+def report_api_calls(report_file: Path = None):
+    """
+    Logs the most frequent and slowest OpenStack API calls and optionally exports all calls as JSON.
+
+    Args:
+        report_file (Path): File to write the report to, no report is written if None.
+    """
+    api_stats = openstack_api_stats.get_api_stats()
+    logger.info(f"OpenStack API calls:\n{api_stats.summary()}")
+    if report_file is not None:
+        api_stats.export_json(report_file)
+
+
+def report_timeline(trace_file: Path = None):
+    """
+    Logs the summary of the deployment timeline and optionally exports it as Chrome-trace JSON.
+
+    Args:
+        trace_file (Path): File to write the trace to, no trace is written if None.
+    """
+    logger.info(f"Deployment timeline:\n{tracer.summary()}")
+    if trace_file is not None:
+        tracer.export_chrome_trace(trace_file)
@@ -23,33 +23,107 @@ def get_ip():
         s.close()
     return IP
 
+def rule_exists(command: str) -> bool:
+    """
+    Checks if the iptables rule added by the given command is already present.
+
+    Args:
+        command (str): An iptables command appending (-A) or inserting (-I <chain> <position>) a rule.
+
+    Returns:
+        bool: True if the rule exists, False otherwise.
+    """
+    parts = command.split()
+    if "-A" in parts:
+        i = parts.index("-A")
+        parts[i] = "-C"
+    elif "-I" in parts:
+        i = parts.index("-I")
+        parts[i] = "-C"
+        if parts[i + 2].isdigit():
+            del parts[i + 2]
+    return subprocess.run(parts, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def get_vm_ip(host_ip: str, address: str = None) -> str:
+    """
+    Returns the IP of an emulated VM in the libvirt network of its host: 192.11.<host>.<address>, where <host> are the
+    last digits of the IP of the host instance and <address> those of the IP the VM is reached with.
+
+    Args:
+        host_ip (str): IP address of the worker instance.
+        address (str): The IP the VM is reached with, the IP of the instance if None.
+    """
+    address = address or host_ip
+    return f"192.11.{host_ip.split('.')[3]}.{address.split('.')[3]}"
+
+
+def get_dnat_command(ip: str, action: str = "-A") -> str:
+    """
+    Creates the iptables command that redirects traffic for the VM on a worker to the worker instance.
+
+    Args:
+        ip (str): IP address of the worker instance, or 'vm_ip=ip' for a VM reached via an additional IP of its host.
+        action (str): "-A" to add the rule, "-D" to delete it.
+
+    Returns:
+        str: The iptables command.
+    """
+    if "=" in ip:
+        vm_ip, ip = ip.split("=", maxsplit=1)
+    else:
+        vm_ip = get_vm_ip(ip)
+    return f"sudo iptables -t nat {action} OUTPUT -d {vm_ip} -j DNAT --to-destination {ip}"
+
+
 def create_master_routing(worker_ips):
     """
-    Configures routing on the master node to direct traffic to worker nodes.
+    Configures routing on the master node to direct traffic to worker nodes. Rules that already exist are not added
+    again, so the function can be called repeatedly with a growing list of workers.
 
     Args:
-        worker_ips (list): A list of IP addresses for the worker nodes.
+        worker_ips (list): A list of IP addresses for the worker nodes, see get_dnat_command.
 
     Raises:
         subprocess.CalledProcessError: If any of the iptables commands fail.
     """
     INTERFACE_NAME = "ens3"
-    MASTER_IP = get_ip()
     commands = []
     commands.append(f"sudo iptables -I FORWARD 1 -o {INTERFACE_NAME} -m state --state NEW,RELATED,ESTABLISHED -j ACCEPT")
     for ip in worker_ips:
-        ip_last = ip.split(".")[3]
-        commands.append(f"sudo iptables -t nat -A OUTPUT -d 192.11.{ip_last}.{ip_last} -j DNAT --to-destination {ip}")
+        commands.append(get_dnat_command(ip))
     
     #execute commands and save them for traceability
     f= open("master_routing_commands.txt", "w")
     for c in commands:
         f.write(c+"\n")
-        subprocess.run(c.split())
+        if not rule_exists(c):
+            subprocess.run(c.split())
     f.close()
     print("Changes applied to iptables!")
 
 
+def remove_master_routing(worker_ips):
+    """
+    Removes the routing rules of worker nodes that are no longer part of the cluster.
+
+    Args:
+        worker_ips (list): A list of IP addresses of the removed worker nodes.
+    """
+    for ip in worker_ips:
+        command = get_dnat_command(ip)
+        if rule_exists(command):
+            subprocess.run(get_dnat_command(ip, "-D").split())
+    print("Routing rules removed from iptables!")
+
+
+def parse_ips(argument: str) -> list[str]:
+    """Parses a list of IPs written with str(list), as in worker_ips.txt."""
+    ips = argument.replace(" ", "").replace("[", "").replace("]", "").replace("'", "").split(",")
+    return [ip for ip in ips if ip]
+
+
 if __name__ == "__main__":
-    ips = sys.argv[1].replace(" ", "").replace("[", "").replace("]", "").replace("'", "").split(",")
-    create_master_routing(ips)
\ No newline at end of file
+    create_master_routing(parse_ips(sys.argv[1]))
+    if len(sys.argv) > 2:
+        remove_master_routing(parse_ips(sys.argv[2]))
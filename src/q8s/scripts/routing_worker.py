@@ -28,19 +28,35 @@ def get_ip():
         s.close()
     return IP
 
+def read_vms(path: str = "/home/cloud/resources/vms.txt") -> list[tuple[str, str, str]]:
+    """
+    Reads the VMs of the host, a single VM reached via the IP of the host if the list does not exist.
+
+    Returns:
+        list: Name, IP the VM is reached with and IP in the libvirt network of every VM.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return [tuple(line.split()) for line in f if line.strip()]
+    except FileNotFoundError:
+        return [(socket.gethostname(), HOST_IP, "192.11." + HOST_IP.split(".")[3] + "." + HOST_IP.split(".")[3])]
+
 HOST_IP = get_ip()
-VM_IP = "192.11." + HOST_IP.split(".")[3] + "." + HOST_IP.split(".")[3]
 INTERFACE_NAME = "ens3"
 
 commands = [f"sudo iptables -I FORWARD 1 -o virbr0 -d 192.11.{HOST_IP.split('.')[3]}.0/24 -m state --state NEW,RELATED,ESTABLISHED -j ACCEPT"]
-#forward host port 2222 to vm ssh port 22
-commands.append(f"sudo iptables -t nat -A PREROUTING -p tcp -i {INTERFACE_NAME} -d {HOST_IP} --dport 2222 -j DNAT --to-destination {VM_IP}:22")
-#reroute everything but ports 22 and 2222 to VM
-commands.append(f"sudo iptables -t nat -A PREROUTING -p tcp -m multiport ! --dports 22,2222 -i {INTERFACE_NAME} -d {HOST_IP} -j DNAT --to-destination {VM_IP}")
-commands.append(f"sudo iptables -t nat -A PREROUTING -p udp -m multiport ! --dports 22,2222 -i {INTERFACE_NAME} -d {HOST_IP} -j DNAT --to-destination {VM_IP}")
-
-#SNAT source of outgoing packets
-commands.append(f"sudo iptables -t nat -I POSTROUTING 1 -s {VM_IP} -j SNAT --to-source {HOST_IP}")
+for name, address, vm_ip in read_vms():
+    #additional IPs of a host running several VMs are not configured by DHCP
+    if address != HOST_IP and f"inet {address}/" not in subprocess.run(["ip", "-4", "addr", "show", "dev", INTERFACE_NAME], capture_output=True, text=True).stdout:
+        commands.append(f"sudo ip addr add {address}/32 dev {INTERFACE_NAME}")
+    #forward port 2222 to vm ssh port 22
+    commands.append(f"sudo iptables -t nat -A PREROUTING -p tcp -i {INTERFACE_NAME} -d {address} --dport 2222 -j DNAT --to-destination {vm_ip}:22")
+    #reroute everything but ports 22 and 2222 to VM
+    commands.append(f"sudo iptables -t nat -A PREROUTING -p tcp -m multiport ! --dports 22,2222 -i {INTERFACE_NAME} -d {address} -j DNAT --to-destination {vm_ip}")
+    commands.append(f"sudo iptables -t nat -A PREROUTING -p udp -m multiport ! --dports 22,2222 -i {INTERFACE_NAME} -d {address} -j DNAT --to-destination {vm_ip}")
+
+    #SNAT source of outgoing packets
+    commands.append(f"sudo iptables -t nat -I POSTROUTING 1 -s {vm_ip} -j SNAT --to-source {address}")
 
 #execute commands and save them in file for tracability
 f= open("host_routing_commands.txt", "w")
@@ -0,0 +1,172 @@
+"""
+License: MIT
+
+Adds and removes emulated worker nodes of a running Q8S cluster according to a changed cluster configuration.
+Only the difference between the configuration and the running cluster is applied:
+
+    spawn ──> wait:<new> ──> reachable:<new> ──> push:<new> ──> setup:<new>
+    join-token, image-cache ──────────────────────┘
+    wait:<new>* ──> worker-ips ──> master-routing ──> join <── join-token
+    remove:<removed> ───────────────────┘
+"""
+import functools
+import logging
+import subprocess
+from pathlib import Path
+from openstack.connection import Connection
+from q8s.scripts import routing_master
+from q8s.scripts.deployment import Deployment
+from q8s.scripts.helper import exceptions, helper_functions, kubernetes_helper, openstack_communication
+from q8s.scripts.helper.cluster_def import ClusterData, format_worker_name, parse_worker_name
+from q8s.scripts.helper.deploy_graph import DeployGraph
+from q8s.scripts.helper.deploy_state import DeployStateFile
+
+
+logger = logging.getLogger("logger")
+
+
+def plan_scaling(cluster_data: ClusterData, existing_workers: list[str]) -> tuple[list[str], list[str]]:
+    """
+    Compares the number of workers per VmType in the cluster configuration with the running workers.
+    New workers are numbered after the highest existing worker number, so existing workers keep their names.
+    Surplus workers are removed starting with the highest number.
+
+    Args:
+        cluster_data (ClusterData): The new cluster configuration.
+        existing_workers (list[str]): Names of the running worker instances, other names (e.g. shared hosts 'host-{number}')
+            are skipped with a warning.
+
+    Returns:
+        tuple[list[str], list[str]]: Names of the workers to add and names of the workers to remove.
+
+    Raises:
+        Q8sFatalError: If the configuration requests workers of an undefined VmType.
+    """
+    desired = cluster_data.cluster_definition.worker
+    for vm_type in desired:
+        if vm_type not in cluster_data.vm_types.types:
+            raise exceptions.Q8sFatalError(f"VmType {vm_type} is not defined in vm_types.")
+
+    skipped = [name for name in existing_workers if parse_worker_name(name) is None]
+    if skipped:
+        logger.warning(f"Instances {skipped} are no workers and are not scaled.")
+    existing_workers = [name for name in existing_workers if parse_worker_name(name) is not None]
+
+    by_type = {}
+    for name in existing_workers:
+        number, vm_type = parse_worker_name(name)
+        by_type.setdefault(vm_type, []).append((number, name))
+    next_number = max((parse_worker_name(n)[0] for n in existing_workers), default=0) + 1
+
+    to_remove = []
+    for vm_type, workers in by_type.items():
+        workers.sort()
+        surplus = len(workers) - int(desired.get(vm_type, 0))
+        if surplus > 0:
+            to_remove += [name for _, name in workers[-surplus:]]
+    to_add = []
+    for vm_type, number in desired.items():
+        for _ in range(int(number) - len(by_type.get(vm_type, []))):
+            to_add.append(format_worker_name(next_number, vm_type))
+            next_number += 1
+    return to_add, to_remove
+
+
+class Scaling(Deployment):
+    """Deployment of additional workers into a running cluster and removal of surplus workers."""
+
+    def __init__(self, conn: Connection, cluster_data: ClusterData, cluster_data_file: Path, state_file: DeployStateFile,
+                 existing_servers: dict, to_add: list[str], to_remove: list[str]):
+        super().__init__(conn, cluster_data, cluster_data_file, state_file, master_names=[], worker_names=to_add)
+        self.to_remove = to_remove
+        self.existing_masters = {}
+        self.kept_workers = {}
+        self.removed_workers = {}
+        for name, server in existing_servers.items():
+            ip = openstack_communication.get_server_ip(conn, server, cluster_data)
+            if name.startswith("master-"):
+                self.existing_masters[name] = ip
+            elif name in to_remove:
+                self.removed_workers[name] = ip
+            else:
+                self.kept_workers[name] = ip
+        self.existing_servers = existing_servers
+
+    def mint_join_command(self):
+        """Creates a fresh kubeadm token and saves the join command for the new workers."""
+        result = subprocess.run("sudo kubeadm token create --print-join-command", capture_output=True, text=True, shell=True)
+        if result.returncode != 0:
+            raise exceptions.Q8sFatalError(f"Could not create a new join token. Stderr: {result.stderr}")
+        with open("/home/cloud/resources/join_command_worker.txt", "w", encoding='utf-8') as f:
+            f.write("sudo " + result.stdout.strip() + "\n")
+
+    def all_worker_ips(self) -> list[str]:
+        """Returns the IPs of all workers remaining in the cluster."""
+        return list(self.kept_workers.values()) + self.ordered_ips(self.worker_names, self.worker_nodes)
+
+    def write_node_ips(self):
+        """Saves the IPs of all remaining workers for the master nodes."""
+        with open("/home/cloud/resources/worker_ips.txt", "w", encoding='utf-8') as f:
+            f.write(str(self.all_worker_ips()))
+
+    def create_master_routing(self):
+        """Adds the routing rules of new workers and removes those of removed workers on all master nodes."""
+        worker_ips = self.all_worker_ips()
+        # an IP of a removed worker may already belong to a new worker
+        removed_ips = [ip for ip in self.removed_workers.values() if ip not in worker_ips]
+        logger.info("Updating routing rules.")
+        routing_master.create_master_routing(worker_ips)
+        routing_master.remove_master_routing(removed_ips)
+        subprocess.run("bash /home/cloud/Q8S/src/q8s/scripts/helper/make_master_routing_persistent.sh", shell=True)
+        helper_functions.send_file_via_sftp(list(self.existing_masters.values()), "/home/cloud/resources/worker_ips.txt", "/home/cloud/resources/worker_ips.txt")
+        for name, ip in self.existing_masters.items():
+            code = helper_functions.execute_ssh_command(ip, f"python3 /home/cloud/Q8S/src/q8s/scripts/routing_master.py \"{worker_ips}\" \"{removed_ips}\"")
+            if code != 0:
+                raise exceptions.Q8sFatalError(f"Could not update routing rules on master node {name}.")
+
+    def remove_worker(self, name: str):
+        """Drains and deletes the Kubernetes node of a worker and deletes its instance."""
+        node_name = "vm-" + name
+        logger.info(f"Removing worker {name}.")
+        result = subprocess.run(f"kubectl drain {node_name} --ignore-daemonsets --delete-emptydir-data --force --timeout=300s", capture_output=True, text=True, shell=True)
+        if result.returncode != 0:
+            logger.warning(f"Could not drain node {node_name}, deleting it anyway. Stderr: {result.stderr}")
+        if not kubernetes_helper.delete_node(node_name):
+            raise exceptions.Q8sFatalError(f"Could not delete node {node_name} from the cluster.")
+        self.conn.compute.delete_server(self.existing_servers[name])
+        with self.state_file.update() as state:
+            state.nodes.pop(name, None)
+
+
+def build_scale_graph(scaling: Scaling) -> DeployGraph:
+    """
+    Creates the dependency graph of all stages for scaling a running cluster.
+
+    Args:
+        scaling (Scaling): The scaling operation the stages operate on.
+
+    Returns:
+        DeployGraph: The graph, ready to be run.
+    """
+    graph = DeployGraph()
+    scaling.graph = graph
+    remove_stages = []
+    for name in scaling.to_remove:
+        graph.add_stage(f"remove:{name}", lambda n=name: scaling.remove_worker(n))
+        remove_stages.append(f"remove:{name}")
+    wait_stages = []
+    if scaling.worker_names:
+        graph.add_stage("spawn", scaling.spawn)
+        graph.add_stage("join-token", scaling.mint_join_command)
+        graph.add_stage("image-cache", scaling.start_image_cache)
+        for name in scaling.worker_names:
+            graph.add_stage(f"wait:{name}", functools.partial(scaling.wait_for_node, name), ["spawn"])
+            graph.add_stage(f"reachable:{name}", functools.partial(scaling.wait_until_reachable, name), [f"wait:{name}"])
+            graph.add_stage(f"push:{name}", lambda n=name: scaling.push_worker_files(n), [f"reachable:{name}", "join-token", "image-cache"])
+            graph.add_stage(f"setup:{name}", lambda n=name: scaling.setup_worker(n), [f"push:{name}"])
+            wait_stages.append(f"wait:{name}")
+    graph.add_stage("worker-ips", scaling.write_node_ips, wait_stages)
+    graph.add_stage("master-routing", scaling.create_master_routing, ["worker-ips"] + remove_stages)
+    if scaling.worker_names:
+        graph.add_stage("join", scaling.wait_for_join, ["join-token", "master-routing"])
+    return graph
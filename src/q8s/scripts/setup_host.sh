@@ -1,30 +1,17 @@
 #!bin/bash
 # Author: Vincent Hasse
 # License: MIT
-# sets up libvirt network, creates VM based on hostname and starts it, creates routing rules, installs required packages
+# sets up libvirt network, creates the VMs listed in resources/vms.txt and starts them, creates routing rules, installs required packages
 
-#otherwise there might be problems with apt update 
-sudo sh -c 'echo "GNUTLS_CPUID_OVERRIDE=0x1" >> /etc/environment'
-
-sudo apt update
-echo -e "Installing packages\n"
-#automatically select default option in case of conflicts with configuration files 
-sudo apt upgrade -y -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold"
-
-sudo apt install -y net-tools dnsutils git cloud-image-utils
-
-#QEMU
-sudo apt install -y qemu-system-x86 qemu-system-aarch64 qemu-efi-aarch64 
-
-#libvirt
-echo -e "\nInstalling libvirt\n"
-sudo apt install -y libvirt-daemon-system virtinst
-sudo sed -i 's|#user = "root"|user = "root"|g' /etc/libvirt/qemu.conf 
-sudo sed -i 's|#group = "root"|group = "root"|g' /etc/libvirt/qemu.conf 
-sudo systemctl restart libvirtd
-#sudo adduser $USER libvirt --> not necessary as cloud is member of 'sudo'-group
+echo "Q8S-STEP Preparing host"
+#install packages, unless the instance was booted from an image created by 'q8s bake'
+if [ -f /etc/q8s/host-prepared ]; then
+    echo -e "Host already prepared, skipping package installation\n"
+else
+    bash /home/cloud/Q8S/src/q8s/scripts/prepare_host.sh
+fi
 
-echo -e "\nSetting up network\n"
+echo "Q8S-STEP Setting up network"
 #destroy old default network
 sudo virsh net-destroy default
 #add dns to default network
@@ -48,40 +35,43 @@ cd /home/cloud
 mkdir -p /home/cloud/resources
 sudo chown cloud resources/ 
 
-echo -e "\nInstalling guest...\n"
-python3 /home/cloud/Q8S/src/q8s/scripts/install_guest.py > /home/cloud/install_guest.log
-#get mac address of vm
-VIRSH_COMMAND="$(cat /home/cloud/resources/virsh-command.txt) --print-xml"
-$VIRSH_COMMAND > /home/cloud/resources/vm_dump.xml
-VM_MAC="$(cat /home/cloud/resources/vm_dump.xml | grep 'mac address' | awk -F'\"' '$0=$2')"
-echo $VM_MAC > /home/cloud/resources/debug_mac.log
-#assign static ip to vm where the last digits are equal to the host's last digits
-DIGITS=$(hostname -I | cut -d' ' -f 1 | cut -d'.' -f 4)
-sudo virsh net-update default add-last ip-dhcp-host "<host mac='$VM_MAC' name='vm-$HOSTNAME' ip='192.11.$DIGITS.$DIGITS'/>" --live --config
-
-#setting VM behavior when shutdown, restarted and when crashing. Options can be found at https://libvirt.org/formatdomain.html
-TEMP_XML="/home/cloud/resources/vm_dump.xml"
-
-if grep -q "<on_poweroff>" "$TEMP_XML"; then
-    sudo sed -i 's|<on_poweroff>.*</on_poweroff>|<on_poweroff>destroy</on_poweroff>|g' "$TEMP_XML"
-else
-    sudo sed -i '/<\/domain>/i <on_poweroff>destroy</on_poweroff>' "$TEMP_XML"
-fi
-
-if grep -q "<on_reboot>" "$TEMP_XML"; then
-    sudo sed -i 's|<on_reboot>.*</on_reboot>|<on_reboot>restart</on_reboot>|g' "$TEMP_XML"
-else
-    sudo sed -i '/<\/domain>/i <on_reboot>restart</on_reboot>' "$TEMP_XML"
-fi
-
-if grep -q "<on_crash>" "$TEMP_XML"; then
-    sudo sed -i 's|<on_crash>.*</on_crash>|<on_crash>restart</on_crash>|g' "$TEMP_XML"
-else
-    sudo sed -i '/<\/domain>/i <on_crash>restart</on_crash>' "$TEMP_XML"
-fi
+echo "Q8S-STEP Installing guest"
+python3 -u /home/cloud/Q8S/src/q8s/scripts/install_guest.py 2>&1 | tee /home/cloud/install_guest.log
+#prepare every VM of the host, the list holds name, IP the VM is reached with and IP of the VM in the libvirt network
+#commands in the loop read from /dev/null, they would consume the list otherwise
+while read NAME ADDRESS VM_IP; do
+    [ -z "$NAME" ] && continue
+    #get mac address of vm
+    VIRSH_COMMAND="$(cat /home/cloud/resources/virsh-command-$NAME.txt) --print-xml"
+    TEMP_XML="/home/cloud/resources/vm_dump-$NAME.xml"
+    $VIRSH_COMMAND > "$TEMP_XML" < /dev/null
+    VM_MAC="$(cat "$TEMP_XML" | grep 'mac address' | awk -F'\"' '$0=$2')"
+    echo $VM_MAC >> /home/cloud/resources/debug_mac.log
+    #assign static ip to vm, its last digits are equal to the last digits of the IP it is reached with
+    sudo virsh net-update default add-last ip-dhcp-host "<host mac='$VM_MAC' name='vm-$NAME' ip='$VM_IP'/>" --live --config < /dev/null
+
+    #setting VM behavior when shutdown, restarted and when crashing. Options can be found at https://libvirt.org/formatdomain.html
+    if grep -q "<on_poweroff>" "$TEMP_XML"; then
+        sudo sed -i 's|<on_poweroff>.*</on_poweroff>|<on_poweroff>destroy</on_poweroff>|g' "$TEMP_XML"
+    else
+        sudo sed -i '/<\/domain>/i <on_poweroff>destroy</on_poweroff>' "$TEMP_XML"
+    fi
+
+    if grep -q "<on_reboot>" "$TEMP_XML"; then
+        sudo sed -i 's|<on_reboot>.*</on_reboot>|<on_reboot>restart</on_reboot>|g' "$TEMP_XML"
+    else
+        sudo sed -i '/<\/domain>/i <on_reboot>restart</on_reboot>' "$TEMP_XML"
+    fi
+
+    if grep -q "<on_crash>" "$TEMP_XML"; then
+        sudo sed -i 's|<on_crash>.*</on_crash>|<on_crash>restart</on_crash>|g' "$TEMP_XML"
+    else
+        sudo sed -i '/<\/domain>/i <on_crash>restart</on_crash>' "$TEMP_XML"
+    fi
+done < /home/cloud/resources/vms.txt
 
 #create routing rules
-echo -e "\nCreating routing rules..."
+echo "Q8S-STEP Creating routing rules"
 python3 /home/cloud/Q8S/src/q8s/scripts/routing_worker.py
 sudo sysctl -w net.ipv4.ip_forward=1 && sudo sed -i '/^net.ipv4.ip_forward/d' /etc/sysctl.conf && echo "net.ipv4.ip_forward=1" | sudo tee -a /etc/sysctl.conf
 #add the routing rules on restart
@@ -108,10 +98,13 @@ EOF"
 sudo systemctl daemon-reload
 sudo systemctl enable recreate_q8s_routing_rules.service
 
-#install vm
+#install vms
 cd /home/cloud/resources
-echo -e "\nStarting VM..."
-sudo virsh define /home/cloud/resources/vm_dump.xml
-sudo virsh start vm-$HOSTNAME
-
-echo -e "\nHost setup finished, VM starting."
\ No newline at end of file
+echo "Q8S-STEP Starting VMs"
+while read NAME ADDRESS VM_IP; do
+    [ -z "$NAME" ] && continue
+    sudo virsh define /home/cloud/resources/vm_dump-$NAME.xml < /dev/null
+    sudo virsh start vm-$NAME < /dev/null
+done < /home/cloud/resources/vms.txt
+
+echo -e "\nHost setup finished, VMs starting."
\ No newline at end of file
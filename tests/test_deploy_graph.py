@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+from q8s.scripts.helper import exceptions
+from q8s.scripts.helper.deploy_graph import DeployGraph
+
+
+def test_validate_rejects_unknown_dependency():
+    graph = DeployGraph()
+    graph.add_stage("push:worker-1-x86", lambda: None, ["spawn"])
+    with pytest.raises(ValueError, match="unknown stage spawn"):
+        graph.validate()
+
+
+def test_validate_rejects_cycle():
+    graph = DeployGraph()
+    graph.add_stage("a", lambda: None, ["c"])
+    graph.add_stage("b", lambda: None, ["a"])
+    graph.add_stage("c", lambda: None, ["b"])
+    with pytest.raises(ValueError, match="cycle"):
+        graph.validate()
+
+
+def test_add_stage_rejects_duplicate():
+    graph = DeployGraph()
+    graph.add_stage("a", lambda: None)
+    with pytest.raises(ValueError):
+        graph.add_stage("a", lambda: None)
+
+
+def test_stage_node():
+    graph = DeployGraph()
+    assert graph.add_stage("push:worker-1-x86", lambda: None).node == "worker-1-x86"
+    assert graph.add_stage("init-master", lambda: None).node == ""
+
+
+def test_run_respects_dependencies():
+    order = []
+    lock = threading.Lock()
+
+    def record(name):
+        def action():
+            with lock:
+                order.append(name)
+            return name
+        return action
+
+    graph = DeployGraph()
+    graph.add_stage("spawn", record("spawn"))
+    graph.add_stage("wait:w1", record("wait:w1"), ["spawn"])
+    graph.add_stage("wait:w2", record("wait:w2"), ["spawn"])
+    graph.add_stage("join", record("join"), ["wait:w1", "wait:w2"])
+    results = graph.run(max_concurrency=4)
+
+    assert order[0] == "spawn" and order[-1] == "join"
+    assert all(r.status == DeployGraph.SUCCEEDED for r in results.values())
+    assert results["join"].value == "join"
+
+
+def test_run_executes_coroutine_stages():
+    async def action():
+        return 42
+
+    graph = DeployGraph()
+    graph.add_stage("wait:w1", action)
+    assert graph.run()["wait:w1"].value == 42
+
+
+def test_failure_skips_dependents_only():
+    def fail():
+        raise RuntimeError("boom")
+
+    graph = DeployGraph()
+    graph.add_stage("push:w1", fail)
+    graph.add_stage("setup:w1", lambda: None, ["push:w1"])
+    graph.add_stage("join:w1", lambda: None, ["setup:w1"])
+    graph.add_stage("push:w2", lambda: None)
+    with pytest.raises(exceptions.Q8sFatalError, match="push:w1: boom"):
+        graph.run()
+
+    assert graph.results["push:w1"].status == DeployGraph.FAILED
+    assert graph.results["setup:w1"].status == DeployGraph.SKIPPED
+    assert graph.results["join:w1"].status == DeployGraph.SKIPPED
+    assert graph.results["push:w2"].status == DeployGraph.SUCCEEDED
+    assert list(graph.failed()) == ["push:w1"]
+
+
+def test_completed_stages_are_not_run_again():
+    calls = []
+    completed = []
+    graph = DeployGraph()
+    graph.add_stage("spawn", lambda: calls.append("spawn"))
+    graph.add_stage("push:w1", lambda: calls.append("push:w1"), ["spawn"])
+    results = graph.run(completed={"spawn"}, on_stage_completed=completed.append)
+
+    assert calls == ["push:w1"]
+    assert completed == ["push:w1"]
+    assert results["spawn"].status == DeployGraph.COMPLETED_BEFORE
@@ -0,0 +1,43 @@
+import pytest
+
+from q8s.scripts.helper import exceptions
+from q8s.scripts.helper.deploy_state import DeployState, DeployStateFile, check_cluster_data_file, create_deploy_state, load_deploy_state
+
+
+@pytest.fixture
+def cluster_file(tmp_path):
+    path = tmp_path / "cluster.yaml"
+    path.write_text("workers: 2\n")
+    return path
+
+
+def test_resume_requires_state_file(tmp_path):
+    assert load_deploy_state(tmp_path / "missing.yaml") == DeployState()
+    with pytest.raises(exceptions.Q8sFatalError):
+        load_deploy_state(tmp_path / "missing.yaml", required=True)
+    (tmp_path / "corrupt.yaml").write_text("nodes: [")
+    with pytest.raises(exceptions.Q8sFatalError):
+        load_deploy_state(tmp_path / "corrupt.yaml", required=True)
+
+
+def test_saved_state_is_loaded(tmp_path, cluster_file):
+    state_file = DeployStateFile(tmp_path / "state.yaml", create_deploy_state(cluster_file))
+    state_file.node("master-1").server_id = "abc"
+    state_file.mark_stage_completed("spawn")
+    state = load_deploy_state(tmp_path / "state.yaml", required=True)
+    assert state.completed_stages == ["spawn"]
+    assert state.nodes["master-1"].server_id == "abc"
+    check_cluster_data_file(state, cluster_file)
+
+
+def test_resume_rejects_changed_cluster_definition(cluster_file):
+    state = create_deploy_state(cluster_file)
+    cluster_file.write_text("workers: 3\n")
+    with pytest.raises(exceptions.Q8sFatalError):
+        check_cluster_data_file(state, cluster_file)
+
+
+def test_resume_compares_path_of_state_without_digest(tmp_path, cluster_file):
+    check_cluster_data_file(DeployState(cluster_data_file=str(cluster_file)), cluster_file)
+    with pytest.raises(exceptions.Q8sFatalError):
+        check_cluster_data_file(DeployState(cluster_data_file=str(tmp_path / "other.yaml")), cluster_file)
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openstack")
+
+from q8s.scripts.helper import flavor_planner
+from q8s.scripts.helper.cluster_def import VmType
+
+LIMITS = {"instances": 10, "cores": 20, "ram": 40960, "disk": 200}
+EMPTY = {"instances": 0, "cores": 0, "ram": 0, "disk": 0}
+
+
+def flavor(name, vcpus, ram, disk):
+    return SimpleNamespace(name=name, vcpus=vcpus, ram=ram, disk=disk)
+
+
+def test_host_requirements_include_overhead_and_host():
+    requirements = flavor_planner.get_host_requirements(VmType(architecture="arm_64", num_cpus=3, ram=2000, storage=20, emulation_overhead=0.0))
+    assert requirements == flavor_planner.HostRequirements(vcpus=5, ram=3000 + flavor_planner.HOST_RAM_MB, disk=20 + flavor_planner.HOST_DISK_GB)
+    requirements = flavor_planner.get_host_requirements(VmType(num_cpus=2, ram=1024, storage=10, emulation_overhead=2.0))
+    assert (requirements.vcpus, requirements.ram) == (4, 2048 + flavor_planner.HOST_RAM_MB)
+
+
+def test_flavor_cost_ignores_unlimited_resources():
+    assert flavor_planner.flavor_cost(flavor("a", 2, 4096, 20), LIMITS) == pytest.approx(0.1 + 0.1 + 0.1)
+    assert flavor_planner.flavor_cost(flavor("a", 2, 4096, 20), {**LIMITS, "ram": -1, "disk": -1}) == pytest.approx(0.1)
+
+
+def test_fits_quota_treats_negative_limits_as_unlimited():
+    used = {"instances": 11, "cores": 20, "ram": 0, "disk": 0}
+    assert not flavor_planner.fits_quota(used, LIMITS)
+    assert flavor_planner.fits_quota(used, {**LIMITS, "instances": -1})
+
+
+def test_search_takes_cheapest_fitting_assignment():
+    small, large = flavor("small", 2, 4096, 20), flavor("large", 8, 4096, 20)
+    candidates = {"x86": (2, [small, large]), "arm": (1, [small, large])}
+    fits, _, assignment, used = flavor_planner.search_assignment(candidates, EMPTY, LIMITS)
+    assert fits and assignment == {"x86": small, "arm": small}
+    assert used["cores"] == 6
+
+    fits, _, assignment, used = flavor_planner.search_assignment({"arm": (1, [large])}, {**EMPTY, "cores": 14}, LIMITS)
+    assert not fits and used["cores"] == 22
+
+
+def test_search_without_planned_types():
+    assert flavor_planner.search_assignment({}, EMPTY, LIMITS) == (True, 0.0, {}, EMPTY)
+
+
+def test_greedy_search_matches_exhaustive_search(monkeypatch):
+    # the cheaper flavor of x86 only fits if arm takes its small flavor
+    cheap, wide = flavor("cheap", 4, 1024, 10), flavor("wide", 2, 8192, 10)
+    tiny, big = flavor("tiny", 2, 1024, 10), flavor("big", 12, 1024, 10)
+    candidates = {"x86": (2, [cheap, wide]), "arm": (1, [tiny, big])}
+    exhaustive = flavor_planner.search_assignment(candidates, EMPTY, LIMITS)
+    monkeypatch.setattr(flavor_planner, "MAX_COMBINATIONS", 1)
+    greedy = flavor_planner.search_assignment(candidates, EMPTY, LIMITS)
+    assert exhaustive == greedy
+    assert greedy[0] and greedy[2] == {"x86": cheap, "arm": tiny}
+
+
+def test_greedy_search_reduces_overuse_first(monkeypatch):
+    monkeypatch.setattr(flavor_planner, "MAX_COMBINATIONS", 1)
+    # the search starts with the first candidate which exceeds the cores
+    cores_heavy, ram_heavy = flavor("cores", 12, 1024, 10), flavor("ram", 2, 30000, 10)
+    fits, _, assignment, _ = flavor_planner.search_assignment({"x86": (2, [cores_heavy, ram_heavy])}, EMPTY, {**LIMITS, "ram": 81920})
+    assert fits and assignment == {"x86": ram_heavy}
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("keystoneauth1")
+pytest.importorskip("openstack")
+
+from q8s.scripts.helper import openstack_retry
+from q8s.scripts.helper.openstack_retry import RetryPolicy, TokenBucket, get_retry_after
+
+
+def response(status: int = 503, **headers):
+    return SimpleNamespace(status_code=status, headers=headers)
+
+
+@pytest.mark.parametrize("method, status, headers, expected", [
+    ("POST", 429, {}, True),
+    ("GET", 429, {}, True),
+    ("POST", 503, {}, False),
+    ("POST", 503, {"Retry-After": "2"}, True),
+    ("GET", 503, {}, True),
+    ("POST", 409, {}, False),
+    ("PUT", 409, {}, True),
+    ("POST", 502, {}, False),
+    ("DELETE", 502, {}, True),
+    ("POST", 504, {}, False),
+    ("get", 504, {}, True),
+    ("GET", 500, {}, False),
+    ("GET", 404, {}, False),
+])
+def test_retryable_status(method, status, headers, expected):
+    assert RetryPolicy().retryable_status(method, status, response(status, **headers)) is expected
+
+
+def test_get_retry_after():
+    assert get_retry_after(None) is None
+    assert get_retry_after(response()) is None
+    assert get_retry_after(response(**{"Retry-After": "3"})) == 3.0
+    assert get_retry_after(response(**{"Retry-After": "-3"})) == 0.0
+    assert get_retry_after(response(**{"Retry-After": "soon"})) is None
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < get_retry_after(response(**{"Retry-After": later})) <= 30
+    earlier = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=30), usegmt=True)
+    assert get_retry_after(response(**{"Retry-After": earlier})) == 0.0
+
+
+def test_delay_is_bounded_by_backoff_and_retry_after():
+    policy = RetryPolicy(base_delay=1.0, max_delay=8.0)
+    for attempt in range(6):
+        assert 0 <= policy.delay(attempt) <= min(8.0, 2 ** attempt)
+    assert 5.0 <= policy.delay(0, response(**{"Retry-After": "5"})) <= 8.0
+    assert policy.delay(0, response(**{"Retry-After": "600"})) == 32.0
+
+
+def test_token_bucket_allows_burst_then_waits(monkeypatch):
+    now = [0.0]
+    sleeps = []
+    monkeypatch.setattr(openstack_retry.time, "monotonic", lambda: now[0])
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(openstack_retry.time, "sleep", sleep)
+    bucket = TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert sleeps == []
+    bucket.acquire()
+    assert sleeps == [pytest.approx(0.5)]
+
+
+def test_install_retries_status_codes(monkeypatch):
+    monkeypatch.setattr(openstack_retry.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(openstack_retry, "_limiter", TokenBucket(rate=1000, burst=1000))
+    monkeypatch.setattr(openstack_retry, "_policy", RetryPolicy(max_retries=3))
+    answers = {"GET": [response(503), response(502), response(200)], "POST": [response(503), response(200)]}
+    session = SimpleNamespace(request=lambda url, method, **kwargs: answers[method].pop(0))
+    conn = SimpleNamespace(session=session)
+    openstack_retry.install(conn)
+    openstack_retry.install(conn)
+
+    result = conn.session.request("/servers", "GET")
+    assert (result.status_code, result.q8s_retries) == (200, 2)
+    # POST without Retry-After is not repeated, the server might have been created
+    result = conn.session.request("/servers", "POST")
+    assert (result.status_code, result.q8s_retries) == (503, 0)
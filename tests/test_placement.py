@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openstack")
+
+from q8s.scripts.helper import exceptions, flavor_planner, openstack_resolver, placement
+from q8s.scripts.helper.cluster_def import ClusterData, ClusterDefinition, VmType, VmTypes
+
+FLAVORS = {
+    "host": SimpleNamespace(name="host", vcpus=8, ram=8192 + flavor_planner.HOST_RAM_MB, disk=100 + flavor_planner.HOST_DISK_GB),
+    "master": SimpleNamespace(name="master", vcpus=2, ram=4096, disk=20),
+}
+
+
+@pytest.fixture(autouse=True)
+def resolver(monkeypatch):
+    monkeypatch.setattr(openstack_resolver, "get_resolver", lambda conn: SimpleNamespace(flavor=FLAVORS.get))
+
+
+def cluster(worker: dict, host_flavor: str = "host") -> ClusterData:
+    return ClusterData(
+        cluster_definition=ClusterDefinition(number_additional_master_nodes=1, master_node_flavor="master", worker=worker, worker_host_flavor=host_flavor),
+        vm_types=VmTypes(types={
+            "x86_small": VmType(architecture="x86_64", num_cpus=2, ram=2048, storage=10),
+            "arm_mid": VmType(architecture="arm_64", num_cpus=4, ram=2048, storage=20),
+            "arm_huge": VmType(architecture="arm_64", num_cpus=8, ram=2048, storage=20),
+        }),
+    )
+
+
+def test_vm_demand_excludes_host_resources():
+    demand = placement.get_vm_demand(cluster({"arm_mid": 1}), "worker-1-arm_mid")
+    assert demand == flavor_planner.HostRequirements(vcpus=6, ram=3072, disk=20)
+
+
+def test_plan_placement_first_fit_decreasing():
+    result = placement.plan_placement(None, cluster({"x86_small": 3, "arm_mid": 2}))
+    # the arm VMs need 6 vCPUs each and are placed first, the x86 VMs fill the remaining 2 vCPUs
+    assert result == {
+        "host-1": ["worker-1-x86_small", "worker-4-arm_mid"],
+        "host-2": ["worker-2-x86_small", "worker-5-arm_mid"],
+        "host-3": ["worker-3-x86_small"],
+    }
+
+
+def test_plan_placement_of_given_workers():
+    result = placement.plan_placement(None, cluster({"x86_small": 3}), ["worker-2-x86_small", "worker-7-x86_small"])
+    assert result == {"host-1": ["worker-2-x86_small", "worker-7-x86_small"]}
+
+
+def test_plan_placement_rejects_too_large_vm():
+    with pytest.raises(exceptions.Q8sFatalError):
+        placement.plan_placement(None, cluster({"arm_huge": 1}))
+
+
+def test_plan_placement_rejects_missing_flavor():
+    with pytest.raises(exceptions.Q8sFatalError):
+        placement.plan_placement(None, cluster({"x86_small": 1}, host_flavor="missing"))
+
+
+def test_fits_quota():
+    cluster_data = cluster({"x86_small": 4})
+    plan = flavor_planner.FlavorPlan(
+        used_now={"instances": 0, "cores": 0, "ram": 0, "disk": 0},
+        limits={"instances": 3, "cores": 20, "ram": -1, "disk": -1},
+    )
+    assert placement.fits_quota(None, cluster_data, {"host-1": [], "host-2": []}, plan)
+    assert not placement.fits_quota(None, cluster_data, {"host-1": [], "host-2": [], "host-3": []}, plan)
+
+
+def test_fits_quota_rejects_missing_flavor():
+    plan = flavor_planner.FlavorPlan(used_now={"instances": 0, "cores": 0, "ram": 0, "disk": 0}, limits={"instances": -1, "cores": -1, "ram": -1, "disk": -1})
+    with pytest.raises(exceptions.Q8sFatalError):
+        placement.fits_quota(None, cluster({"x86_small": 1}, host_flavor="missing"), {"host-1": ["worker-1-x86_small"]}, plan)
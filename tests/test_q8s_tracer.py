@@ -0,0 +1,56 @@
+import pytest
+
+from q8s.scripts.helper.q8s_tracer import Tracer, vm_type_of
+
+
+def test_vm_type_of():
+    assert vm_type_of("worker-1-x86-small") == "x86-small"
+    assert vm_type_of("vm-worker-12-arm-mid") == "arm-mid"
+    assert vm_type_of("master-1") == "master"
+    assert vm_type_of("") == "-"
+
+
+def test_node_alias_maps_ip_to_name():
+    tracer = Tracer()
+    tracer.set_node_alias("10.0.0.5", "worker-1-x86")
+    assert tracer.add_span("sftp_put", 0, 1, "10.0.0.5").node == "worker-1-x86"
+
+
+def test_span_records_errors():
+    tracer = Tracer()
+    with pytest.raises(RuntimeError):
+        with tracer.span("setup", "worker-1-x86"):
+            raise RuntimeError("boom")
+    assert tracer.spans[0].args["error"] == "boom"
+
+
+def test_critical_path_follows_last_finished_dependency():
+    tracer = Tracer()
+    tracer.add_span("spawn", 0, 10, category="stage")
+    tracer.add_span("init-master", 0, 30, category="stage")
+    tracer.add_span("wait:w1", 10, 20, "w1", "stage", depends_on=["spawn"])
+    tracer.add_span("push:w1", 30, 35, "w1", "stage", depends_on=["wait:w1", "init-master"])
+    tracer.add_span("setup:w1", 35, 90, "w1", "stage", depends_on=["push:w1"])
+    tracer.add_span("setup:w2", 35, 60, "w2", "stage", depends_on=["spawn"])
+
+    assert [s.name for s in tracer.critical_path()] == ["init-master", "push:w1", "setup:w1"]
+    assert "Critical path (90.0s)" in tracer.summary()
+
+
+def test_summary_groups_phases_by_vm_type():
+    tracer = Tracer()
+    tracer.add_span("setup", 0, 10, "worker-1-x86")
+    tracer.add_span("setup", 0, 30, "worker-2-x86")
+    line = next(l for l in tracer.summary().splitlines() if l.startswith("setup"))
+    assert line.split() == ["setup", "x86", "2", "20.0", "30.0"]
+
+
+def test_chrome_trace_uses_one_track_per_node():
+    tracer = Tracer()
+    tracer.origin = 0
+    tracer.add_span("a", 1, 2, "worker-1-x86")
+    tracer.add_span("b", 2, 3)
+    events = tracer.to_chrome_trace()["traceEvents"]
+    spans = {e["name"]: e for e in events if e["ph"] == "X"}
+    assert spans["a"]["ts"] == 1_000_000 and spans["a"]["dur"] == 1_000_000
+    assert spans["a"]["tid"] != spans["b"]["tid"] == 0